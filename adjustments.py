@@ -0,0 +1,157 @@
+import asyncio
+
+import database
+import provisioning
+import queries
+import ratelimit
+import user_cache
+import xui_api
+from config import logger, BULK_CHUNK_SIZE, BULK_CONCURRENCY
+from utils import safe_bot_edit_message_text
+
+SEGMENTS = {
+    "active": ("активным", "expiry_date > NOW()"),
+    "all": ("всем", "TRUE"),
+}
+
+CREATE = queries.Query(
+    "adjustment_create", "INSERT INTO bulk_adjustments (segment, days, chat_id, message_id) VALUES ($1, $2, $3, $4) RETURNING id"
+)
+# по запросу на сегмент: условие отбора входит в текст, который asyncpg готовит один раз
+APPLY = {
+    segment: queries.Query(f"adjustment_apply_{segment}", f"""
+WITH updated AS (
+    UPDATE users SET expiry_date = GREATEST(COALESCE(expiry_date, NOW()), NOW()) + make_interval(days => $1),
+                     expired_notification_sent = FALSE
+    WHERE {where} RETURNING user_id, uuid
+), queued AS (
+    INSERT INTO bulk_adjustment_items (adjustment_id, user_id)
+    SELECT $2, user_id FROM updated WHERE uuid IS NOT NULL RETURNING 1
+)
+SELECT COUNT(*) FROM queued
+""")
+    for segment, (_, where) in SEGMENTS.items()
+}
+SET_TOTAL = queries.Query("adjustment_set_total", "UPDATE bulk_adjustments SET total = $2 WHERE id = $1")
+UNFINISHED = queries.Query("adjustment_unfinished", "SELECT id FROM bulk_adjustments WHERE finished_at IS NULL")
+NEXT_ITEMS = queries.Query("adjustment_next_items", """
+SELECT u.user_id, u.uuid, u.expiry_date, u.xui_state FROM bulk_adjustment_items i
+JOIN users u ON u.user_id = i.user_id
+WHERE i.adjustment_id = $1 ORDER BY i.user_id LIMIT $2
+""")
+CLEAR_XUI_STATE = queries.Query("adjustment_clear_xui_state", "UPDATE users SET xui_state = NULL WHERE user_id = ANY($1::bigint[])")
+DELETE_ITEMS = queries.Query(
+    "adjustment_delete_items", "DELETE FROM bulk_adjustment_items WHERE adjustment_id = $1 AND user_id = ANY($2::bigint[])"
+)
+PROGRESS = queries.Query(
+    "adjustment_progress", "UPDATE bulk_adjustments SET done = done + $2, deferred = deferred + $3 WHERE id = $1 RETURNING *"
+)
+FINISH = queries.Query("adjustment_finish", "UPDATE bulk_adjustments SET finished_at = NOW() WHERE id = $1 RETURNING *")
+
+class BulkAdjustments:
+    """Массовое изменение подписок (компенсация после аварии и т.п.).
+
+    Срок меняется одним UPDATE ... RETURNING, который одновременно складывает затронутых
+    пользователей в bulk_adjustment_items. Дальше они пачками по chunk_size уходят в X-UI
+    (до concurrency вызовов параллельно, без удержания соединения с базой) и удаляются
+    из items. Прерванная операция продолжается с того же места при следующем старте.
+    """
+
+    def __init__(self, chunk_size: int, concurrency: int):
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self._tasks: dict[int, asyncio.Task] = {}
+
+    async def create(self, segment: str, days: int, chat_id: int, message_id: int) -> int:
+        async with database.db_pool.acquire() as conn:
+            async with conn.transaction():
+                adjustment_id = await CREATE.fetchval(conn, segment, days, chat_id, message_id)
+                total = await APPLY[segment].fetchval(conn, days, adjustment_id)
+                await SET_TOTAL.execute(conn, adjustment_id, total)
+
+        user_cache.users.clear()
+        logger.info(f"📦 Массовое начисление #{adjustment_id}: {days} дн. {segment}, {total} ключей к обновлению")
+        self._spawn(adjustment_id)
+        return adjustment_id
+
+    async def resume(self) -> None:
+        if not database.db_pool: return
+        async with database.db_pool.acquire() as conn:
+            rows = await UNFINISHED.fetch(conn)
+        for row in rows:
+            logger.info(f"📦 Продолжаем массовое начисление #{row['id']}")
+            self._spawn(row["id"])
+
+    async def stop(self) -> None:
+        for task in self._tasks.values(): task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks.clear()
+
+    def _spawn(self, adjustment_id: int) -> None:
+        task = asyncio.create_task(self._push(adjustment_id))
+        self._tasks[adjustment_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(adjustment_id, None))
+
+    async def _push(self, adjustment_id: int) -> None:
+        ratelimit.set_priority(ratelimit.TRANSACTIONAL)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def push_one(row) -> bool:
+            email, expiry_ms = f"user_{row['user_id']}", int(row["expiry_date"].timestamp() * 1000)
+            async with semaphore:
+                try:
+                    # клиента, удаленного очисткой, в панели нет — создаем заново, как provisioning.prepare
+                    if row["xui_state"] == "deleted":
+                        return await xui_api.add_client_via_xui_api(row["uuid"], email, limit_ip=1, expiry_time=expiry_ms)
+                    return await xui_api.update_client_via_xui_api(row["uuid"], email, expiry_ms)
+                except Exception:
+                    return False
+
+        try:
+            while True:
+                async with database.db_pool.acquire() as conn:
+                    rows = await NEXT_ITEMS.fetch(conn, adjustment_id, self.chunk_size)
+                if not rows: break
+
+                if xui_api.breaker.is_open():
+                    results = [False] * len(rows)
+                else:
+                    results = await asyncio.gather(*(push_one(row) for row in rows))
+                pushed = [row["user_id"] for row, ok in zip(rows, results) if ok]
+                failed = [row for row, ok in zip(rows, results) if not ok]
+
+                async with database.db_pool.acquire() as conn:
+                    async with conn.transaction():
+                        # упавшие не теряем: их дотянет очередь отложенной выдачи
+                        for row in failed:
+                            await provisioning.queue.defer(conn, row["user_id"], row["uuid"], int(row["expiry_date"].timestamp() * 1000))
+                        # состояние сбрасываем только тем, кого панель подтвердила
+                        await CLEAR_XUI_STATE.execute(conn, pushed)
+                        await DELETE_ITEMS.execute(conn, adjustment_id, [row["user_id"] for row in rows])
+                        job = await PROGRESS.fetchrow(conn, adjustment_id, len(pushed), len(failed))
+                for user_id in pushed: user_cache.users.update(user_id, xui_state=None)
+                await self._report(job)
+
+            async with database.db_pool.acquire() as conn:
+                job = await FINISH.fetchrow(conn, adjustment_id)
+            await self._report(job, finished=True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Массовое начисление #{adjustment_id} прервано: {e}")
+
+    async def _report(self, job, finished: bool = False) -> None:
+        who, _ = SEGMENTS.get(job["segment"], (job["segment"], ""))
+        header = "✅ <b>Начисление завершено</b>" if finished else "⏳ <b>Идет начисление...</b>"
+        text = (
+            f"{header}\n\n"
+            f"{job['days']:+d} дн. {who}\n"
+            f"🔑 Обновлено ключей: {job['done'] + job['deferred']} / {job['total']}"
+        )
+        if job["deferred"]: text += f"\n⏳ Отложено до восстановления панели: {job['deferred']}"
+        try:
+            await safe_bot_edit_message_text(job["chat_id"], job["message_id"], text, parse_mode="HTML")
+        except Exception:
+            pass
+
+adjustments = BulkAdjustments(BULK_CHUNK_SIZE, BULK_CONCURRENCY)
@@ -0,0 +1,268 @@
+"""Локальные эмуляторы панели 3x-ui и Lava Business с задержками и отказами.
+
+Реализуют ровно те эндпоинты, которые дергают py3xui (через xui_api) и lava_pay, чтобы
+нагружать путь выдачи ключей и оплаты без настоящей панели:
+
+    python -m benchmarks.emulators --xui-port 2053 --lava-port 8081 \\
+        --xui-latency lognormal:80:0.6 --xui-error-rate 0.05 --xui-flap 30 --xui-auth-ttl 60
+
+После этого бота можно запускать с PANEL_URL=http://127.0.0.1:2053 и
+LAVA_API_URL=http://127.0.0.1:8081.
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import secrets
+import time
+import uuid
+from collections import Counter
+
+from aiohttp import web
+
+class LatencyModel:
+    """fixed:MS, uniform:MIN:MAX, exp:MEAN, lognormal:MEDIAN:SIGMA (все значения в мс)."""
+
+    def __init__(self, spec: str = "fixed:0"):
+        kind, *params = spec.split(":")
+        self.kind = kind
+        self.params = [float(p) for p in params]
+        if kind not in ("fixed", "uniform", "exp", "lognormal"):
+            raise ValueError(f"Unknown latency model: {spec}")
+
+    def sample(self) -> float:
+        p = self.params
+        if self.kind == "fixed": ms = p[0] if p else 0
+        elif self.kind == "uniform": ms = random.uniform(p[0], p[1])
+        elif self.kind == "exp": ms = random.expovariate(1 / p[0]) if p[0] > 0 else 0
+        else: ms = random.lognormvariate(math.log(p[0]), p[1] if len(p) > 1 else 0.5)
+        return ms / 1000
+
+class FaultProfile:
+    """Задержка на каждый запрос, доля 500-х ответов и периодическое «падение» сервиса.
+
+    flap_period > 0 — сервис flap_period секунд работает и столько же отвечает 503.
+    """
+
+    def __init__(self, latency: LatencyModel | None = None, error_rate: float = 0.0, flap_period: float = 0.0):
+        self.latency = latency or LatencyModel()
+        self.error_rate = error_rate
+        self.flap_period = flap_period
+        self._started = time.monotonic()
+
+    def is_down(self) -> bool:
+        if self.flap_period <= 0: return False
+        return int((time.monotonic() - self._started) / self.flap_period) % 2 == 1
+
+    async def apply(self) -> web.Response | None:
+        delay = self.latency.sample()
+        if delay > 0: await asyncio.sleep(delay)
+        if self.is_down(): return web.json_response({"success": False, "msg": "emulated outage"}, status=503)
+        if self.error_rate and random.random() < self.error_rate:
+            return web.json_response({"success": False, "msg": "emulated error"}, status=500)
+        return None
+
+@web.middleware
+async def _faults_middleware(request: web.Request, handler):
+    emulator = request.app["emulator"]
+    route = request.match_info.route.resource
+    emulator.requests[route.canonical if route else request.path] += 1
+    failure = await emulator.faults.apply()
+    if failure is not None:
+        emulator.failures += 1
+        return failure
+    return await handler(request)
+
+class XuiEmulator:
+    COOKIE = "3x-ui"
+
+    def __init__(self, faults: FaultProfile | None = None, inbound_id: int = 1,
+                 username: str = "admin", password: str = "admin", auth_ttl: float = 0.0):
+        self.faults = faults or FaultProfile()
+        self.inbound_id = inbound_id
+        self.username = username
+        self.password = password
+        self.auth_ttl = auth_ttl
+        self.clients: dict[str, dict] = {}
+        self.sessions: dict[str, float] = {}
+        self.requests: Counter = Counter()
+        self.failures = 0
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[_faults_middleware])
+        app["emulator"] = self
+        app.router.add_get("/csrf-token", self.csrf_token)
+        app.router.add_post("/login", self.login)
+        app.router.add_get("/panel/api/inbounds/list", self.inbounds_list)
+        app.router.add_get("/panel/api/inbounds/get/{inbound_id}", self.inbound_get)
+        app.router.add_get("/panel/api/clients/list", self.clients_list)
+        app.router.add_post("/panel/api/clients/add", self.client_add)
+        app.router.add_post("/panel/api/clients/update/{email}", self.client_update)
+        app.router.add_post("/panel/api/clients/del/{email}", self.client_delete)
+        return app
+
+    @staticmethod
+    def _ok(obj=None, msg: str = "") -> web.Response:
+        return web.json_response({"success": True, "msg": msg, "obj": obj})
+
+    @staticmethod
+    def _fail(msg: str, status: int = 200) -> web.Response:
+        return web.json_response({"success": False, "msg": msg, "obj": None}, status=status)
+
+    def _authorized(self, request: web.Request) -> bool:
+        expires = self.sessions.get(request.cookies.get(self.COOKIE, ""))
+        return expires is not None and (not expires or expires > time.monotonic())
+
+    def _inbound(self) -> dict:
+        settings = {"clients": list(self.clients.values()), "decryption": "none", "fallbacks": []}
+        return {
+            "id": self.inbound_id, "up": 0, "down": 0, "total": 0, "remark": "emulator", "enable": True,
+            "expiryTime": 0, "clientStats": [], "listen": "", "port": 443, "protocol": "vless",
+            "settings": json.dumps(settings), "streamSettings": "",
+            "sniffing": json.dumps({"enabled": False, "destOverride": []}), "tag": "inbound-443",
+        }
+
+    async def csrf_token(self, request: web.Request) -> web.Response:
+        return self._ok(secrets.token_hex(16))
+
+    async def login(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        if data.get("username") != self.username or data.get("password") != self.password:
+            return self._fail("Wrong username or password")
+        token = secrets.token_hex(16)
+        self.sessions[token] = time.monotonic() + self.auth_ttl if self.auth_ttl else 0
+        response = self._ok(msg="Login successfully")
+        response.set_cookie(self.COOKIE, token)
+        return response
+
+    async def inbounds_list(self, request: web.Request) -> web.Response:
+        if not self._authorized(request): return self._fail("unauthorized", 401)
+        return self._ok([self._inbound()])
+
+    async def inbound_get(self, request: web.Request) -> web.Response:
+        if not self._authorized(request): return self._fail("unauthorized", 401)
+        if int(request.match_info["inbound_id"]) != self.inbound_id: return self._fail("inbound not found")
+        return self._ok(self._inbound())
+
+    async def clients_list(self, request: web.Request) -> web.Response:
+        if not self._authorized(request): return self._fail("unauthorized", 401)
+        return self._ok(list(self.clients.values()))
+
+    async def client_add(self, request: web.Request) -> web.Response:
+        if not self._authorized(request): return self._fail("unauthorized", 401)
+        data = await request.json()
+        client = data.get("client") or {}
+        if self.inbound_id not in data.get("inboundIds", []): return self._fail("inbound not found")
+        if client.get("email") in self.clients: return self._fail(f"Duplicate email: {client.get('email')}")
+        self.clients[client["email"]] = client
+        return self._ok()
+
+    async def client_update(self, request: web.Request) -> web.Response:
+        if not self._authorized(request): return self._fail("unauthorized", 401)
+        email = request.match_info["email"]
+        if email not in self.clients: return self._fail(f"client {email} not found")
+        self.clients[email] = {**self.clients[email], **await request.json()}
+        return self._ok()
+
+    async def client_delete(self, request: web.Request) -> web.Response:
+        if not self._authorized(request): return self._fail("unauthorized", 401)
+        if self.clients.pop(request.match_info["email"], None) is None: return self._fail("client not found")
+        return self._ok()
+
+class LavaEmulator:
+    """Lava Business: invoice/create и invoice/status с той же проверкой подписи, что в lava_pay."""
+
+    def __init__(self, secret_key: str, faults: FaultProfile | None = None, paid_after: float = 0.0):
+        # lava_pay тянет config, поэтому импортируем только когда эмулятор Lava действительно нужен
+        from lava_pay import generate_signature
+        self._sign = generate_signature
+        self.secret_key = secret_key
+        self.faults = faults or FaultProfile()
+        self.paid_after = paid_after
+        self.invoices: dict[str, dict] = {}
+        self.requests: Counter = Counter()
+        self.failures = 0
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[_faults_middleware])
+        app["emulator"] = self
+        app.router.add_post("/business/invoice/create", self.create)
+        app.router.add_post("/business/invoice/status", self.status)
+        return app
+
+    async def _signed_json(self, request: web.Request) -> dict | None:
+        body = await request.text()
+        if request.headers.get("Signature") != self._sign(body, self.secret_key): return None
+        return json.loads(body)
+
+    async def create(self, request: web.Request) -> web.Response:
+        data = await self._signed_json(request)
+        if data is None: return web.json_response({"status": 401, "error": "Signature is not valid"}, status=401)
+        invoice_id = str(uuid.uuid4())
+        self.invoices[invoice_id] = {"orderId": data.get("orderId"), "sum": data.get("sum"), "created": time.monotonic()}
+        return web.json_response({
+            "status": 200, "status_check": True,
+            "data": {"id": invoice_id, "amount": data.get("sum"), "expired": data.get("expire"), "status": 1,
+                     "shop_id": data.get("shopId"), "url": f"https://pay.lava.invalid/invoice/{invoice_id}"},
+        })
+
+    async def status(self, request: web.Request) -> web.Response:
+        data = await self._signed_json(request)
+        if data is None: return web.json_response({"status": 401, "error": "Signature is not valid"}, status=401)
+        invoice = self.invoices.get(data.get("invoiceId"))
+        if invoice is None: return web.json_response({"status": 404, "error": "Invoice not found"}, status=404)
+        paid = time.monotonic() - invoice["created"] >= self.paid_after
+        return web.json_response({
+            "status": 200,
+            "data": {"id": data.get("invoiceId"), "order_id": invoice["orderId"], "amount": invoice["sum"],
+                     "status": "success" if paid else "created"},
+        })
+
+async def start_app(app: web.Application, port: int, host: str = "127.0.0.1") -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+def add_fault_arguments(parser: argparse.ArgumentParser, prefix: str) -> None:
+    parser.add_argument(f"--{prefix}-latency", default="fixed:0", help="fixed:MS | uniform:MIN:MAX | exp:MEAN | lognormal:MEDIAN:SIGMA")
+    parser.add_argument(f"--{prefix}-error-rate", type=float, default=0.0)
+    parser.add_argument(f"--{prefix}-flap", type=float, default=0.0, help="период up/down, с (0 — без падений)")
+
+def fault_profile(args: argparse.Namespace, prefix: str) -> FaultProfile:
+    return FaultProfile(
+        LatencyModel(getattr(args, f"{prefix}_latency")),
+        getattr(args, f"{prefix}_error_rate"),
+        getattr(args, f"{prefix}_flap"),
+    )
+
+async def _serve(args: argparse.Namespace) -> None:
+    xui = XuiEmulator(fault_profile(args, "xui"), args.inbound_id, args.username, args.password, args.xui_auth_ttl)
+    lava = LavaEmulator(args.lava_secret, fault_profile(args, "lava"), args.lava_paid_after)
+    runners = [await start_app(xui.app(), args.xui_port, args.host), await start_app(lava.app(), args.lava_port, args.host)]
+    print(f"3x-ui emulator: http://{args.host}:{args.xui_port}  Lava emulator: http://{args.host}:{args.lava_port}")
+    try:
+        while True:
+            await asyncio.sleep(10)
+            print(f"xui: {dict(xui.requests)} failures={xui.failures} | lava: {dict(lava.requests)} failures={lava.failures}")
+    finally:
+        for runner in runners: await runner.cleanup()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--xui-port", type=int, default=2053)
+    parser.add_argument("--lava-port", type=int, default=8081)
+    parser.add_argument("--inbound-id", type=int, default=1)
+    parser.add_argument("--username", default="admin")
+    parser.add_argument("--password", default="admin")
+    parser.add_argument("--xui-auth-ttl", type=float, default=0.0, help="время жизни сессии панели, с (0 — бессрочно)")
+    parser.add_argument("--lava-secret", default="emulator-secret")
+    parser.add_argument("--lava-paid-after", type=float, default=0.0, help="через сколько секунд счет считается оплаченным")
+    add_fault_arguments(parser, "xui")
+    add_fault_arguments(parser, "lava")
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,139 @@
+"""Локальные заглушки для бенчмарка: Bot API, панель X-UI, Lava и CryptoPay."""
+import asyncio
+import itertools
+import types as pytypes
+import typing
+from collections import Counter
+from datetime import datetime
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import TelegramMethod
+from aiogram.types import Chat, ChatMemberMember, Message, MessageId, User
+
+from benchmarks.emulators import LatencyModel
+
+BOT_USER = User(id=1, is_bot=True, first_name="Bench", username="bench_bot")
+
+async def _latency(model: LatencyModel | None) -> None:
+    delay = model.sample() if model else 0
+    if delay > 0: await asyncio.sleep(delay)
+
+class FakeSession(BaseSession):
+    """Сессия Bot API, которая отвечает правдоподобными объектами без сети."""
+
+    def __init__(self, latency: LatencyModel | None = None):
+        super().__init__()
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._message_ids = itertools.count(1_000_000)
+
+    async def close(self) -> None:
+        pass
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: int | None = None):
+        self.calls[method.__api_method__] += 1
+        await _latency(self.latency)
+        return self._result(bot, method)
+
+    def _result(self, bot: Bot, method: TelegramMethod):
+        returning = method.__returning__
+        options = typing.get_args(returning) if isinstance(returning, pytypes.UnionType) or typing.get_origin(returning) is typing.Union else (returning,)
+
+        if User in options: return BOT_USER
+        if Message in options:
+            chat_id = getattr(method, "chat_id", None) or 0
+            return Message(
+                message_id=next(self._message_ids),
+                date=datetime.now(),
+                chat=Chat(id=chat_id if isinstance(chat_id, int) else 0, type="private"),
+                from_user=BOT_USER,
+                text=getattr(method, "text", None),
+            ).as_(bot)
+        if MessageId in options: return MessageId(message_id=next(self._message_ids))
+        if bool in options: return True
+        if ChatMemberMember in options:
+            return ChatMemberMember(user=User(id=getattr(method, "user_id", 0), is_bot=False, first_name="user"))
+        return True
+
+class _FakeXuiClients:
+    def __init__(self, api: "FakeXuiApi"):
+        self.api = api
+
+    async def add(self, inbound_id: int, clients: list) -> None:
+        await self.api.call()
+        for client in clients: self.api.clients[client.email] = client
+
+    async def update(self, client_uuid: str, client) -> None:
+        await self.api.call()
+        self.api.clients[client.email] = client
+
+    async def delete(self, inbound_id: int, client_uuid: str) -> None:
+        await self.api.call()
+        for email, client in list(self.api.clients.items()):
+            if str(client.id) == str(client_uuid): del self.api.clients[email]
+
+class _FakeXuiInbounds:
+    def __init__(self, api: "FakeXuiApi"):
+        self.api = api
+
+    async def get_list(self) -> list:
+        await self.api.call()
+        return []
+
+class FakeXuiApi:
+    """Подмена py3xui.AsyncApi с тем же набором вызовов, что использует xui_api."""
+
+    def __init__(self, latency: LatencyModel | None = None):
+        self.latency = latency
+        self.calls = 0
+        self.clients: dict[str, object] = {}
+        self.client = _FakeXuiClients(self)
+        self.inbound = _FakeXuiInbounds(self)
+
+    async def call(self) -> None:
+        self.calls += 1
+        await _latency(self.latency)
+
+    async def login(self) -> None:
+        await self.call()
+
+class FakeLava:
+    def __init__(self, latency: LatencyModel | None = None):
+        self.latency = latency
+        self.calls = 0
+        self._ids = itertools.count(1)
+
+    async def create_invoice(self, amount: float, order_id: str, comment: str = "VPN Access") -> dict:
+        self.calls += 1
+        await _latency(self.latency)
+        invoice_id = f"inv{next(self._ids)}"
+        return {"status": 200, "data": {"id": invoice_id, "url": f"https://lava.invalid/{invoice_id}"}}
+
+    async def check_status(self, order_id: str, invoice_id: str) -> dict:
+        self.calls += 1
+        await _latency(self.latency)
+        return {"status": 200, "data": {"status": "success"}}
+
+class FakeCryptoPay:
+    def __init__(self, latency: LatencyModel | None = None):
+        self.latency = latency
+        self.calls = 0
+        self._ids = itertools.count(1)
+
+    async def create_invoice(self, **kwargs):
+        self.calls += 1
+        await _latency(self.latency)
+        invoice_id = next(self._ids)
+        return pytypes.SimpleNamespace(invoice_id=invoice_id, bot_invoice_url=f"https://t.me/CryptoBot?start={invoice_id}", status="active")
+
+    async def get_invoices(self, invoice_ids=None, **kwargs):
+        self.calls += 1
+        await _latency(self.latency)
+        return [pytypes.SimpleNamespace(invoice_id=invoice_ids, status="paid")]
+
+    async def close(self) -> None:
+        pass
@@ -0,0 +1,315 @@
+"""Офлайн-бенчмарк диспетчера: прогоняет синтетические апдейты через dp.feed_update.
+
+Telegram, X-UI, Lava и CryptoPay подменяются локальными заглушками, база — настоящий
+Postgres (нужна отдельная тестовая БД). С --emulators вместо заглушек X-UI и Lava
+поднимаются HTTP-эмуляторы из benchmarks.emulators, и запросы идут через настоящие
+py3xui и lava_pay с заданными задержками и отказами.
+
+Пользователи бенчмарка создаются в диапазоне user_id от BENCH_USER_BASE и удаляются
+до и после прогона.
+
+    python -m benchmarks.replay --dsn postgresql://postgres@localhost/bench --updates 5000 --concurrency 32
+    python -m benchmarks.replay --dsn ... --emulators --xui-latency lognormal:80:0.6 --xui-flap 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from benchmarks.emulators import LatencyModel, add_fault_arguments
+
+BENCH_USER_BASE = 9_000_000_000_000
+BENCH_ADMIN_ID = BENCH_USER_BASE - 1
+
+WORKLOAD = {
+    "start": 5,
+    "start_ref": 10,
+    "profile": 25,
+    "show_key": 5,
+    "bonus": 15,
+    "menu": 10,
+    "buy_menu": 8,
+    "lava_create": 5,
+    "lava_check": 3,
+    "crypto_create": 4,
+    "crypto_check": 2,
+    "stars_paid": 2,
+    "admin_page": 6,
+}
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dsn", required=True, help="Postgres DSN тестовой базы")
+    parser.add_argument("--users", type=int, default=500, help="сколько пользователей зарегистрировать до замера")
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tg-latency", default="fixed:0", help="задержка Bot API, формат как у --xui-latency")
+    parser.add_argument("--crypto-latency", default="fixed:0", help="задержка CryptoPay, формат как у --xui-latency")
+    parser.add_argument("--tg-rate", type=float, help="включить ratelimit с этим глобальным лимитом сообщений/с (по умолчанию без лимита)")
+    parser.add_argument("--json", help="сохранить отчет в файл")
+    parser.add_argument("--emulators", action="store_true", help="HTTP-эмуляторы 3x-ui и Lava вместо заглушек")
+    add_fault_arguments(parser, "xui")
+    add_fault_arguments(parser, "lava")
+    return parser.parse_args()
+
+class UpdateFactory:
+    def __init__(self, rng: random.Random):
+        self.rng = rng
+        self._update_ids = iter(range(1, 10**9))
+        self.users: list[int] = []
+        self._next_user = BENCH_USER_BASE
+        self._lava_invoices = 0
+        self._crypto_invoices = 0
+        self.lava_invoices: list[str] = []
+
+    def new_user(self) -> int:
+        self._next_user += 1
+        return self._next_user
+
+    def _user(self, user_id: int):
+        from aiogram.types import User
+        return User(id=user_id, is_bot=False, first_name="Bench", username=f"bench{user_id % 10**6}")
+
+    def _message(self, user_id: int, **fields):
+        from aiogram.types import Chat, Message
+        return Message(
+            message_id=next(self._update_ids),
+            date=datetime.now(),
+            chat=Chat(id=user_id, type="private"),
+            from_user=self._user(user_id),
+            **fields,
+        )
+
+    def message(self, user_id: int, text: str):
+        from aiogram.types import Update
+        return Update(update_id=next(self._update_ids), message=self._message(user_id, text=text))
+
+    def callback(self, user_id: int, data: str):
+        from aiogram.types import CallbackQuery, Update
+        from benchmarks.fakes import BOT_USER
+        menu = self._message(user_id, text="menu")
+        menu = menu.model_copy(update={"from_user": BOT_USER})
+        return Update(
+            update_id=next(self._update_ids),
+            callback_query=CallbackQuery(id=str(next(self._update_ids)), from_user=self._user(user_id), chat_instance="bench", data=data, message=menu),
+        )
+
+    def stars_payment(self, user_id: int):
+        from aiogram.types import SuccessfulPayment, Update
+        payment = SuccessfulPayment(
+            currency="XTR", total_amount=100, invoice_payload="vpn_month_sub",
+            telegram_payment_charge_id=f"tg{user_id}", provider_payment_charge_id=f"pp{user_id}",
+        )
+        return Update(update_id=next(self._update_ids), message=self._message(user_id, successful_payment=payment))
+
+    def registration(self):
+        user_id = self.new_user()
+        referrer = self.rng.choice(self.users) if self.users and self.rng.random() < 0.7 else None
+        self.users.append(user_id)
+        return self.message(user_id, f"/start {referrer}" if referrer else "/start")
+
+    def make(self, kind: str):
+        if kind == "start_ref": return self.registration()
+        user_id = self.rng.choice(self.users)
+        if kind == "start": return self.message(user_id, "/start")
+        if kind == "profile": return self.callback(user_id, "profile")
+        if kind == "show_key": return self.callback(user_id, "show_key")
+        if kind == "bonus": return self.callback(user_id, "daily_bonus")
+        if kind == "menu": return self.callback(user_id, "start")
+        if kind == "buy_menu": return self.callback(user_id, "buy_1_month")
+        if kind == "lava_create": return self.callback(user_id, "pay_lava")
+        if kind == "lava_check":
+            self._lava_invoices += 1
+            invoice_id = self.rng.choice(self.lava_invoices) if self.lava_invoices else f"inv{self._lava_invoices}"
+            return self.callback(user_id, f"L_{invoice_id}_{user_id}-{self._lava_invoices}")
+        if kind == "crypto_create": return self.callback(user_id, "pay_crypto")
+        if kind == "crypto_check":
+            self._crypto_invoices += 1
+            return self.callback(user_id, f"check_{self._crypto_invoices}")
+        if kind == "stars_paid": return self.stars_payment(user_id)
+        if kind == "admin_page": return self.callback(BENCH_ADMIN_ID, f"admin_page_{self.rng.randrange(max(len(self.users), 1))}")
+        raise ValueError(kind)
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values: return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+async def replay(dp, bot, updates: list, concurrency: int, counters: dict) -> dict:
+    latencies: dict[str, list[float]] = defaultdict(list)
+    errors: dict[str, int] = defaultdict(int)
+    queue: asyncio.Queue = asyncio.Queue()
+    for item in updates: queue.put_nowait(item)
+
+    async def worker():
+        while not queue.empty():
+            kind, update = queue.get_nowait()
+            start = time.perf_counter()
+            try:
+                await dp.feed_update(bot, update)
+            except Exception:
+                errors[kind] += 1
+            latencies[kind].append(time.perf_counter() - start)
+
+    queries_before = counters["queries"]
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        "updates": len(updates),
+        "seconds": elapsed,
+        "updates_per_second": len(updates) / elapsed if elapsed else 0,
+        "p50_ms": percentile(all_latencies, 50) * 1000,
+        "p99_ms": percentile(all_latencies, 99) * 1000,
+        "db_queries_per_update": (counters["queries"] - queries_before) / max(len(updates), 1),
+        "errors": sum(errors.values()),
+        "by_kind": {
+            kind: {
+                "count": len(values),
+                "p50_ms": percentile(values, 50) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+                "mean_ms": statistics.fmean(values) * 1000,
+                "errors": errors.get(kind, 0),
+            }
+            for kind, values in sorted(latencies.items())
+        },
+    }
+
+def print_report(title: str, report: dict) -> None:
+    print(f"\n== {title}: {report['updates']} updates in {report['seconds']:.2f}s ==")
+    print(f"updates/s: {report['updates_per_second']:.1f}   p50: {report['p50_ms']:.2f} ms   p99: {report['p99_ms']:.2f} ms   "
+          f"db queries/update: {report['db_queries_per_update']:.2f}   errors: {report['errors']}")
+    print(f"{'kind':<16}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'mean ms':>10}{'errors':>8}")
+    for kind, row in report["by_kind"].items():
+        print(f"{kind:<16}{row['count']:>8}{row['p50_ms']:>10.2f}{row['p99_ms']:>10.2f}{row['mean_ms']:>10.2f}{row['errors']:>8}")
+
+async def main(args: argparse.Namespace) -> None:
+    import bot as bot_module
+    import database
+    import events
+    import metrics
+    import provisioning
+    import queries
+    import ratelimit
+    import referrals
+    import scheduling
+    import xui_api
+    from config import bot, dp
+    from benchmarks.fakes import FakeCryptoPay, FakeLava, FakeSession, FakeXuiApi
+
+    session = FakeSession(LatencyModel(args.tg_latency))
+    bot.session = session
+    lava = FakeLava(LatencyModel(args.lava_latency))
+    bot_module.crypto = FakeCryptoPay(LatencyModel(args.crypto_latency))
+    emulators = await start_emulators(args) if args.emulators else None
+    if emulators is None:
+        xui_api.vpn_api = FakeXuiApi(LatencyModel(args.xui_latency))
+        bot_module.create_lava_invoice = lava.create_invoice
+        bot_module.check_lava_status = lava.check_status
+
+    counters = {"queries": 0}
+
+    def count_query(record) -> None:
+        counters["queries"] += 1
+
+    async def install_logger(conn) -> None:
+        conn.add_query_logger(count_query)
+
+    await database.init_db(init=install_logger)
+    async with database.db_pool.acquire() as conn:
+        await conn.execute("DELETE FROM pending_referral_rewards WHERE referrer_id >= $1", BENCH_ADMIN_ID)
+        await conn.execute("DELETE FROM pending_provisioning WHERE user_id >= $1", BENCH_ADMIN_ID)
+        await conn.execute("DELETE FROM users WHERE user_id >= $1", BENCH_ADMIN_ID)
+    await referrals.rewards.start()
+    await provisioning.queue.start()
+    await events.recorder.start()
+    if args.tg_rate:
+        ratelimit.limiter.interval = 1 / args.tg_rate
+        ratelimit.setup(bot)
+    metrics.setup(dp, bot)
+    scheduling.setup(dp)
+
+    rng = random.Random(args.seed)
+    factory = UpdateFactory(rng)
+    if emulators:
+        for n in range(20):
+            result = await bot_module.create_lava_invoice(amount=100.00, order_id=f"bench-{n}")
+            if result.get("data"): factory.lava_invoices.append(result["data"]["id"])
+    try:
+        await dp.feed_update(bot, factory.message(BENCH_ADMIN_ID, "/start"))
+        registration = [("start_ref", factory.registration()) for _ in range(args.users)]
+        print_report("registration", await replay(dp, bot, registration, args.concurrency, counters))
+
+        kinds = list(WORKLOAD)
+        weights = [WORKLOAD[kind] for kind in kinds]
+        mixed = []
+        for kind in rng.choices(kinds, weights, k=args.updates):
+            mixed.append((kind, factory.make(kind)))
+        report = await replay(dp, bot, mixed, args.concurrency, counters)
+        print_report("mixed workload", report)
+
+        api_calls = sum(session.calls.values())
+        print(f"\nBot API calls: {api_calls} ({api_calls / max(args.updates + args.users, 1):.2f}/update), CryptoPay calls: {bot_module.crypto.calls}")
+        if emulators:
+            xui, lava_emulator, _ = emulators
+            print(f"3x-ui emulator: {sum(xui.requests.values())} requests, {xui.failures} injected failures, {len(xui.clients)} clients")
+            print(f"Lava emulator: {sum(lava_emulator.requests.values())} requests, {lava_emulator.failures} injected failures")
+            print(f"X-UI circuit: {xui_api.breaker.state}, deferred grants pending: {len(provisioning.queue)}")
+        else:
+            print(f"X-UI calls: {xui_api.vpn_api.calls}, Lava calls: {lava.calls}")
+
+        print("\nTop queries by total time:")
+        for q in queries.top(10):
+            print(f"{q.name:<32} {q.calls:>6} calls {q.total * 1000:>9.1f} ms total {q.total / q.calls * 1000:>7.2f} ms avg")
+
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+    finally:
+        await referrals.rewards.stop()
+        await provisioning.queue.stop()
+        await events.recorder.stop()
+        async with database.db_pool.acquire() as conn:
+            await conn.execute("DELETE FROM pending_referral_rewards WHERE referrer_id >= $1", BENCH_ADMIN_ID)
+            await conn.execute("DELETE FROM pending_provisioning WHERE user_id >= $1", BENCH_ADMIN_ID)
+            await conn.execute("DELETE FROM open_invoices WHERE user_id >= $1", BENCH_ADMIN_ID)
+            await conn.execute("DELETE FROM users WHERE user_id >= $1", BENCH_ADMIN_ID)
+            await conn.execute("DELETE FROM events WHERE user_id >= $1", BENCH_ADMIN_ID)
+        await database.close_db()
+        if emulators:
+            for runner in emulators[2]: await runner.cleanup()
+
+async def start_emulators(args: argparse.Namespace):
+    import lava_pay
+    import xui_api
+    from benchmarks.emulators import LavaEmulator, XuiEmulator, fault_profile, start_app
+
+    xui = XuiEmulator(fault_profile(args, "xui"), inbound_id=1, username="bench", password="bench")
+    lava = LavaEmulator("bench-secret", fault_profile(args, "lava"))
+    runners = [await start_app(xui.app(), 0), await start_app(lava.app(), 0)]
+    xui_url, lava_url = (f"http://127.0.0.1:{runner.addresses[0][1]}" for runner in runners)
+
+    xui_api.PANEL_URL, xui_api.PANEL_USERNAME, xui_api.PANEL_PASSWORD, xui_api.INBOUND_ID = xui_url, "bench", "bench", 1
+    await xui_api.init_vpn_api()
+    lava_pay.LAVA_PROJECT_ID, lava_pay.LAVA_SECRET_KEY = "bench-shop", "bench-secret"
+    lava_pay.LAVA_CREATE_URL = f"{lava_url}/business/invoice/create"
+    lava_pay.LAVA_STATUS_URL = f"{lava_url}/business/invoice/status"
+    return xui, lava, runners
+
+if __name__ == "__main__":
+    args = parse_args()
+    os.environ["BOT_TOKEN"] = "123456:BENCHMARK"
+    os.environ["DATABASE_URL"] = args.dsn
+    os.environ["ADMIN_ID"] = str(BENCH_ADMIN_ID)
+    os.environ.setdefault("REFERRAL_COALESCE_SECONDS", "0.1")
+    import logging
+    logging.disable(logging.WARNING)
+    asyncio.run(main(args))
@@ -1,35 +1,63 @@
 import asyncio
 import os
 import random
-import string
-import uuid
+import tempfile
 import time
 from datetime import datetime, timedelta
 
-from aiocryptopay import AioCryptoPay, Networks
+from typing import TYPE_CHECKING
+
 from aiogram import F, types
 from aiogram.exceptions import TelegramBadRequest
-from aiogram.filters import CommandStart, CommandObject, StateFilter
+from aiogram.filters import Command, CommandStart, CommandObject, StateFilter
 from aiogram.fsm.context import FSMContext
-from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice, PreCheckoutQuery
+from aiogram.types import BufferedInputFile, FSInputFile, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice, PreCheckoutQuery
 
-from config import bot, dp, logger, ADMIN_ID, ADMIN_USERNAME, CHANNEL_ID, CHANNEL_2_ID
+from config import bot, dp, logger, ADMIN_ID, ADMIN_USERNAME, CHANNEL_ID, CHANNEL_2_ID, PORT, PROFILE_MAX_SECONDS, STARTUP_TIMEOUT, SHUTDOWN_TIMEOUT
 import database
+import queries
 import xui_api
+import user_cache
+import referrals
+import provisioning
+import metrics
+import profiler
+import scheduling
+import ratelimit
+import pruning
+import stats
+import events
+import adjustments
+import broadcasts
+import delivery
+import digests
+import invoices
 import keyboards as kb
 from states import AdminState, SupportState
 from utils import (
-    safe_message_answer, safe_message_edit_text, safe_bot_send_message,
-    safe_callback_answer, get_guide_text
+    safe_message_answer, safe_message_edit_text, safe_bot_send_message, safe_bot_edit_message_text,
+    safe_callback_answer, get_guide_text, PENDING_NOTE
 )
-from lava_pay import create_lava_invoice, check_lava_status
+from lava_pay import create_lava_invoice, check_lava_status, LAVA_INVOICE_EXPIRE
+
+
+if TYPE_CHECKING:
+    from aiocryptopay import AioCryptoPay
 
+crypto: "AioCryptoPay | None" = None
 
-crypto: AioCryptoPay | None = None
+def get_crypto() -> "AioCryptoPay | None":
+    """aiocryptopay тянет за собой полсотни pydantic-моделей — импортируем при первом платеже, а не на старте."""
+    global crypto
+    if crypto is None and os.getenv("CRYPTO_TOKEN"):
+        from aiocryptopay import AioCryptoPay, Networks
+        crypto = AioCryptoPay(token=os.getenv("CRYPTO_TOKEN"), network=Networks.MAIN_NET)
+    return crypto
+
+SUBSCRIPTION_DAYS = 30
+ALREADY_CREDITED_TEXT = "✅ <b>Этот платеж уже зачислен.</b>\nКлюч доступен в разделе «👤 Профиль»."
 
-def generate_custom_id() -> str:
-    chars = string.ascii_uppercase + string.digits
-    return "".join(random.choice(chars) for _ in range(9))
+EXPORT_COLUMNS = "user_id, username, custom_id, uuid, expiry_date, referrer_id, referral_count, last_bonus_claim, xui_state"
 
 async def check_sub(user_id: int) -> bool:
     channels_to_check = []
@@ -46,73 +74,27 @@ async def check_sub(user_id: int) -> bool:
             continue
     return True
 
-async def process_referral_reward(referrer_id: int) -> None:
-    logger.info(f"🎁 Начисляем награду рефереру {referrer_id}...")
-    if not database.db_pool: return
-
-    async with database.db_pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "UPDATE users SET referral_count = referral_count + 1 WHERE user_id = $1 RETURNING referral_count, expiry_date, uuid",
-            referrer_id,
-        )
-        if not row: return
-
-        count = row["referral_count"]
-        if count % 5 != 0: return
-
-        if row["expiry_date"] and row["expiry_date"] > datetime.now():
-            new_expiry = row["expiry_date"] + timedelta(days=3)
-        else:
-            new_expiry = datetime.now() + timedelta(days=3)
-
-        email = f"user_{referrer_id}"
-        expiry_ms = int(new_expiry.timestamp() * 1000)
-
-        if not row["uuid"]:
-            new_uuid = str(uuid.uuid4())
-            await xui_api.add_client_via_xui_api(new_uuid, email, limit_ip=1, expiry_time=expiry_ms)
-            await conn.execute("UPDATE users SET expiry_date=$1, uuid=$2 WHERE user_id=$3", new_expiry, new_uuid, referrer_id)
-            key = xui_api.generate_vless_link(new_uuid, email)
-            try:
-                await safe_bot_send_message(referrer_id, f"🎉 <b>Бонус (5 друзей)!</b>\nВаш ключ (+3 дня):\n<code>{key}</code>", parse_mode="HTML")
-            except: pass
-        else:
-            await conn.execute("UPDATE users SET expiry_date=$1 WHERE user_id=$2", new_expiry, referrer_id)
-            await xui_api.update_client_via_xui_api(row["uuid"], email, expiry_ms)
-            try:
-                await safe_bot_send_message(referrer_id, "🎉 <b>Бонус (5 друзей)!</b>\nВам добавлено 3 дня VPN!", parse_mode="HTML")
-            except: pass
-
 @dp.message(CommandStart())
 async def cmd_start(message: types.Message, command: CommandObject):
     if not database.db_pool: return
     user_id = message.from_user.id
     username = message.from_user.username
 
-    async with database.db_pool.acquire() as conn:
-        user = await conn.fetchrow("SELECT user_id FROM users WHERE user_id = $1", user_id)
-        if not user:
-            custom_id = generate_custom_id()
-            referrer_id: int | None = None
-            
-            if command.args:
-                ref_row = await conn.fetchrow("SELECT user_id FROM users WHERE custom_id = $1", command.args)
-                if ref_row:
-                    found_id = ref_row["user_id"]
-                    if found_id != user_id:
-                        referrer_id = found_id
-                elif command.args.isdigit() and int(command.args) != user_id:
-                    ref_check = await conn.fetchval("SELECT user_id FROM users WHERE user_id = $1", int(command.args))
-                    if ref_check: referrer_id = int(command.args)
-            
-            await conn.execute("INSERT INTO users (user_id, username, custom_id, referrer_id) VALUES ($1, $2, $3, $4)", user_id, username, custom_id, referrer_id)
-            if referrer_id:
-                asyncio.create_task(process_referral_reward(referrer_id))
-                try:
-                    await safe_bot_send_message(referrer_id, f"👤 <b>Новый реферал!</b>\n@{username if username else user_id}", parse_mode="HTML")
-                except: pass
+    user = user_cache.users.get(user_id)
+    if not user:
+        async with database.db_pool.acquire() as conn:
+            user, is_new = await user_cache.register_user(conn, user_id, username, command.args)
+        if is_new: events.emit("signup", user_id, referred=bool(user["referrer_id"]))
+        if is_new and user["referrer_id"]:
+            referrals.rewards.signed_up(user["referrer_id"])
+            digests.new_referrals.add(user["referrer_id"], f"@{username}" if username else str(user_id))
+    if user["unreachable_at"]:
+        async with database.db_pool.acquire() as conn:
+            await delivery.reactivate(conn, user_id)
 
+    events.emit("start", user_id)
     if not await check_sub(user_id):
+        events.emit("sub_required", user_id)
         return await safe_message_answer(message, "🔒 <b>Доступ закрыт!</b>\nДля работы с ботом подпишитесь на наши каналы:", reply_markup=kb.sub_kb(), parse_mode="HTML")
 
     await safe_message_answer(message, "👋 <b>Добро пожаловать в VPN Shop!</b>", reply_markup=kb.main_menu_kb(user_id), parse_mode="HTML")
@@ -198,8 +180,7 @@ async def profile_handler(callback: types.CallbackQuery):
     if not await check_sub(callback.from_user.id): return await safe_message_answer(callback.message, "🔒 Подпишитесь:", reply_markup=kb.sub_kb())
 
     user_id = callback.from_user.id
-    async with database.db_pool.acquire() as conn:
-        user = await conn.fetchrow("SELECT * FROM users WHERE user_id=$1", user_id)
+    user = await user_cache.get_user(user_id)
 
     if not user: return await safe_callback_answer(callback, "Ошибка данных", show_alert=True)
 
@@ -240,45 +221,39 @@ async def get_daily_bonus(callback: types.CallbackQuery):
         return await safe_message_answer(callback.message, "🔒 Для бонуса нужно подписаться:", reply_markup=kb.sub_kb())
 
     user_id = callback.from_user.id
-    async with database.db_pool.acquire() as conn:
-        user = await conn.fetchrow("SELECT last_bonus_claim, expiry_date, uuid FROM users WHERE user_id = $1", user_id)
-        
-        if user and user["last_bonus_claim"]:
-            if user["last_bonus_claim"] + timedelta(days=1) > datetime.now():
-                next_claim = user["last_bonus_claim"] + timedelta(days=1)
-                time_left = next_claim - datetime.now()
-                hours = int(time_left.total_seconds() // 3600)
-                minutes = int((time_left.total_seconds() % 3600) // 60)
-                return await safe_callback_answer(callback, f"⏳ Бонус доступен раз в 24 часа.\nЖдать: {hours} ч. {minutes} мин.", show_alert=True)
-
-        chance = random.randint(1, 100)
-        if chance <= 90: hours_reward = random.randint(1, 12)
-        elif chance <= 99: hours_reward = random.randint(13, 24)
-        else: hours_reward = random.randint(25, 72)
-
-        if user["expiry_date"] and user["expiry_date"] > datetime.now():
-            new_expiry = user["expiry_date"] + timedelta(hours=hours_reward)
-        else:
-            new_expiry = datetime.now() + timedelta(hours=hours_reward)
-            
-        expiry_ms = int(new_expiry.timestamp() * 1000)
-        email = f"user_{user_id}"
+    user = await user_cache.get_user(user_id)
+    if not user: return
 
-        try:
-            if user["uuid"]:
-                await xui_api.update_client_via_xui_api(user["uuid"], email, expiry_ms)
-                final_uuid = user["uuid"]
-            else:
-                new_uuid = str(uuid.uuid4())
-                await xui_api.add_client_via_xui_api(new_uuid, email, limit_ip=1, expiry_time=expiry_ms)
-                final_uuid = new_uuid
-                await conn.execute("UPDATE users SET uuid=$1 WHERE user_id=$2", final_uuid, user_id)
-            
-            await conn.execute("UPDATE users SET expiry_date=$1, last_bonus_claim=$2 WHERE user_id=$3", new_expiry, datetime.now(), user_id)
+    if user["last_bonus_claim"]:
+        if user["last_bonus_claim"] + timedelta(days=1) > datetime.now():
+            next_claim = user["last_bonus_claim"] + timedelta(days=1)
+            time_left = next_claim - datetime.now()
+            hours = int(time_left.total_seconds() // 3600)
+            minutes = int((time_left.total_seconds() % 3600) // 60)
+            return await safe_callback_answer(callback, f"⏳ Бонус доступен раз в 24 часа.\nЖдать: {hours} ч. {minutes} мин.", show_alert=True)
 
-        except Exception as e:
-            logger.error(f"Bonus error: {e}")
-            return await safe_callback_answer(callback, "❌ Ошибка сервера, попробуйте позже", show_alert=True)
+    chance = random.randint(1, 100)
+    if chance <= 90: hours_reward = random.randint(1, 12)
+    elif chance <= 99: hours_reward = random.randint(13, 24)
+    else: hours_reward = random.randint(25, 72)
+
+    email = f"user_{user_id}"
+
+    try:
+        async with database.db_pool.acquire() as conn:
+            row = await queries.CLAIM_BONUS.fetchrow(conn, user_id, hours_reward)
+            if row:
+                user_cache.users.put(row)
+                await stats.bump(conn, bonus_claims=1)
+                grant = await provisioning.prepare(conn, row)
+        if not row: return await safe_callback_answer(callback, "⏳ Бонус доступен раз в 24 часа.", show_alert=True)
+        events.emit("bonus", user_id, hours=hours_reward)
+        provisioned = await provisioning.push(grant)
+        final_uuid = grant.uuid
+
+    except Exception as e:
+        logger.error(f"Bonus error: {e}")
+        return await safe_callback_answer(callback, "❌ Ошибка сервера, попробуйте позже", show_alert=True)
 
     if hours_reward >= 24:
         days = hours_reward // 24
@@ -297,12 +272,14 @@ async def get_daily_bonus(callback: types.CallbackQuery):
         f"🔑 <b>Ваш ключ доступа:</b>\n"
         f"<tg-spoiler><code>{key_link}</code></tg-spoiler>\n\n"
         f"<i>Следующий бонус через 24 часа.</i>"
+        f"{'' if provisioned else PENDING_NOTE}"
     )
     await safe_message_answer(callback.message, guide_text, reply_markup=kb.back_kb(), parse_mode="HTML")
 
 @dp.callback_query(F.data == "check_sub_btn")
 async def check_sub_btn(callback: types.CallbackQuery):
     if await check_sub(callback.from_user.id):
+        events.emit("subscribed", callback.from_user.id)
         await callback.message.delete()
         await safe_message_answer(callback.message, "👋 <b>Спасибо! Доступ открыт.</b>", reply_markup=kb.main_menu_kb(callback.from_user.id), parse_mode="HTML")
     else:
@@ -318,46 +295,11 @@ async def cb_start(callback: types.CallbackQuery, state: FSMContext):
     except:
         await safe_message_answer(callback.message, "👋 Главное меню", reply_markup=kb.main_menu_kb(callback.from_user.id))
 
-@dp.message(CommandStart())
-async def cmd_start(message: types.Message, command: CommandObject):
-    if not database.db_pool: return
-    user_id = message.from_user.id
-    username = message.from_user.username
-
-    async with database.db_pool.acquire() as conn:
-        user = await conn.fetchrow("SELECT user_id FROM users WHERE user_id = $1", user_id)
-        if not user:
-            custom_id = generate_custom_id()
-            referrer_id: int | None = None
-            
-            if command.args:
-                ref_row = await conn.fetchrow("SELECT user_id FROM users WHERE custom_id = $1", command.args)
-                if ref_row:
-                    found_id = ref_row["user_id"]
-                    if found_id != user_id:
-                        referrer_id = found_id
-                elif command.args.isdigit() and int(command.args) != user_id:
-                    ref_check = await conn.fetchval("SELECT user_id FROM users WHERE user_id = $1", int(command.args))
-                    if ref_check: referrer_id = int(command.args)
-            
-            await conn.execute("INSERT INTO users (user_id, username, custom_id, referrer_id) VALUES ($1, $2, $3, $4)", user_id, username, custom_id, referrer_id)
-            if referrer_id:
-                asyncio.create_task(process_referral_reward(referrer_id))
-                try:
-                    await safe_bot_send_message(referrer_id, f"👤 <b>Новый реферал!</b>\n@{username if username else user_id}", parse_mode="HTML")
-                except: pass
-
-    if not await check_sub(user_id):
-        return await safe_message_answer(message, "🔒 <b>Доступ закрыт!</b>\nДля работы с ботом подпишитесь на наши каналы:", reply_markup=kb.sub_kb(), parse_mode="HTML")
-
-    await safe_message_answer(message, "👋 <b>Добро пожаловать в VPN Shop!</b>", reply_markup=kb.main_menu_kb(user_id), parse_mode="HTML")
-
 @dp.callback_query(F.data == "show_key")
 async def show_key_handler(callback: types.CallbackQuery):
     if not database.db_pool: return
     user_id = callback.from_user.id
-    async with database.db_pool.acquire() as conn:
-        user = await conn.fetchrow("SELECT uuid, expiry_date FROM users WHERE user_id=$1", user_id)
+    user = await user_cache.get_user(user_id)
 
     if not user or not user["uuid"]:
         return await safe_callback_answer(callback, "❌ У вас нет активного ключа", show_alert=True)
@@ -388,6 +330,7 @@ async def create_invoice(callback: types.CallbackQuery):
             )
         return
 
+    events.emit("buy_menu", callback.from_user.id)
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="💳 Картой РФ (100₽)", callback_data="pay_lava")],
         [InlineKeyboardButton(text="⭐️ Оплатить Звездами (100 ⭐️)", callback_data="pay_stars")], 
@@ -423,24 +366,31 @@ async def create_invoice(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "pay_lava")
 async def pay_lava_handler(callback: types.CallbackQuery):
     if not database.db_pool: return
-    
-    short_time = int(time.time()) % 1000000
-    order_id = f"{callback.from_user.id}-{short_time}"
+    user_id = callback.from_user.id
+    events.emit("payment_method", user_id, method="lava")
+
+    invoice = invoices.registry.get(user_id, "lava", 100.00)
+    if invoice:
+        url, invoice_id, order_id = invoice.url, invoice.invoice_id, invoice.order_id
+    else:
+        short_time = int(time.time()) % 1000000
+        order_id = f"{user_id}-{short_time}"
 
-    result = await create_lava_invoice(amount=100.00, order_id=order_id)
+        result = await create_lava_invoice(amount=100.00, order_id=order_id)
 
-    if not result or result.get("status") == "error":
-        logger.error(f"Lava Error: {result}")
-        msg = result.get("message", "Ошибка")
-        return await safe_callback_answer(callback, f"❌ Ошибка Lava: {msg}", show_alert=True)
+        if not result or result.get("status") == "error":
+            logger.error(f"Lava Error: {result}")
+            msg = result.get("message", "Ошибка")
+            return await safe_callback_answer(callback, f"❌ Ошибка Lava: {msg}", show_alert=True)
 
-    data_obj = result.get("data")
-    if not data_obj:
-        logger.error(f"Lava No Data: {result}")
-        return await safe_callback_answer(callback, "❌ Ошибка получения ссылки.", show_alert=True)
+        data_obj = result.get("data")
+        if not data_obj:
+            logger.error(f"Lava No Data: {result}")
+            return await safe_callback_answer(callback, "❌ Ошибка получения ссылки.", show_alert=True)
 
-    url = data_obj["url"]
-    invoice_id = data_obj["id"]
+        url = data_obj["url"]
+        invoice_id = data_obj["id"]
+        await invoices.registry.remember(user_id, "lava", 100.00, invoice_id, url, timedelta(minutes=LAVA_INVOICE_EXPIRE), order_id=order_id)
 
     check_data = f"L_{invoice_id}_{order_id}"
     
@@ -492,52 +442,45 @@ async def check_lava_handler(callback: types.CallbackQuery):
 
         user_id = callback.from_user.id
         async with database.db_pool.acquire() as conn:
-            row = await conn.fetchrow(
-                """UPDATE users 
-                   SET expiry_date = GREATEST(expiry_date, NOW()) + INTERVAL '30 days',
-                       expired_notification_sent = FALSE
-                   WHERE user_id = $1
-                   RETURNING uuid, expiry_date""",
-                user_id,
-            )
-            
+            row = await queries.CREDIT_PAYMENT.fetchrow(conn, user_id, SUBSCRIPTION_DAYS, "lava", invoice_id)
             if row:
-                expiry_ms = int(row["expiry_date"].timestamp() * 1000)
-                email = f"user_{user_id}"
-                
-                if row["uuid"]:
-                    try:
-                        await xui_api.update_client_via_xui_api(row["uuid"], email, expiry_ms)
-                    except: pass
-                    key = xui_api.generate_vless_link(row["uuid"], email)
-                else:
-                    new_uuid = str(uuid.uuid4())
-                    try:
-                        await xui_api.add_client_via_xui_api(new_uuid, email, limit_ip=1, expiry_time=expiry_ms)
-                        await conn.execute("UPDATE users SET uuid = $1 WHERE user_id = $2", new_uuid, user_id)
-                    except: pass
-                    key = xui_api.generate_vless_link(new_uuid, email)
-                
-                await safe_message_edit_text(
-                    callback.message,
-                    get_guide_text(key),
-                    reply_markup=kb.back_kb(),
-                    parse_mode="HTML",
-                    disable_web_page_preview=True
-                )
-            else:
-                 await safe_callback_answer(callback, "❌ Ошибка базы данных.", show_alert=True)
+                user_cache.users.put(row)
+                await stats.bump(conn, payments=1)
+                await invoices.registry.close(user_id, "lava", invoice_id, conn)
+                grant = await provisioning.prepare(conn, row)
+
+        if row:
+            events.emit("paid", user_id, method="lava")
+            provisioned = await provisioning.push(grant)
+            key = xui_api.generate_vless_link(grant.uuid, f"user_{user_id}")
+
+            await safe_message_edit_text(
+                callback.message,
+                get_guide_text(key, pending=not provisioned),
+                reply_markup=kb.back_kb(),
+                parse_mode="HTML",
+                disable_web_page_preview=True
+            )
+        else:
+            await safe_message_edit_text(callback.message, ALREADY_CREDITED_TEXT, reply_markup=kb.back_kb(), parse_mode="HTML")
     else:
         logger.info(f"Check status failed: {result}")
         await safe_callback_answer(callback, "⏳ Оплата еще не поступила. Попробуйте через минуту.", show_alert=True)
 
 @dp.callback_query(F.data == "pay_crypto")
 async def create_crypto_invoice(callback: types.CallbackQuery):
+    crypto = get_crypto()
     if not crypto: return
+    user_id = callback.from_user.id
+    events.emit("payment_method", user_id, method="crypto")
     try:
-        invoice = await crypto.create_invoice(amount=1.00, fiat="USD", currency_type="fiat", accepted_assets="USDT,TON,BTC,LTC", description="VPN (30 days)", expires_in=600)
+        invoice = invoices.registry.get(user_id, "crypto", 1.00)
+        if not invoice:
+            async with metrics.track("cryptopay", "create_invoice"):
+                created = await crypto.create_invoice(amount=1.00, fiat="USD", currency_type="fiat", accepted_assets="USDT,TON,BTC,LTC", description="VPN (30 days)", expires_in=600)
+            invoice = await invoices.registry.remember(user_id, "crypto", 1.00, created.invoice_id, created.bot_invoice_url, timedelta(seconds=600))
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔗 Выбрать валюту и оплатить", url=invoice.bot_invoice_url)],
+            [InlineKeyboardButton(text="🔗 Выбрать валюту и оплатить", url=invoice.url)],
             [InlineKeyboardButton(text="🔄 Проверить оплату", callback_data=f"check_{invoice.invoice_id}")],
             [InlineKeyboardButton(text="🔙 Назад", callback_data="start")]
         ])
@@ -556,6 +499,7 @@ async def create_crypto_invoice(callback: types.CallbackQuery):
 
 @dp.callback_query(F.data == "pay_stars")
 async def send_stars_invoice(callback: types.CallbackQuery):
+    events.emit("payment_method", callback.from_user.id, method="stars")
     await callback.message.delete()
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -584,31 +528,31 @@ async def success_payment_handler(message: types.Message):
     user_id = message.from_user.id
     if not database.db_pool: return
 
+    charge_id = message.successful_payment.telegram_payment_charge_id
     async with database.db_pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "UPDATE users SET expiry_date = GREATEST(expiry_date, NOW()) + INTERVAL '30 days', expired_notification_sent = FALSE WHERE user_id = $1 RETURNING uuid, expiry_date", 
-            user_id
-        )
-        expiry_ms = int(row["expiry_date"].timestamp() * 1000)
-        email = f"user_{user_id}"
-
-        if row["uuid"]:
-            await xui_api.update_client_via_xui_api(row["uuid"], email, expiry_ms)
-            key = xui_api.generate_vless_link(row["uuid"], email)
-        else:
-            new_uuid = str(uuid.uuid4())
-            await xui_api.add_client_via_xui_api(new_uuid, email, limit_ip=1, expiry_time=expiry_ms)
-            await conn.execute("UPDATE users SET uuid = $1 WHERE user_id = $2", new_uuid, user_id)
-            key = xui_api.generate_vless_link(new_uuid, email)
+        row = await queries.CREDIT_PAYMENT.fetchrow(conn, user_id, SUBSCRIPTION_DAYS, "stars", charge_id)
+        if row:
+            user_cache.users.put(row)
+            await stats.bump(conn, payments=1)
+            grant = await provisioning.prepare(conn, row)
+    if not row:
+        # тот же платеж пришел повторно (апдейт переотправлен после рестарта) — уже зачислен
+        logger.warning(f"⭐️ Платеж {charge_id} от {user_id} уже зачислен, пропускаем")
+        return
+    events.emit("paid", user_id, method="stars")
+    provisioned = await provisioning.push(grant)
+    key = xui_api.generate_vless_link(grant.uuid, f"user_{user_id}")
 
-    await safe_message_answer(message, get_guide_text(key), reply_markup=kb.back_kb(), parse_mode="HTML", disable_web_page_preview=True)
+    await safe_message_answer(message, get_guide_text(key, pending=not provisioned), reply_markup=kb.back_kb(), parse_mode="HTML", disable_web_page_preview=True)
 
 @dp.callback_query(F.data.startswith("check_"))
 async def check_invoice(callback: types.CallbackQuery):
+    crypto = get_crypto()
     if not crypto: return
     inv_id = int(callback.data.split("_")[1])
     try:
-        invs = await crypto.get_invoices(invoice_ids=inv_id)
+        async with metrics.track("cryptopay", "get_invoices"):
+            invs = await crypto.get_invoices(invoice_ids=inv_id)
         invoice = invs[0] if isinstance(invs, list) else invs
     except: return await safe_callback_answer(callback, "❌ Ошибка проверки", show_alert=True)
 
@@ -616,27 +560,24 @@ async def check_invoice(callback: types.CallbackQuery):
         await safe_callback_answer(callback, "✅ Оплата получена! Генерируем ключ...", show_alert=True)
         user_id = callback.from_user.id
         async with database.db_pool.acquire() as conn:
-             row = await conn.fetchrow(
-                "UPDATE users SET expiry_date = GREATEST(expiry_date, NOW()) + INTERVAL '30 days', expired_notification_sent = FALSE WHERE user_id = $1 RETURNING uuid, expiry_date", 
-                user_id
-            )
-             expiry_ms = int(row["expiry_date"].timestamp() * 1000)
-             email = f"user_{user_id}"
-             
-             if row["uuid"]:
-                await xui_api.update_client_via_xui_api(row["uuid"], email, expiry_ms)
-                key = xui_api.generate_vless_link(row["uuid"], email)
-             else:
-                new_uuid = str(uuid.uuid4())
-                await xui_api.add_client_via_xui_api(new_uuid, email, limit_ip=1, expiry_time=expiry_ms)
-                await conn.execute("UPDATE users SET uuid = $1 WHERE user_id = $2", new_uuid, user_id)
-                key = xui_api.generate_vless_link(new_uuid, email)
+             row = await queries.CREDIT_PAYMENT.fetchrow(conn, user_id, SUBSCRIPTION_DAYS, "crypto", str(inv_id))
+             await invoices.registry.close(user_id, "crypto", inv_id, conn)
+             if row:
+                 user_cache.users.put(row)
+                 await stats.bump(conn, payments=1)
+                 grant = await provisioning.prepare(conn, row)
+        if not row:
+            return await safe_message_edit_text(callback.message, ALREADY_CREDITED_TEXT, reply_markup=kb.back_kb(), parse_mode="HTML")
+        events.emit("paid", user_id, method="crypto")
+        provisioned = await provisioning.push(grant)
+        key = xui_api.generate_vless_link(grant.uuid, f"user_{user_id}")
         
-        await safe_message_edit_text(callback.message, get_guide_text(key), reply_markup=kb.back_kb(), parse_mode="HTML", disable_web_page_preview=True)
+        await safe_message_edit_text(callback.message, get_guide_text(key, pending=not provisioned), reply_markup=kb.back_kb(), parse_mode="HTML", disable_web_page_preview=True)
         
     elif invoice.status == "active":
         await safe_callback_answer(callback, "⏳ Оплата еще не поступила", show_alert=True)
     else:
+        await invoices.registry.close(callback.from_user.id, "crypto", inv_id)
         await safe_message_edit_text(callback.message, "❌ Счет истек.", reply_markup=kb.back_kb())
 
 
@@ -648,19 +589,18 @@ async def support_start(callback: types.CallbackQuery, state: FSMContext):
 
     user_id = callback.from_user.id
 
-    async with database.db_pool.acquire() as conn:
-        user = await conn.fetchrow("SELECT last_support_time FROM users WHERE user_id = $1", user_id)
-        if user and user["last_support_time"]:
-            last_time = user["last_support_time"].replace(tzinfo=None)
-            minutes_passed = (datetime.utcnow() - last_time).total_seconds() / 60
-            
-            if minutes_passed < 60:
-                minutes_left = int(60 - minutes_passed)
-                return await safe_callback_answer(
-                    callback,
-                    f"⏳ Писать в поддержку можно раз в час.\nПодождите еще {minutes_left} мин.",
-                    show_alert=True
-                )
+    user = await user_cache.get_user(user_id)
+    if user and user["last_support_time"]:
+        last_time = user["last_support_time"].replace(tzinfo=None)
+        minutes_passed = (datetime.utcnow() - last_time).total_seconds() / 60
+        
+        if minutes_passed < 60:
+            minutes_left = int(60 - minutes_passed)
+            return await safe_callback_answer(
+                callback,
+                f"⏳ Писать в поддержку можно раз в час.\nПодождите еще {minutes_left} мин.",
+                show_alert=True
+            )
 
     await safe_message_edit_text(
         callback.message,
@@ -678,14 +618,13 @@ async def support_receive_msg(message: types.Message, state: FSMContext):
 
     user_id = message.from_user.id
     
-    async with database.db_pool.acquire() as conn:
-        user = await conn.fetchrow("SELECT last_support_time FROM users WHERE user_id = $1", user_id)
-        if user and user["last_support_time"]:
-            last_time = user["last_support_time"].replace(tzinfo=None)
-            if (datetime.utcnow() - last_time).total_seconds() < 3600:
-                await safe_message_answer(message, "⏳ Прошел меньше часа с прошлого обращения.")
-                await state.clear()
-                return
+    user = await user_cache.get_user(user_id)
+    if user and user["last_support_time"]:
+        last_time = user["last_support_time"].replace(tzinfo=None)
+        if (datetime.utcnow() - last_time).total_seconds() < 3600:
+            await safe_message_answer(message, "⏳ Прошел меньше часа с прошлого обращения.")
+            await state.clear()
+            return
 
     if not ADMIN_ID:
         await safe_message_answer(message, "❌ Поддержка не настроена.")
@@ -693,15 +632,11 @@ async def support_receive_msg(message: types.Message, state: FSMContext):
         return
 
     try:
-        await safe_bot_send_message(
-            ADMIN_ID, 
-            f"📩 <b>Тикет</b>\nОт: @{message.from_user.username} (ID: <code>{message.from_user.id}</code>)\n\n{message.text}", 
-            reply_markup=kb.admin_ticket_kb(message.from_user.id),
-            parse_mode="HTML"
-        )
-
         async with database.db_pool.acquire() as conn:
-            await conn.execute("UPDATE users SET last_support_time = $1 WHERE user_id = $2", datetime.utcnow(), user_id)
+            ticket = await digests.save_ticket(conn, user_id, message.from_user.username, message.text or "")
+            row = await queries.SET_SUPPORT_TIME.fetchrow(conn, user_id, datetime.utcnow())
+            if row: user_cache.users.put(row)
+        digests.support_tickets.add(ADMIN_ID, ticket)
 
         await safe_message_answer(message, "✅ <b>Отправлено!</b> Администратор ответит вам в ближайшее время.", reply_markup=kb.back_kb(), parse_mode="HTML")
     except: 
@@ -738,8 +673,10 @@ async def admin_panel_open(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
     
     kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
         [InlineKeyboardButton(text="👥 Управление пользователями", callback_data="admin_users_list")],
         [InlineKeyboardButton(text="📢 Создать объявление", callback_data="admin_create_announce")],
+        [InlineKeyboardButton(text="🎁 Начислить дни всем", callback_data="admin_bulk")],
         [InlineKeyboardButton(text="🔙 В главное меню", callback_data="start")]
     ])
 
@@ -751,6 +688,101 @@ async def admin_panel_open(callback: types.CallbackQuery, state: FSMContext):
     )
 
 
+@dp.callback_query(F.data == "admin_stats")
+async def admin_stats(callback: types.CallbackQuery):
+    if callback.from_user.id != ADMIN_ID: return
+    if not database.db_pool: return
+    kb_stats = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_stats")],
+        [InlineKeyboardButton(text="🔙 В админ панель", callback_data="admin_panel")]
+    ])
+    try:
+        await safe_message_edit_text(callback.message, await stats.snapshot.render(), reply_markup=kb_stats, parse_mode="HTML")
+    except TelegramBadRequest: pass
+    await safe_callback_answer(callback)
+
+@dp.callback_query(F.data == "admin_bulk")
+async def admin_bulk_start(callback: types.CallbackQuery):
+    if callback.from_user.id != ADMIN_ID: return
+    await safe_message_edit_text(
+        callback.message,
+        "🎁 <b>Массовое начисление</b>\n\nКому начислить дни?",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🟢 Активным подпискам", callback_data="admin_bulk_seg_active")],
+            [InlineKeyboardButton(text="👥 Всем пользователям", callback_data="admin_bulk_seg_all")],
+            [InlineKeyboardButton(text="🔙 Отмена", callback_data="admin_panel")]
+        ]),
+        parse_mode="HTML"
+    )
+
+@dp.callback_query(F.data.startswith("admin_bulk_seg_"))
+async def admin_bulk_segment(callback: types.CallbackQuery, state: FSMContext):
+    if callback.from_user.id != ADMIN_ID: return
+    segment = callback.data.removeprefix("admin_bulk_seg_")
+    if segment not in adjustments.SEGMENTS: return
+    await state.update_data(bulk_segment=segment, bulk_msg_id=callback.message.message_id)
+    await safe_message_edit_text(
+        callback.message,
+        f"🎁 <b>Массовое начисление</b> ({adjustments.SEGMENTS[segment][0]})\n\nОтправьте число дней, например `3`.",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🔙 Отмена", callback_data="admin_panel")]]),
+        parse_mode="HTML"
+    )
+    await state.set_state(AdminState.waiting_for_bulk_days)
+
+@dp.message(StateFilter(AdminState.waiting_for_bulk_days))
+async def admin_bulk_apply(message: types.Message, state: FSMContext):
+    if message.from_user.id != ADMIN_ID: return
+    try: await message.delete()
+    except: pass
+    if not database.db_pool: await state.clear(); return
+    data = await state.get_data()
+    try: days = int(message.text)
+    except (TypeError, ValueError): days = 0
+    if days <= 0:
+        # состояние оставляем: следующее сообщение — новая попытка, «Отмена» его сбрасывает
+        segment = data["bulk_segment"]
+        try:
+            await safe_bot_edit_message_text(
+                message.chat.id, data["bulk_msg_id"],
+                f"🎁 <b>Массовое начисление</b> ({adjustments.SEGMENTS[segment][0]})\n\n"
+                f"❌ Нужно целое число дней больше нуля. Отправьте его еще раз, например `3`.",
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🔙 Отмена", callback_data="admin_panel")]]),
+                parse_mode="HTML"
+            )
+        except Exception:
+            await safe_message_answer(message, "❌ Нужно целое число дней больше нуля.")
+        return
+    await state.clear()
+    await adjustments.adjustments.create(data["bulk_segment"], days, message.chat.id, data["bulk_msg_id"])
+
+@dp.message(Command("profile"))
+async def admin_profile(message: types.Message, command: CommandObject):
+    if message.from_user.id != ADMIN_ID: return
+    if profiler.is_profiling():
+        return await safe_message_answer(message, "⏳ Профилирование уже запущено.")
+
+    seconds = int(command.args) if command.args and command.args.isdigit() else 30
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    await safe_message_answer(message, f"🔬 Снимаю профиль {seconds} с...")
+
+    data = await profiler.profile(seconds)
+    filename = f"profile-{datetime.now():%Y%m%d-%H%M%S}.collapsed"
+    await message.answer_document(
+        BufferedInputFile(data, filename=filename),
+        caption="Collapsed stacks: flamegraph.pl или speedscope.app",
+    )
+
+@dp.message(Command("queries"))
+async def admin_queries(message: types.Message):
+    if message.from_user.id != ADMIN_ID: return
+    top = queries.top(15)
+    if not top: return await safe_message_answer(message, "Запросов к базе еще не было.")
+    lines = ["🗄 <b>Запросы к базе</b> (с момента старта, по суммарному времени)\n", "<code>Всего,с  Вызовов  Сред,мс  Запрос</code>"]
+    for q in top:
+        lines.append(f"<code>{q.total:>7.2f} {q.calls:>8} {q.total / q.calls * 1000:>8.1f}  {q.name}</code>" + (f" ❌{q.errors}" if q.errors else ""))
+    await safe_message_answer(message, "\n".join(lines), parse_mode="HTML")
+
+
 @dp.callback_query(F.data == "admin_create_announce")
 async def ask_announcement_text(callback: types.CallbackQuery, state: FSMContext):
     if callback.from_user.id != ADMIN_ID: return
@@ -785,10 +817,9 @@ async def broadcast_announcement(message: types.Message, state: FSMContext):
   
     try:
         if menu_msg_id:
-            await bot.edit_message_text(
+            await safe_bot_edit_message_text(
+                message.chat.id, menu_msg_id,
                 "⏳ <b>Рассылка запущена...</b>\nЭто может занять некоторое время.",
-                chat_id=message.chat.id,
-                message_id=menu_msg_id,
                 parse_mode="HTML"
             )
         else:
@@ -803,51 +834,8 @@ async def broadcast_announcement(message: types.Message, state: FSMContext):
         await state.clear()
         return
 
-    count_success = 0
-    count_blocked = 0
-
-    async with database.db_pool.acquire() as conn:
-        users = await conn.fetch("SELECT user_id FROM users")
-        
-    for row in users:
-        user_id = row['user_id']
-        try:
-           
-            await message.send_copy(chat_id=user_id)
-            count_success += 1
-        except Exception:
-            count_blocked += 1
-        
-        await asyncio.sleep(0.05)
-
-  
-    try:
-        await message.delete()
-    except Exception:
-        pass
-
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔙 В админ панель", callback_data="admin_panel")]
-    ])
-    
-    result_text = (
-        f"✅ <b>Объявление разослано!</b>\n\n"
-        f"📨 Получили: {count_success}\n"
-        f"🚫 Заблокировали бота: {count_blocked}"
-    )
-
-    try:
-        await bot.edit_message_text(
-            result_text,
-            chat_id=message.chat.id,
-            message_id=menu_msg_id,
-            reply_markup=kb,
-            parse_mode="HTML"
-        )
-    except Exception:
-       
-        await message.answer(result_text, reply_markup=kb, parse_mode="HTML")
-        
+    # рассылка идет фоном и переживает рестарт бота, итог придет в это же меню
+    await broadcasts.broadcasts.create(message.chat.id, message.message_id, menu_msg_id)
     await state.clear()
 
 @dp.callback_query(F.data == "admin_users_list")
@@ -857,29 +845,20 @@ async def admin_users_list(callback: types.CallbackQuery, state: FSMContext):
     await state.update_data(admin_search_query=None, admin_filter_active=False)
     await show_user_page(callback.message, state, page=0, is_edit=True)
 
-async def show_user_page(message_obj: types.Message, state: FSMContext, page: int, is_edit: bool = False, message_id_to_edit: int = None):
+def admin_users_filter(search_query: str | None, filter_active: bool) -> list:
+    """Параметры для queries.ADMIN_USERS_WHERE."""
+    return [datetime.now() if filter_active else None, search_query or None]
+
+async def show_user_page(message_obj: types.Message, state: FSMContext, page: int, is_edit: bool = False, message_id_to_edit: int = None, fresh: bool = False):
     if not database.db_pool: return
     data = await state.get_data()
     search_query = data.get("admin_search_query")
     filter_active = data.get("admin_filter_active", False)
 
-    where = []
-    params = []
-    idx = 1
-
-    if filter_active: 
-        where.append(f"expiry_date > ${idx}")
-        params.append(datetime.now())
-        idx += 1
-
-    if search_query:
-        where.append(f"(username ILIKE ${idx} OR CAST(user_id AS TEXT) = ${idx} OR custom_id = ${idx})")
-        params.append(search_query)
-        idx += 1
-
-    where_sql = " WHERE " + " AND ".join(where) if where else ""
-    async with database.db_pool.acquire() as conn:
-        total = await conn.fetchval(f"SELECT COUNT(*) FROM users{where_sql}", *params)
+    params = admin_users_filter(search_query, filter_active)
+    # fresh — сразу после правки дней/рефералов: с реплики админ увидел бы старое значение
+    async with (database.db_pool if fresh else database.read_pool()).acquire() as conn:
+        total = await queries.ADMIN_USERS_COUNT.fetchval(conn, *params)
 
         if total == 0:
              text = f"🛠 <b>Админ панель</b>\nСтатус: {'🔍 Поиск: ' + search_query if search_query else 'Все'}\n\n🤷‍♂️ <b>Пользователей не найдено.</b>"
@@ -890,7 +869,7 @@ async def show_user_page(message_obj: types.Message, state: FSMContext, page: in
 
              if message_id_to_edit:
                 try:
-                    await bot.edit_message_text(text=text, chat_id=message_obj.chat.id, message_id=message_id_to_edit, reply_markup=markup, parse_mode="HTML")
+                    await safe_bot_edit_message_text(message_obj.chat.id, message_id_to_edit, text, reply_markup=markup, parse_mode="HTML")
                     return
                 except: pass
 
@@ -898,8 +877,7 @@ async def show_user_page(message_obj: types.Message, state: FSMContext, page: in
              else: await safe_message_answer(message_obj, text, reply_markup=markup, parse_mode="HTML")
              return
 
-        params.append(page)
-        user = await conn.fetchrow(f"SELECT user_id, custom_id, username, referral_count, expiry_date, uuid FROM users{where_sql} ORDER BY user_id LIMIT 1 OFFSET ${idx}", *params)
+        user = await queries.ADMIN_USERS_PAGE.fetchrow(conn, *params, page)
 
     status_str = "🔘 Все"
     if filter_active: status_str = "🟢 Активные"
@@ -937,13 +915,14 @@ async def show_user_page(message_obj: types.Message, state: FSMContext, page: in
     search_btn = "🔍 Поиск по @username / ID" if not search_query else "❌ Сбросить поиск"
     search_cb = "admin_search_start" if not search_query else "admin_reset_filters"
     rows.append([InlineKeyboardButton(text=search_btn, callback_data=search_cb)])
+    rows.append([InlineKeyboardButton(text="📥 Выгрузить в CSV", callback_data="admin_export")])
     rows.append([InlineKeyboardButton(text="🔙 Назад в меню", callback_data="admin_panel")])
 
     markup = InlineKeyboardMarkup(inline_keyboard=rows)
 
     if message_id_to_edit:
         try:
-            await bot.edit_message_text(text=text, chat_id=message_obj.chat.id, message_id=message_id_to_edit, reply_markup=markup, parse_mode="HTML")
+            await safe_bot_edit_message_text(message_obj.chat.id, message_id_to_edit, text, reply_markup=markup, parse_mode="HTML")
             return
         except Exception:
             pass
@@ -951,6 +930,40 @@ async def show_user_page(message_obj: types.Message, state: FSMContext, page: in
     if is_edit: await safe_message_edit_text(message_obj, text, reply_markup=markup, parse_mode="HTML")
     else: await safe_message_answer(message_obj, text, reply_markup=markup, parse_mode="HTML")
 
+async def export_users(chat_id: int, search_query: str | None = None, filter_active: bool = False) -> None:
+    """COPY ... TO STDOUT прямо во временный файл: asyncpg пишет его чанками через executor,
+    так что память не растет с размером таблицы, а соединение занято только на время копирования."""
+    params = admin_users_filter(search_query, filter_active)
+    fd, path = tempfile.mkstemp(prefix="users-", suffix=".csv")
+    os.close(fd)
+    try:
+        async with database.read_pool().acquire() as conn:
+            await conn.copy_from_query(
+                f"SELECT {EXPORT_COLUMNS} FROM users WHERE {queries.ADMIN_USERS_WHERE} ORDER BY user_id",
+                *params, output=path, format="csv", header=True,
+            )
+        filename = f"users-{datetime.now():%Y%m%d-%H%M%S}.csv"
+        await bot.send_document(chat_id, FSInputFile(path, filename=filename))
+    finally:
+        os.remove(path)
+
+@dp.message(Command("export"))
+async def admin_export_command(message: types.Message, command: CommandObject):
+    if message.from_user.id != ADMIN_ID: return
+    if not database.db_pool: return
+    args = (command.args or "").strip()
+    filter_active = args == "active"
+    search_query = None if filter_active or not args else args
+    await export_users(message.chat.id, search_query, filter_active)
+
+@dp.callback_query(F.data == "admin_export")
+async def admin_export(callback: types.CallbackQuery, state: FSMContext):
+    if callback.from_user.id != ADMIN_ID: return
+    if not database.db_pool: return
+    data = await state.get_data()
+    await safe_callback_answer(callback, "⏳ Готовим выгрузку...")
+    await export_users(callback.message.chat.id, data.get("admin_search_query"), data.get("admin_filter_active", False))
+
 @dp.callback_query(F.data.startswith("admin_page_"))
 async def admin_pagination(callback: types.CallbackQuery, state: FSMContext):
     if callback.from_user.id != ADMIN_ID: return
@@ -1023,49 +1036,34 @@ async def admin_save_days(message: types.Message, state: FSMContext):
     except: return
     data = await state.get_data()
     uid = data["editing_user_id"]
-    
-    async with database.db_pool.acquire() as conn:
-        user = await conn.fetchrow("SELECT * FROM users WHERE user_id=$1", uid)
-        
-        if days == 0:
-            new_d = datetime.now() - timedelta(minutes=1)
-        else:
-            base = user["expiry_date"] if user["expiry_date"] and user["expiry_date"] > datetime.now() else datetime.now()
-            new_d = base + timedelta(days=days)
-
-        if user["uuid"]: 
-            try:
-                await xui_api.update_client_via_xui_api(user["uuid"], f"user_{uid}", int(new_d.timestamp()*1000))
-            except Exception as e:
-                logger.error(f"X-UI Update Error: {e}")
 
-        notification_sent = False
-        
-        if new_d < datetime.now():
-            try:
-                kb_renew = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="💳 Продлить подписку", callback_data="buy_1_month")]
-                ])
-                await safe_bot_send_message(
-                    uid,
-                    "⛔️ <b>Ваша подписка истекла!</b>\n\n"
-                    "VPN отключен. Чтобы продолжить пользоваться интернетом без ограничений, пожалуйста, продлите подписку.",
-                    reply_markup=kb_renew,
-                    parse_mode="HTML"
-                )
-                notification_sent = True 
-            except Exception:
-                notification_sent = True 
-        else:
-            notification_sent = False 
+    # новый срок считает сам UPDATE; уведомление и панель — после того, как соединение вернулось в пул
+    grant = None
+    async with database.db_pool.acquire() as conn:
+        row = await queries.ADJUST_DAYS.fetchrow(conn, uid, days)
+        if row:
+            user_cache.users.put(row)
+            if row["uuid"]: grant = await provisioning.prepare(conn, row)
 
-        await conn.execute(
-            "UPDATE users SET expiry_date=$1, expired_notification_sent=$2 WHERE user_id=$3", 
-            new_d, notification_sent, uid
-        )
+    if row and row["expired_notification_sent"]:
+        try:
+            kb_renew = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="💳 Продлить подписку", callback_data="buy_1_month")]
+            ])
+            await safe_bot_send_message(
+                uid,
+                "⛔️ <b>Ваша подписка истекла!</b>\n\n"
+                "VPN отключен. Чтобы продолжить пользоваться интернетом без ограничений, пожалуйста, продлите подписку.",
+                reply_markup=kb_renew,
+                parse_mode="HTML"
+            )
+        except Exception:
+            pass
+    if grant and not await provisioning.push(grant):
+        logger.warning(f"X-UI недоступна, срок user_{uid} будет применен позже")
 
     await state.clear()
-    await show_user_page(message, state, data["return_page"], is_edit=False, message_id_to_edit=data["panel_msg_id"])
+    await show_user_page(message, state, data["return_page"], is_edit=False, message_id_to_edit=data["panel_msg_id"], fresh=True)
 
 @dp.callback_query(F.data.startswith("admin_edit_refs_"))
 async def admin_edit_refs_start(callback: types.CallbackQuery, state: FSMContext):
@@ -1088,63 +1086,141 @@ async def admin_save_refs(message: types.Message, state: FSMContext):
     except: return
     data = await state.get_data()
     async with database.db_pool.acquire() as conn:
-        await conn.execute("UPDATE users SET referral_count=$1 WHERE user_id=$2", refs, data["editing_user_id"])
+        row = await queries.SET_REFERRAL_COUNT.fetchrow(conn, data["editing_user_id"], refs)
+        if row: user_cache.users.put(row)
     await state.clear()
-    await show_user_page(message, state, data["return_page"], is_edit=False, message_id_to_edit=data["panel_msg_id"])
+    await show_user_page(message, state, data["return_page"], is_edit=False, message_id_to_edit=data["panel_msg_id"], fresh=True)
 
 async def check_expired_subscriptions():
     """Фоновая задача: проверяет истекшие подписки и шлет уведомления."""
+    ratelimit.set_priority(ratelimit.TRANSACTIONAL)
     while True:
         try:
             if database.db_pool:
-                async with database.db_pool.acquire() as conn:
-                    rows = await conn.fetch(
-                        "SELECT user_id FROM users WHERE expiry_date < NOW() AND (expired_notification_sent IS FALSE OR expired_notification_sent IS NULL)"
-                    )
+                started = time.perf_counter()
+                async with database.read_pool().acquire() as conn:
+                    rows = await queries.EXPIRED_UNNOTIFIED.fetch(conn)
+                oldest = min((row["expiry_date"] for row in rows), default=None)
+                metrics.EXPIRY_CHECKER_LAG.set((datetime.now() - oldest).total_seconds() if oldest else 0)
+
+                # соединение берется на каждую короткую запись, а не на весь цикл отправки
+                for row in rows:
+                    user_id = row["user_id"]
+                    # сначала отмечаем в primary: уже продливший или отмеченный пользователь отсеется
+                    async with database.db_pool.acquire() as conn:
+                        if not await queries.MARK_EXPIRED_NOTIFIED.fetchval(conn, user_id): continue
+                    user_cache.users.update(user_id, expired_notification_sent=True)
+                  
+                    kb_renew = InlineKeyboardMarkup(inline_keyboard=[
+                        [InlineKeyboardButton(text="💳 Продлить подписку", callback_data="buy_1_month")]
+                    ])
                     
-                    for row in rows:
-                        user_id = row["user_id"]
-                        
-                      
-                        kb_renew = InlineKeyboardMarkup(inline_keyboard=[
-                            [InlineKeyboardButton(text="💳 Продлить подписку", callback_data="buy_1_month")]
-                        ])
-                        
-                        try:
-                            await safe_bot_send_message(
-                                user_id,
-                                "⛔️ <b>Ваша подписка истекла!</b>\n\n"
-                                "VPN отключен. Чтобы продолжить пользоваться интернетом без ограничений, пожалуйста, продлите подписку.",
-                                reply_markup=kb_renew,
-                                parse_mode="HTML"
-                            )
-                            await conn.execute("UPDATE users SET expired_notification_sent = TRUE WHERE user_id = $1", user_id)
-                        except Exception as e:
-                            await conn.execute("UPDATE users SET expired_notification_sent = TRUE WHERE user_id = $1", user_id)
-
+                    try:
+                        await safe_bot_send_message(
+                            user_id,
+                            "⛔️ <b>Ваша подписка истекла!</b>\n\n"
+                            "VPN отключен. Чтобы продолжить пользоваться интернетом без ограничений, пожалуйста, продлите подписку.",
+                            reply_markup=kb_renew,
+                            parse_mode="HTML"
+                        )
+                    except Exception as e:
+                        outcome = delivery.classify(e)
+                        async with database.db_pool.acquire() as conn:
+                            if outcome in delivery.UNREACHABLE:
+                                await delivery.record_unreachable(conn, {user_id: outcome})
+                            else:
+                                await queries.UNMARK_EXPIRED_NOTIFIED.execute(conn, user_id)
+                                user_cache.users.update(user_id, expired_notification_sent=False)
+
+                metrics.EXPIRY_CHECKER_DURATION.set(time.perf_counter() - started)
+                metrics.EXPIRY_CHECKER_LAST_RUN.set_to_current_time()
         except Exception as e:
             logger.error(f"Ошибка в чекере подписок: {e}")
         
         await asyncio.sleep(300)
 
-async def main():
-    global crypto
-    crypto = AioCryptoPay(token=os.getenv("CRYPTO_TOKEN"), network=Networks.MAIN_NET)
-    
-    await xui_api.init_vpn_api()
+async def startup_step(name: str, coro, required: bool = False) -> None:
+    try:
+        result = await asyncio.wait_for(coro, STARTUP_TIMEOUT)
+    except Exception as e:
+        if required: raise
+        logger.warning(f"⚠️ {name}: не поднялся за {STARTUP_TIMEOUT} с ({e!r}), продолжаем без него")
+        return
+    metrics.set_ready(name, result is not False)
+
+async def init_storage() -> None:
     await database.init_db()
+    await asyncio.gather(
+        referrals.rewards.start(), provisioning.queue.start(), adjustments.adjustments.resume(), broadcasts.broadcasts.resume(),
+        invoices.registry.start(), digests.restore_tickets(ADMIN_ID),
+    )
+    pruning.pruner.start()
+    stats.snapshot.start()
+    await events.recorder.start()
+
+@dp.startup()
+async def on_polling_started() -> None:
+    metrics.set_ready("telegram")
+
+async def drain_updates() -> None:
+    """Поллинг уже остановлен (SIGTERM/SIGINT): доделываем начатые апдейты и подтверждаем offset."""
+    metrics.set_ready("telegram", False)
+    started = time.perf_counter()
+    left = await scheduling.scheduler.drain(SHUTDOWN_TIMEOUT)
+    if left: logger.warning(f"⚠️ {left} апдейтов не завершились за {SHUTDOWN_TIMEOUT} с, Telegram пришлет их снова")
+    else: logger.info(f"✅ Начатые апдейты завершены за {time.perf_counter() - started:.2f} с")
+    if not scheduling.scheduler.last_update_id: return
+    try:
+        # без этого последняя пачка getUpdates придет повторно после рестарта
+        await bot.get_updates(offset=scheduling.scheduler.confirm_offset(), limit=1, timeout=0)
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось подтвердить offset: {e}")
 
-    asyncio.create_task(check_expired_subscriptions())
+async def main():
+    started = time.perf_counter()
+    metrics.expect("database")
+    metrics.expect("telegram")
+    metrics.expect("xui", required=False)
+    ratelimit.setup(bot)
+    metrics.setup(dp, bot)
+    scheduling.setup(dp)
+    metrics_runner = await metrics.start_server(PORT)
+    profiler.monitor.start()
+
+    # независимые зависимости поднимаем параллельно: рестарт стоит max(), а не сумму.
+    # Логин в X-UI не блокирует старт — до него вызовы панели прикроет circuit breaker
+    xui_login = asyncio.create_task(startup_step("xui", xui_api.init_vpn_api()))
+    await asyncio.gather(
+        startup_step("database", init_storage(), required=True),
+        # накопившиеся за рестарт апдейты не выбрасываем — их обработает поллинг
+        startup_step("webhook", bot.delete_webhook(drop_pending_updates=False)),
+    )
 
-    await bot.delete_webhook(drop_pending_updates=True)
-    logger.info("🚀 Бот запущен (Polling)")
+    expiry_checker = asyncio.create_task(check_expired_subscriptions())
+    logger.info(f"🚀 Бот запущен (Polling), старт за {time.perf_counter() - started:.2f} с")
 
     try:
-        await dp.start_polling(bot)
+        # сессию закрываем сами: она нужна хендлерам, которые доделываются после остановки поллинга
+        await dp.start_polling(bot, close_bot_session=False)
+        await drain_updates()
     finally:
+        xui_login.cancel()
+        expiry_checker.cancel()
+        # фоновые задачи хранят прогресс в базе и продолжат с того же места после старта
+        await broadcasts.broadcasts.stop()
+        await digests.new_referrals.stop()
+        await digests.support_tickets.stop()
+        await referrals.rewards.stop()
+        await provisioning.queue.stop()
+        await pruning.pruner.stop()
+        await stats.snapshot.stop()
+        await adjustments.adjustments.stop()
+        await profiler.monitor.stop()
+        await events.recorder.stop()
+        await metrics_runner.cleanup()
         await bot.session.close()
         if crypto: await crypto.close()
-        if database.db_pool: await database.db_pool.close()
+        await database.close_db()
 
 if __name__ == "__main__":
     try:
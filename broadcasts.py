@@ -0,0 +1,144 @@
+import asyncio
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+import database
+import delivery
+import metrics
+import queries
+import ratelimit
+from config import bot, logger
+from utils import safe_bot_edit_message_text
+
+BROADCAST_BATCH = 100
+
+CREATE = queries.Query(
+    "broadcast_create", "INSERT INTO broadcasts (from_chat_id, message_id, menu_msg_id) VALUES ($1, $2, $3) RETURNING id"
+)
+UNFINISHED = queries.Query("broadcast_unfinished", "SELECT id FROM broadcasts WHERE finished_at IS NULL")
+GET = queries.Query("broadcast_get", "SELECT * FROM broadcasts WHERE id = $1")
+CHECKPOINT = queries.Query("broadcast_checkpoint", """
+UPDATE broadcasts SET last_user_id = $2, sent = $3, failed = $4, finished_at = CASE WHEN $5 THEN NOW() END WHERE id = $1
+""")
+RECIPIENTS = queries.Query(
+    "broadcast_recipients", "SELECT user_id FROM users WHERE user_id > $1 AND unreachable_at IS NULL ORDER BY user_id LIMIT $2"
+)
+
+class SourceDeleted(Exception):
+    """Исходное сообщение рассылки удалено — продолжать ее бессмысленно."""
+
+class Broadcasts:
+    """Рассылка объявления всем пользователям как фоновая задача с чекпоинтом.
+
+    Сообщение админа копируется через copy_message (нужны только chat_id/message_id
+    исходника) с приоритетом BULK — темп задает ratelimit, ответы пользователям идут
+    вперед. Пользователи обходятся по user_id пачками, и после каждой пачки
+    last_user_id фиксируется в broadcasts. При остановке бота прогресс сохраняется,
+    а незавершенная рассылка продолжается с того же места при следующем старте.
+    Заблокировавшие бота и удаленные аккаунты в том же чекпоинте отмечаются в users
+    и в следующие рассылки не попадают.
+    """
+
+    def __init__(self, batch: int):
+        self.batch = batch
+        self._tasks: dict[int, asyncio.Task] = {}
+
+    async def create(self, from_chat_id: int, message_id: int, menu_msg_id: int) -> int:
+        async with database.db_pool.acquire() as conn:
+            broadcast_id = await CREATE.fetchval(conn, from_chat_id, message_id, menu_msg_id)
+        logger.info(f"📣 Рассылка #{broadcast_id} запущена")
+        self._spawn(broadcast_id)
+        return broadcast_id
+
+    async def resume(self) -> None:
+        if not database.db_pool: return
+        async with database.db_pool.acquire() as conn:
+            rows = await UNFINISHED.fetch(conn)
+        for row in rows:
+            logger.info(f"📣 Продолжаем рассылку #{row['id']}")
+            self._spawn(row["id"])
+
+    async def stop(self) -> None:
+        for task in self._tasks.values(): task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks.clear()
+
+    def _spawn(self, broadcast_id: int) -> None:
+        task = asyncio.create_task(self._run(broadcast_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def _run(self, broadcast_id: int) -> None:
+        ratelimit.set_priority(ratelimit.BULK)
+        async with database.db_pool.acquire() as conn:
+            job = await GET.fetchrow(conn, broadcast_id)
+        last_user_id, sent, failed = job["last_user_id"], job["sent"], job["failed"]
+        failures: dict[int, str] = {}
+
+        async def checkpoint(finished: bool = False):
+            async with database.db_pool.acquire() as conn:
+                await delivery.record_unreachable(conn, failures)
+                failures.clear()
+                await CHECKPOINT.execute(conn, broadcast_id, last_user_id, sent, failed, finished)
+
+        try:
+            while True:
+                async with database.read_pool().acquire() as conn:
+                    user_ids = await RECIPIENTS.fetch(conn, last_user_id, self.batch)
+                if not user_ids: break
+
+                for row in user_ids:
+                    try:
+                        await bot.copy_message(chat_id=row["user_id"], from_chat_id=job["from_chat_id"], message_id=job["message_id"])
+                        sent += 1
+                        metrics.BROADCAST_MESSAGES.labels("sent").inc()
+                    except Exception as e:
+                        if delivery.source_missing(e): raise SourceDeleted from e
+                        failures[row["user_id"]] = delivery.classify(e)
+                        failed += 1
+                        metrics.BROADCAST_MESSAGES.labels("failed").inc()
+                    last_user_id = row["user_id"]
+                await checkpoint()
+
+            await checkpoint(finished=True)
+            logger.info(f"📣 Рассылка #{broadcast_id} завершена: {sent} доставлено, {failed} не доставлено")
+            await self._report(job, sent, failed)
+        except asyncio.CancelledError:
+            # остановка бота: сохраняем место, на котором прервались
+            await checkpoint()
+            logger.info(f"📣 Рассылка #{broadcast_id} приостановлена на user_id {last_user_id}")
+            raise
+        except SourceDeleted:
+            # не возобновляем: при следующем старте она упала бы на том же месте
+            await checkpoint(finished=True)
+            logger.warning(f"📣 Рассылка #{broadcast_id} остановлена: исходное сообщение удалено ({sent} доставлено)")
+            await self._report(job, sent, failed, aborted=True)
+        except Exception as e:
+            logger.error(f"❌ Рассылка #{broadcast_id} прервана: {e}")
+
+    async def _report(self, job, sent: int, failed: int, aborted: bool = False) -> None:
+        # исходник больше не нужен для copy_message
+        if not aborted:
+            try:
+                await bot.delete_message(job["from_chat_id"], job["message_id"])
+            except Exception:
+                pass
+
+        kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔙 В админ панель", callback_data="admin_panel")]
+        ])
+        header = "⚠️ <b>Рассылка остановлена:</b> исходное сообщение удалено." if aborted else "✅ <b>Объявление разослано!</b>"
+        text = (
+            f"{header}\n\n"
+            f"📨 Получили: {sent}\n"
+            f"🚫 Заблокировали бота: {failed}"
+        )
+        try:
+            await safe_bot_edit_message_text(job["from_chat_id"], job["menu_msg_id"], text, reply_markup=kb, parse_mode="HTML")
+        except Exception:
+            try:
+                await bot.send_message(job["from_chat_id"], text, reply_markup=kb, parse_mode="HTML")
+            except Exception:
+                pass
+
+broadcasts = Broadcasts(BROADCAST_BATCH)
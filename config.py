@@ -23,7 +23,58 @@ PANEL_URL = os.getenv("PANEL_URL", "")
 PANEL_USERNAME = os.getenv("PANEL_USERNAME", "")
 PANEL_PASSWORD = os.getenv("PANEL_PASSWORD", "")
 INBOUND_ID = int(os.getenv("INBOUND_ID", "0"))
+XUI_TIMEOUT = float(os.getenv("XUI_TIMEOUT", 5))
+XUI_ATTEMPTS = int(os.getenv("XUI_ATTEMPTS", 3))
+XUI_HANDLER_DEADLINE = float(os.getenv("XUI_HANDLER_DEADLINE", 3))
+XUI_BREAKER_FAILURES = int(os.getenv("XUI_BREAKER_FAILURES", 5))
+XUI_BREAKER_RESET = float(os.getenv("XUI_BREAKER_RESET", 30))
+PROVISIONING_DRAIN_INTERVAL = float(os.getenv("PROVISIONING_DRAIN_INTERVAL", 10))
+XUI_DISABLE_AFTER_DAYS = float(os.getenv("XUI_DISABLE_AFTER_DAYS", 3))
+XUI_DELETE_AFTER_DAYS = float(os.getenv("XUI_DELETE_AFTER_DAYS", 30))
+XUI_PRUNE_INTERVAL = float(os.getenv("XUI_PRUNE_INTERVAL", 3600))
+XUI_PRUNE_BATCH = int(os.getenv("XUI_PRUNE_BATCH", 100))
 DATABASE_URL = os.getenv("DATABASE_URL")
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 5))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 20))
+DB_STATEMENT_TIMEOUT = float(os.getenv("DB_STATEMENT_TIMEOUT", 30))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 100))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", 10))
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+DB_REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", 5))
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_CHECK_INTERVAL", 1))
+STARTUP_TIMEOUT = float(os.getenv("STARTUP_TIMEOUT", 10))
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", 25))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+RENDERED_CACHE_SIZE = int(os.getenv("RENDERED_CACHE_SIZE", 10000))
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", 32))
+ADMISSION_MAX_WAITING = int(os.getenv("ADMISSION_MAX_WAITING", 2 * MAX_CONCURRENT_UPDATES))
+ADMISSION_MAX_POOL_WAIT = float(os.getenv("ADMISSION_MAX_POOL_WAIT", 1))
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", 30))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", 1))
+TG_CHAT_BURST = int(os.getenv("TG_CHAT_BURST", 3))
+TG_GROUP_RATE = float(os.getenv("TG_GROUP_RATE", 20 / 60))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", 3))
+DIGEST_WINDOW = float(os.getenv("DIGEST_WINDOW", 60))
+EVENTS_FLUSH_SIZE = int(os.getenv("EVENTS_FLUSH_SIZE", 500))
+EVENTS_FLUSH_INTERVAL = float(os.getenv("EVENTS_FLUSH_INTERVAL", 5))
+EVENTS_BUFFER_MAX = int(os.getenv("EVENTS_BUFFER_MAX", 50000))
+EVENTS_RETENTION_DAYS = int(os.getenv("EVENTS_RETENTION_DAYS", 90))
+
+REFERRAL_WORKERS = int(os.getenv("REFERRAL_WORKERS", 4))
+REFERRAL_COALESCE_SECONDS = float(os.getenv("REFERRAL_COALESCE_SECONDS", 5))
+REFERRAL_RETRY_BASE = float(os.getenv("REFERRAL_RETRY_BASE", 10))
+REFERRAL_RETRY_MAX = float(os.getenv("REFERRAL_RETRY_MAX", 3600))
+
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", 200))
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", 10))
+
+STATS_REFRESH_INTERVAL = float(os.getenv("STATS_REFRESH_INTERVAL", 600))
+STATS_DAYS = int(os.getenv("STATS_DAYS", 7))
+
+SLOW_HANDLER_SECONDS = float(os.getenv("SLOW_HANDLER_SECONDS", 2))
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", 0.5))
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", 0.25))
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", 120))
 
 SERVER_IP = os.getenv("SERVER_IP")
 SERVER_PORT = os.getenv("SERVER_PORT")
@@ -1,11 +1,174 @@
+import asyncio
+import time
+from collections import OrderedDict
+
 import asyncpg
-from config import DATABASE_URL
+from prometheus_client import Counter
+from config import (
+    logger, DATABASE_URL, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_STATEMENT_TIMEOUT, DB_STATEMENT_CACHE_SIZE, DB_ACQUIRE_TIMEOUT,
+    DATABASE_REPLICA_URL, DB_REPLICA_MAX_LAG, DB_REPLICA_CHECK_INTERVAL,
+)
+import metrics
+
+# после записи чтения этого пользователя идут в primary, пока реплика гарантированно не догонит
+PIN_SECONDS = DB_REPLICA_MAX_LAG + DB_REPLICA_CHECK_INTERVAL
+PINNED_MAX = 10000
+
+DB_READS = Counter("db_reads_total", "Read-only pool acquisitions by the pool that served them", ["pool"])
+
+class PoolTimeoutError(asyncio.TimeoutError):
+    """Свободное соединение не освободилось за acquire_timeout."""
+
+class _TimedAcquire:
+    __slots__ = ("_pool", "_ctx")
+
+    def __init__(self, pool: "TrackedPool", ctx):
+        self._pool = pool
+        self._ctx = ctx
+
+    async def __aenter__(self) -> asyncpg.Connection:
+        start = time.perf_counter()
+        self._pool._waiters[self] = start
+        try:
+            conn = await self._ctx.__aenter__()
+        except asyncio.TimeoutError as e:
+            raise PoolTimeoutError(f"нет свободного соединения за {time.perf_counter() - start:.1f} с") from e
+        finally:
+            del self._pool._waiters[self]
+        metrics.DB_POOL_WAIT.observe(time.perf_counter() - start)
+        return conn
+
+    async def __aexit__(self, *exc):
+        return await self._ctx.__aexit__(*exc)
+
+class TrackedPool:
+    """Обертка над asyncpg.Pool: меряет ожидание свободного соединения и ограничивает его
+    acquire_timeout, чтобы при исчерпанном пуле хендлеры не висели бесконечно."""
+
+    def __init__(self, pool: asyncpg.Pool, acquire_timeout: float | None = None):
+        self.pool = pool
+        self.acquire_timeout = acquire_timeout
+        self._waiters: dict[_TimedAcquire, float] = {}
+
+    def acquire(self, *, timeout: float | None = None) -> _TimedAcquire:
+        return _TimedAcquire(self, self.pool.acquire(timeout=timeout or self.acquire_timeout))
+
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def oldest_wait(self) -> float:
+        """Сколько уже ждет соединения самый давний из ждущих; 0 — никто не ждет."""
+        if not self._waiters: return 0.0
+        return time.perf_counter() - min(self._waiters.values())
+
+    def __getattr__(self, name: str):
+        return getattr(self.pool, name)
+
+db_pool: TrackedPool | None = None
+replica_pool: TrackedPool | None = None
+# отставание реплики в секундах по последней проверке; None — неизвестно или реплика недоступна
+replica_lag: float | None = None
+_replica_watch: asyncio.Task | None = None
+_pinned: OrderedDict[int, float] = OrderedDict()
+# массовая правка (bulk_adjustments): до этого момента чтения любых пользователей идут в primary
+_pinned_all_until = 0.0
+
+metrics.register_gauge("db_pool_size", "Open connections in the pool", lambda: db_pool.get_size())
+metrics.register_gauge("db_pool_idle", "Idle connections in the pool", lambda: db_pool.get_idle_size())
+metrics.register_gauge("db_pool_max_size", "Pool max_size", lambda: db_pool.get_max_size())
+metrics.register_gauge("db_pool_waiting", "Tasks waiting for a pool connection", lambda: float(db_pool.waiting()))
+metrics.register_gauge("db_pool_oldest_wait_seconds", "How long the oldest waiter has been waiting for a connection", lambda: db_pool.oldest_wait())
+metrics.register_gauge("db_replica_lag_seconds", "Replica replay lag, -1 when unknown", lambda: -1.0 if replica_lag is None else replica_lag)
+
+def note_write(user_id: int) -> None:
+    """Пользователь только что что-то записал: его чтения ближайшие PIN_SECONDS идут в primary."""
+    _pinned[user_id] = time.monotonic() + PIN_SECONDS
+    _pinned.move_to_end(user_id)
+    if len(_pinned) > PINNED_MAX: _pinned.popitem(last=False)
+
+def note_bulk_write() -> None:
+    """Записали сразу многих пользователей: PIN_SECONDS все чтения по пользователям — из primary."""
+    global _pinned_all_until
+    _pinned_all_until = time.monotonic() + PIN_SECONDS
+
+def read_pool(user_id: int | None = None) -> TrackedPool:
+    """Пул для запросов только на чтение.
 
-db_pool: asyncpg.Pool | None = None
+    Реплика, если она задана и отстает не больше DB_REPLICA_MAX_LAG; иначе primary.
+    user_id — чьи данные показываем: после note_write(user_id) он видит свою запись.
+    """
+    if replica_pool is None or replica_lag is None or replica_lag > DB_REPLICA_MAX_LAG:
+        DB_READS.labels("primary").inc()
+        return db_pool
+    if user_id is not None:
+        if _pinned_all_until > time.monotonic():
+            DB_READS.labels("primary").inc()
+            return db_pool
+        until = _pinned.get(user_id)
+        if until is not None:
+            if until > time.monotonic():
+                DB_READS.labels("primary").inc()
+                return db_pool
+            del _pinned[user_id]
+    DB_READS.labels("replica").inc()
+    return replica_pool
 
-async def init_db() -> None:
+async def _check_replica() -> float | None:
+    async with db_pool.acquire() as conn:
+        lsn = await conn.fetchval("SELECT pg_current_wal_lsn()::text")
+    async with replica_pool.acquire() as conn:
+        # догнала primary — отставания нет, даже если записей давно не было и replay_timestamp старый
+        row = await conn.fetchrow(
+            """SELECT pg_last_wal_replay_lsn() >= $1::text::pg_lsn AS caught_up,
+                      EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp())::float8 AS lag""",
+            lsn,
+        )
+    if row["caught_up"]: return 0.0
+    return row["lag"]
+
+async def _watch_replica() -> None:
+    global replica_lag
+    while True:
+        try:
+            lag = await asyncio.wait_for(_check_replica(), DB_REPLICA_CHECK_INTERVAL * 5)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if replica_lag is not None: logger.warning(f"⚠️ Реплика недоступна, чтения идут в primary: {e!r}")
+            lag = None
+        if lag is not None and lag > DB_REPLICA_MAX_LAG and (replica_lag is None or replica_lag <= DB_REPLICA_MAX_LAG):
+            logger.warning(f"⚠️ Реплика отстает на {lag:.1f} с, чтения идут в primary")
+        replica_lag = lag
+        await asyncio.sleep(DB_REPLICA_CHECK_INTERVAL)
+
+async def _init_replica(pool_kwargs: dict) -> None:
+    """Реплика необязательна: не поднялась — все читаем из primary."""
+    global replica_pool, _replica_watch
+    try:
+        replica_pool = TrackedPool(await asyncpg.create_pool(DATABASE_REPLICA_URL, **pool_kwargs), DB_ACQUIRE_TIMEOUT)
+    except Exception as e:
+        logger.warning(f"⚠️ Реплика не подключена, чтения идут в primary: {e!r}")
+        return
+    _replica_watch = asyncio.create_task(_watch_replica())
+
+async def close_db() -> None:
+    if _replica_watch:
+        _replica_watch.cancel()
+        await asyncio.gather(_replica_watch, return_exceptions=True)
+    if replica_pool: await replica_pool.close()
+    if db_pool: await db_pool.close()
+
+async def init_db(**pool_kwargs) -> None:
     global db_pool
-    db_pool = await asyncpg.create_pool(DATABASE_URL)
+    # create_pool открывает min_size соединений сразу (параллельно), первые апдейты после рестарта не ждут коннекта
+    pool_kwargs.setdefault("min_size", DB_POOL_MIN_SIZE)
+    pool_kwargs.setdefault("max_size", DB_POOL_MAX_SIZE)
+    # prepared statements из queries.Query живут в кэше каждого соединения (0 — для pgbouncer в transaction mode)
+    pool_kwargs.setdefault("statement_cache_size", DB_STATEMENT_CACHE_SIZE)
+    # зависший запрос отменяет сам Postgres, соединение остается рабочим; 0 — без лимита
+    pool_kwargs.setdefault("server_settings", {"statement_timeout": str(int(DB_STATEMENT_TIMEOUT * 1000))})
+    db_pool = TrackedPool(await asyncpg.create_pool(DATABASE_URL, **pool_kwargs), DB_ACQUIRE_TIMEOUT)
+    if DATABASE_REPLICA_URL: await _init_replica(pool_kwargs)
     async with db_pool.acquire() as conn:
         await conn.execute(
             """
@@ -28,5 +191,146 @@ async def init_db() -> None:
             await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS last_support_time TIMESTAMP;")
             await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS last_bonus_claim TIMESTAMP;")
             await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS expired_notification_sent BOOLEAN DEFAULT FALSE;")
+            await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS xui_state TEXT;")
+            await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS unreachable_at TIMESTAMP;")
+            await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS unreachable_reason TEXT;")
         except Exception:
-            pass
\ No newline at end of file
+            pass
+
+        await conn.execute("CREATE INDEX IF NOT EXISTS users_expiry_date_idx ON users (expiry_date);")
+
+        # custom_id = перестановка номера из последовательности в 9 символов base36: новые id не совпадают друг с другом
+        await conn.execute(
+            """
+            CREATE SEQUENCE IF NOT EXISTS users_custom_id_seq;
+            CREATE OR REPLACE FUNCTION make_custom_id(n BIGINT) RETURNS TEXT AS $$
+            DECLARE
+                alphabet CONSTANT TEXT := 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789';
+                x NUMERIC := (n::numeric * 27182818284593 + 7919) % 101559956668416;
+                result TEXT := '';
+            BEGIN
+                FOR i IN 1..9 LOOP
+                    result := substr(alphabet, (x % 36)::int + 1, 1) || result;
+                    x := div(x, 36);
+                END LOOP;
+                RETURN result;
+            END
+            $$ LANGUAGE plpgsql IMMUTABLE;
+            """
+        )
+
+        await conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pending_referral_rewards (
+                referrer_id BIGINT PRIMARY KEY,
+                signups INTEGER NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW()
+            );
+            """
+        )
+        await conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS daily_stats (
+                day DATE PRIMARY KEY,
+                new_users INTEGER NOT NULL DEFAULT 0,
+                referred_users INTEGER NOT NULL DEFAULT 0,
+                bonus_claims INTEGER NOT NULL DEFAULT 0,
+                payments INTEGER NOT NULL DEFAULT 0,
+                referral_rewards INTEGER NOT NULL DEFAULT 0
+            );
+            """
+        )
+        await conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS bulk_adjustments (
+                id SERIAL PRIMARY KEY,
+                segment TEXT NOT NULL,
+                days INTEGER NOT NULL,
+                chat_id BIGINT NOT NULL,
+                message_id BIGINT NOT NULL,
+                total INTEGER NOT NULL DEFAULT 0,
+                done INTEGER NOT NULL DEFAULT 0,
+                deferred INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                finished_at TIMESTAMP
+            );
+            CREATE TABLE IF NOT EXISTS bulk_adjustment_items (
+                adjustment_id INTEGER NOT NULL REFERENCES bulk_adjustments (id) ON DELETE CASCADE,
+                user_id BIGINT NOT NULL,
+                PRIMARY KEY (adjustment_id, user_id)
+            );
+            """
+        )
+        await conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS events (
+                ts TIMESTAMP NOT NULL,
+                user_id BIGINT,
+                name TEXT NOT NULL,
+                props JSONB
+            ) PARTITION BY RANGE (ts);
+            """
+        )
+        await conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id SERIAL PRIMARY KEY,
+                from_chat_id BIGINT NOT NULL,
+                message_id BIGINT NOT NULL,
+                menu_msg_id BIGINT,
+                last_user_id BIGINT NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                finished_at TIMESTAMP
+            );
+            """
+        )
+        await conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS open_invoices (
+                user_id BIGINT NOT NULL,
+                method TEXT NOT NULL,
+                amount NUMERIC(12, 2) NOT NULL,
+                invoice_id TEXT NOT NULL,
+                order_id TEXT,
+                url TEXT NOT NULL,
+                expires_at TIMESTAMP NOT NULL,
+                PRIMARY KEY (user_id, method)
+            );
+            """
+        )
+        await conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pending_provisioning (
+                user_id BIGINT PRIMARY KEY,
+                uuid TEXT NOT NULL,
+                expiry_ms BIGINT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+            );
+            """
+        )
+        await conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS payments (
+                method TEXT NOT NULL,
+                payment_id TEXT NOT NULL,
+                user_id BIGINT NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (method, payment_id)
+            );
+            """
+        )
+        await conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pending_tickets (
+                id SERIAL PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                username TEXT,
+                text TEXT NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT NOW()
+            );
+            """
+        )
\ No newline at end of file
@@ -0,0 +1,44 @@
+import asyncpg
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramNotFound, TelegramRetryAfter
+from prometheus_client import Counter
+
+import queries
+import user_cache
+
+FORBIDDEN, CHAT_NOT_FOUND, RATE_LIMITED, TRANSIENT = "forbidden", "chat_not_found", "rate_limited", "transient"
+# после этих ошибок слать пользователю бесполезно, пока он сам не напишет /start
+UNREACHABLE = (FORBIDDEN, CHAT_NOT_FOUND)
+# только про получателя: «message to copy not found» и т.п. к пользователю отношения не имеют
+RECIPIENT_NOT_FOUND = ("chat not found", "user not found")
+
+DELIVERY_FAILURES = Counter("telegram_delivery_failures_total", "Failed sends to users by outcome", ["outcome"])
+
+def classify(e: Exception) -> str:
+    """Исход неудачной отправки пользователю."""
+    if isinstance(e, TelegramForbiddenError):
+        outcome = FORBIDDEN  # заблокировал бота или удалил аккаунт
+    elif isinstance(e, TelegramNotFound) or (isinstance(e, TelegramBadRequest) and any(s in e.message.lower() for s in RECIPIENT_NOT_FOUND)):
+        outcome = CHAT_NOT_FOUND
+    elif isinstance(e, TelegramRetryAfter):
+        outcome = RATE_LIMITED  # ratelimit уже исчерпал повторы
+    else:
+        outcome = TRANSIENT
+    DELIVERY_FAILURES.labels(outcome).inc()
+    return outcome
+
+def source_missing(e: Exception) -> bool:
+    """copy_message: исходное сообщение удалено — слать дальше нечего никому."""
+    return isinstance(e, TelegramBadRequest) and "message to copy not found" in e.message.lower()
+
+async def record_unreachable(conn: asyncpg.Connection, failures: dict[int, str]) -> None:
+    """failures — {user_id: исход}; сохраняются только постоянные (UNREACHABLE)."""
+    unreachable = {user_id: outcome for user_id, outcome in failures.items() if outcome in UNREACHABLE}
+    if not unreachable: return
+    rows = await queries.MARK_UNREACHABLE.fetch(conn, list(unreachable), list(unreachable.values()))
+    for row in rows:
+        user_cache.users.update(row["user_id"], unreachable_at=row["unreachable_at"], unreachable_reason=row["unreachable_reason"])
+
+async def reactivate(conn: asyncpg.Connection, user_id: int) -> None:
+    """Пользователь снова написал боту — возвращаем его в рассылки и напоминания."""
+    await queries.MARK_REACHABLE.execute(conn, user_id)
+    user_cache.users.update(user_id, unreachable_at=None, unreachable_reason=None)
@@ -0,0 +1,146 @@
+import asyncio
+import html
+from typing import Any, Awaitable, Callable
+
+import asyncpg
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+import database
+import keyboards as kb
+import queries
+import ratelimit
+from config import logger, DIGEST_WINDOW
+from utils import safe_bot_send_message
+
+MAX_LISTED = 10
+
+Render = Callable[[list[Any]], tuple[str, InlineKeyboardMarkup | None]]
+Delivered = Callable[[list[Any]], Awaitable[None]]
+
+SAVE_TICKET = queries.Query("ticket_save", "INSERT INTO pending_tickets (user_id, username, text) VALUES ($1, $2, $3) RETURNING id")
+PENDING_TICKETS = queries.Query("tickets_pending", "SELECT id, user_id, username, text FROM pending_tickets ORDER BY id")
+DELETE_TICKETS = queries.Query("tickets_delete", "DELETE FROM pending_tickets WHERE id = ANY($1::int[])")
+
+class _Bucket:
+    __slots__ = ("items", "timer")
+
+    def __init__(self):
+        self.items: list[Any] = []
+        self.timer: asyncio.TimerHandle | None = None
+
+class Digest:
+    """Склеивает уведомления одному получателю в сводку раз в window секунд.
+
+    Первое уведомление уходит сразу и открывает окно. Все, что приходит, пока окно
+    открыто, копится и уходит одним сообщением в его конце (render получает весь
+    список), после чего окно открывается снова. Тишина в течение окна его закрывает.
+    Так популярный реферер получает «+37 новых рефералов» раз в минуту, а не 37
+    сообщений, которые съедают лимиты Telegram на чат.
+    """
+
+    def __init__(self, name: str, window: float, render: Render, chunk: int | None = None, delivered: Delivered | None = None):
+        self.name = name
+        self.window = window
+        self.render = render
+        self.chunk = chunk
+        # delivered — вызывается с каждой доставленной пачкой (снять ее с хранения)
+        self.delivered = delivered
+        self._buckets: dict[int, _Bucket] = {}
+        self._sends: set[asyncio.Task] = set()
+
+    def add(self, chat_id: int, item: Any) -> None:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = _Bucket()
+            self._send(chat_id, [item])
+            self._arm(chat_id, bucket)
+        else:
+            bucket.items.append(item)
+
+    def _arm(self, chat_id: int, bucket: _Bucket) -> None:
+        bucket.timer = asyncio.get_running_loop().call_later(self.window, self._flush, chat_id)
+
+    def _flush(self, chat_id: int) -> None:
+        bucket = self._buckets[chat_id]
+        if not bucket.items:
+            del self._buckets[chat_id]
+            return
+        items, bucket.items = bucket.items, []
+        self._send(chat_id, items)
+        self._arm(chat_id, bucket)
+
+    def _send(self, chat_id: int, items: list[Any]) -> None:
+        task = asyncio.create_task(self._deliver(chat_id, items))
+        self._sends.add(task)
+        task.add_done_callback(self._sends.discard)
+
+    async def _deliver(self, chat_id: int, items: list[Any]) -> None:
+        ratelimit.set_priority(ratelimit.TRANSACTIONAL)
+        # chunk — для сводок, где каждый элемент должен остаться виден целиком (тикеты с кнопкой ответа)
+        size = self.chunk or len(items)
+        for i in range(0, len(items), size):
+            batch = items[i:i + size]
+            try:
+                text, markup = self.render(batch)
+                await safe_bot_send_message(chat_id, text, reply_markup=markup, parse_mode="HTML")
+                if self.delivered: await self.delivered(batch)
+            except Exception as e:
+                logger.warning(f"Сводка {self.name} для {chat_id} ({len(items)} шт.) не отправлена: {e}")
+
+    async def stop(self) -> None:
+        """Остановка бота: накопленное отправляем сразу, не дожидаясь конца окна."""
+        for chat_id, bucket in list(self._buckets.items()):
+            if bucket.timer: bucket.timer.cancel()
+            if bucket.items: self._send(chat_id, bucket.items)
+        self._buckets.clear()
+        await asyncio.gather(*self._sends, return_exceptions=True)
+
+def _render_referrals(names: list[str]) -> tuple[str, None]:
+    if len(names) == 1: return f"👤 <b>Новый реферал!</b>\n{names[0]}", None
+    listed = ", ".join(names[:MAX_LISTED])
+    more = f" и еще {len(names) - MAX_LISTED}" if len(names) > MAX_LISTED else ""
+    return f"👥 <b>+{len(names)} новых рефералов!</b>\n{listed}{more}", None
+
+def _sender(user_id: int, username: str | None) -> str:
+    return f"@{html.escape(username)}" if username else str(user_id)
+
+def _render_tickets(tickets: list[tuple[int, int, str | None, str]]) -> tuple[str, InlineKeyboardMarkup]:
+    """tickets — (ticket_id, user_id, username, text); username у пользователя может не быть."""
+    if len(tickets) == 1:
+        _, user_id, username, text = tickets[0]
+        return (
+            f"📩 <b>Тикет</b>\nОт: {_sender(user_id, username)} (ID: <code>{user_id}</code>)\n\n{html.escape(text)}",
+            kb.admin_ticket_kb(user_id),
+        )
+
+    lines = [f"📩 <b>Новых тикетов: {len(tickets)}</b>"]
+    for _, user_id, username, text in tickets:
+        lines.append(f"\n<b>{_sender(user_id, username)}</b> (<code>{user_id}</code>):\n{html.escape(text[:300])}")
+    buttons = [
+        [InlineKeyboardButton(text=f"✏️ Ответить {'@' + username if username else user_id}", callback_data=f"ans_{user_id}")]
+        for _, user_id, username, _ in tickets
+    ]
+    buttons.append([InlineKeyboardButton(text="🗑 Удалить/Закрыть", callback_data="del_msg")])
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=buttons)
+
+async def _tickets_delivered(tickets: list[tuple[int, int, str | None, str]]) -> None:
+    async with database.db_pool.acquire() as conn:
+        await DELETE_TICKETS.execute(conn, [ticket[0] for ticket in tickets])
+
+new_referrals = Digest("referrals", DIGEST_WINDOW, _render_referrals)
+support_tickets = Digest("tickets", DIGEST_WINDOW, _render_tickets, chunk=MAX_LISTED, delivered=_tickets_delivered)
+
+async def save_ticket(conn: asyncpg.Connection, user_id: int, username: str | None, text: str) -> tuple[int, int, str | None, str]:
+    """Тикет сначала пишется в pending_tickets и снимается оттуда только после доставки
+    админу, так что рестарт посреди окна сводки его не теряет."""
+    ticket_id = await SAVE_TICKET.fetchval(conn, user_id, username, text)
+    return ticket_id, user_id, username, text
+
+async def restore_tickets(chat_id: int) -> None:
+    """Старт бота: недоставленные в прошлый раз тикеты снова ставятся в сводку."""
+    if not database.db_pool or not chat_id: return
+    async with database.db_pool.acquire() as conn:
+        rows = await PENDING_TICKETS.fetch(conn)
+    for row in rows:
+        support_tickets.add(chat_id, (row["id"], row["user_id"], row["username"], row["text"]))
+    if rows: logger.info(f"📩 Недоставленных тикетов: {len(rows)}")
@@ -0,0 +1,121 @@
+import asyncio
+import json
+import time
+from datetime import date, datetime, timedelta
+
+from prometheus_client import Counter, Histogram
+
+import database
+import metrics
+from config import logger, EVENTS_FLUSH_SIZE, EVENTS_FLUSH_INTERVAL, EVENTS_BUFFER_MAX, EVENTS_RETENTION_DAYS
+
+EVENT_COLUMNS = ("ts", "user_id", "name", "props")
+
+EVENTS_WRITTEN = Counter("events_written_total", "User action events flushed to Postgres")
+EVENTS_DROPPED = Counter("events_dropped_total", "User action events dropped because the buffer was full")
+EVENTS_FLUSH_DURATION = Histogram("events_flush_seconds", "Duration of one COPY of buffered events", buckets=metrics.LATENCY_BUCKETS)
+
+def _partition(day: date) -> str:
+    return f"events_{day:%Y%m%d}"
+
+class EventLog:
+    """Журнал действий пользователей для воронок (start → buy_menu → payment_method → paid).
+
+    emit() только кладет кортеж в память — хендлер не ждет базу. Фоновая задача сливает
+    буфер одним copy_records_to_table, когда набралось flush_size событий или прошло
+    flush_interval секунд. Таблица events разбита на партиции по дням: старые дни
+    удаляются DROP TABLE без VACUUM. Если база недоступна, события копятся до buffer_max,
+    дальше новые отбрасываются (events_dropped_total).
+    """
+
+    def __init__(self, flush_size: int, flush_interval: float, buffer_max: int, retention_days: int):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.buffer_max = buffer_max
+        self.retention_days = retention_days
+        self._buffer: list[tuple] = []
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._partitions_day: date | None = None
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def emit(self, name: str, user_id: int | None = None, **props) -> None:
+        if len(self._buffer) >= self.buffer_max:
+            EVENTS_DROPPED.inc()
+            return
+        self._buffer.append((datetime.now(), user_id, name, json.dumps(props, ensure_ascii=False) if props else None))
+        if len(self._buffer) >= self.flush_size: self._wakeup.set()
+
+    async def start(self) -> None:
+        if not database.db_pool: return
+        await self._maintain_partitions()
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            # последние события до остановки не теряем
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Не удалось сохранить {len(self._buffer)} событий при остановке: {e}")
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                if self._partitions_day != date.today(): await self._maintain_partitions()
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка записи журнала событий: {e}")
+
+    async def flush(self) -> None:
+        if not self._buffer: return
+        batch, self._buffer = self._buffer, []
+        start = time.perf_counter()
+        try:
+            async with database.db_pool.acquire() as conn:
+                await conn.copy_records_to_table("events", records=batch, columns=EVENT_COLUMNS)
+        except Exception:
+            # возвращаем в начало буфера, новые события за время COPY идут следом
+            self._buffer = batch + self._buffer
+            raise
+        EVENTS_WRITTEN.inc(len(batch))
+        EVENTS_FLUSH_DURATION.observe(time.perf_counter() - start)
+
+    async def _maintain_partitions(self) -> None:
+        """Партиции на вчера (события из буфера, пережившего полночь), сегодня и завтра; удаление старше retention."""
+        today = date.today()
+        cutoff = _partition(today - timedelta(days=self.retention_days))
+        async with database.db_pool.acquire() as conn:
+            for offset in (-1, 0, 1):
+                day = today + timedelta(days=offset)
+                await conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {_partition(day)} PARTITION OF events "
+                    f"FOR VALUES FROM ('{day}') TO ('{day + timedelta(days=1)}')"
+                )
+            expired = await conn.fetch(
+                """SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                   WHERE i.inhparent = 'events'::regclass AND c.relname < $1""",
+                cutoff,
+            )
+            for row in expired:
+                await conn.execute(f"DROP TABLE IF EXISTS {row['relname']}")
+        if expired: logger.info(f"🗑 Журнал событий: удалено {len(expired)} партиций старше {self.retention_days} дн.")
+        self._partitions_day = today
+
+recorder = EventLog(EVENTS_FLUSH_SIZE, EVENTS_FLUSH_INTERVAL, EVENTS_BUFFER_MAX, EVENTS_RETENTION_DAYS)
+
+metrics.register_gauge("events_buffered", "User action events waiting for the next flush", lambda: float(len(recorder)))
+
+def emit(name: str, user_id: int | None = None, **props) -> None:
+    """events.emit("paid", user_id, method="stars") — без ожидания базы."""
+    recorder.emit(name, user_id, **props)
@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+import asyncpg
+
+import database
+import metrics
+import queries
+from config import logger
+
+# счет, которому осталось меньше, не показываем снова — пользователь может не успеть оплатить
+MIN_TIME_LEFT = timedelta(minutes=1)
+
+SAVE = queries.Query("invoice_save", """
+INSERT INTO open_invoices (user_id, method, amount, invoice_id, order_id, url, expires_at) VALUES ($1, $2, $3, $4, $5, $6, $7)
+ON CONFLICT (user_id, method) DO UPDATE SET amount = EXCLUDED.amount, invoice_id = EXCLUDED.invoice_id,
+    order_id = EXCLUDED.order_id, url = EXCLUDED.url, expires_at = EXCLUDED.expires_at
+""")
+LOAD = queries.Query("invoice_load", "SELECT * FROM open_invoices WHERE expires_at > NOW()")
+PURGE = queries.Query("invoice_purge", "DELETE FROM open_invoices WHERE expires_at <= NOW()")
+CLOSE = queries.Query("invoice_close", "DELETE FROM open_invoices WHERE user_id = $1 AND method = $2 AND invoice_id = $3")
+
+class Invoice(NamedTuple):
+    invoice_id: str
+    order_id: str | None
+    url: str
+    amount: float
+    expires_at: datetime
+
+class InvoiceRegistry:
+    """Открытые счета пользователей, по одному на способ оплаты.
+
+    Повторный вход на экран оплаты показывает уже выставленный счет без запроса к
+    Lava/CryptoPay. Новый выставляется, когда старый истекает (или осталось меньше
+    MIN_TIME_LEFT), меняется сумма или счет оплачен. Счета хранятся в open_invoices и
+    поднимаются в память при старте, поэтому рестарт бота их не теряет.
+    """
+
+    def __init__(self):
+        self.reused = 0
+        self._open: dict[tuple[int, str], Invoice] = {}
+
+    def __len__(self) -> int:
+        return len(self._open)
+
+    async def start(self) -> None:
+        if not database.db_pool: return
+        async with database.db_pool.acquire() as conn:
+            await PURGE.execute(conn)
+            rows = await LOAD.fetch(conn)
+        for row in rows:
+            self._open[(row["user_id"], row["method"])] = Invoice(row["invoice_id"], row["order_id"], row["url"], float(row["amount"]), row["expires_at"])
+        if rows: logger.info(f"🧾 Открытых счетов: {len(rows)}")
+
+    def get(self, user_id: int, method: str, amount: float) -> Invoice | None:
+        invoice = self._open.get((user_id, method))
+        if invoice is None: return None
+        if invoice.amount != amount or invoice.expires_at - datetime.now() < MIN_TIME_LEFT:
+            del self._open[(user_id, method)]
+            return None
+        self.reused += 1
+        return invoice
+
+    async def remember(self, user_id: int, method: str, amount: float, invoice_id: str, url: str, ttl: timedelta, order_id: str | None = None) -> Invoice:
+        invoice = Invoice(str(invoice_id), order_id, url, amount, datetime.now() + ttl)
+        self._open[(user_id, method)] = invoice
+        async with database.db_pool.acquire() as conn:
+            await SAVE.execute(conn, user_id, method, amount, invoice.invoice_id, order_id, url, invoice.expires_at)
+        return invoice
+
+    async def close(self, user_id: int, method: str, invoice_id: str, conn: asyncpg.Connection | None = None) -> None:
+        """Счет оплачен или истек — следующий вход на экран оплаты выставит новый."""
+        invoice = self._open.get((user_id, method))
+        if invoice is not None and invoice.invoice_id == str(invoice_id): del self._open[(user_id, method)]
+        if conn is not None:
+            await CLOSE.execute(conn, user_id, method, str(invoice_id))
+            return
+        async with database.db_pool.acquire() as conn:
+            await CLOSE.execute(conn, user_id, method, str(invoice_id))
+
+registry = InvoiceRegistry()
+
+metrics.register_counter("invoices_reused", "Payment screens served with an already open invoice", lambda: registry.reused)
+metrics.register_gauge("invoices_open", "Open invoices kept for reuse", lambda: float(len(registry)))
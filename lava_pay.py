@@ -5,11 +5,16 @@ import hashlib
 import aiohttp
 import logging
 
+import metrics
+
 LAVA_PROJECT_ID = os.getenv("LAVA_PROJECT_ID")
 LAVA_SECRET_KEY = os.getenv("LAVA_SECRET_KEY")
 
-LAVA_CREATE_URL = "https://api.lava.ru/business/invoice/create"
-LAVA_STATUS_URL = "https://api.lava.ru/business/invoice/status"
+LAVA_API_URL = os.getenv("LAVA_API_URL", "https://api.lava.ru")
+LAVA_CREATE_URL = f"{LAVA_API_URL}/business/invoice/create"
+LAVA_STATUS_URL = f"{LAVA_API_URL}/business/invoice/status"
+# время жизни счета, минуты
+LAVA_INVOICE_EXPIRE = 300
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +25,10 @@ def generate_signature(json_string: str, secret_key: str) -> str:
         hashlib.sha256
     ).hexdigest()
 
+def _is_error(result) -> bool:
+    return not result or result.get("status") == "error"
+
+@metrics.tracked("lava", "invoice_create", failed=_is_error)
 async def create_lava_invoice(amount: float, order_id: str, comment: str = "VPN Access"):
     
     if not LAVA_PROJECT_ID or "ВАШ_" in LAVA_PROJECT_ID:
@@ -30,7 +39,7 @@ async def create_lava_invoice(amount: float, order_id: str, comment: str = "VPN
         "shopId": LAVA_PROJECT_ID,
         "sum": float(amount),
         "orderId": order_id,
-        "expire": 300, 
+        "expire": LAVA_INVOICE_EXPIRE,
         "comment": f"{comment}: {order_id}",
         "hookUrl": "https://google.com", 
         "failUrl": "https://google.com",
@@ -64,6 +73,7 @@ async def create_lava_invoice(amount: float, order_id: str, comment: str = "VPN
         logger.error(f"Lava connection error: {e}")
         return {"status": "error", "message": str(e)}
 
+@metrics.tracked("lava", "invoice_status", failed=_is_error)
 async def check_lava_status(order_id: str, invoice_id: str):
     """Проверка статуса (Lava Business)"""
     if not LAVA_PROJECT_ID or not LAVA_SECRET_KEY:
@@ -0,0 +1,187 @@
+import time
+from contextlib import asynccontextmanager
+from functools import wraps
+from typing import Any, Awaitable, Callable
+
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import CallbackQuery, TelegramObject
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from config import logger, SLOW_HANDLER_SECONDS
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+MAX_HANDLER_LABELS = 256
+
+HANDLER_LATENCY = Histogram("bot_handler_latency_seconds", "Handler latency by callback data prefix / handler name", ["handler"], buckets=LATENCY_BUCKETS)
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Unhandled handler exceptions", ["handler"])
+
+EVENT_LOOP_LAG = Histogram("event_loop_lag_seconds", "Event loop wake-up lag", buckets=LATENCY_BUCKETS)
+
+DB_POOL_WAIT = Histogram("db_pool_acquire_wait_seconds", "Time spent waiting for a pool connection", buckets=LATENCY_BUCKETS)
+
+EXTERNAL_LATENCY = Histogram("external_call_latency_seconds", "Latency of calls to external APIs", ["service", "method"], buckets=LATENCY_BUCKETS)
+EXTERNAL_ERRORS = Counter("external_call_errors_total", "Failed calls to external APIs", ["service", "method"])
+
+BROADCAST_MESSAGES = Counter("broadcast_messages_total", "Broadcast deliveries", ["result"])
+
+EXPIRY_CHECKER_LAG = Gauge("expiry_checker_lag_seconds", "Age of the oldest expired subscription still waiting for a notification")
+EXPIRY_CHECKER_DURATION = Gauge("expiry_checker_last_run_seconds", "Duration of the last expiry checker pass")
+EXPIRY_CHECKER_LAST_RUN = Gauge("expiry_checker_last_run_timestamp", "Unix time of the last expiry checker pass")
+
+class _CallbackCollector:
+    """Значения, которые дешевле прочитать при скрейпе, чем обновлять на каждый вызов."""
+
+    def __init__(self):
+        self._metrics: list[tuple[type, str, str, Callable[[], float]]] = []
+
+    def add(self, family: type, name: str, documentation: str, fn: Callable[[], float]) -> None:
+        self._metrics.append((family, name, documentation, fn))
+
+    def collect(self):
+        for family, name, documentation, fn in self._metrics:
+            metric = family(name, documentation)
+            try:
+                metric.add_metric([], fn())
+            except Exception:
+                continue
+            yield metric
+
+_callbacks = _CallbackCollector()
+REGISTRY.register(_callbacks)
+
+def register_gauge(name: str, documentation: str, fn: Callable[[], float]) -> None:
+    _callbacks.add(GaugeMetricFamily, name, documentation, fn)
+
+def register_counter(name: str, documentation: str, fn: Callable[[], float]) -> None:
+    _callbacks.add(CounterMetricFamily, name, documentation, fn)
+
+_handler_labels: set[str] = set()
+
+def callback_prefix(data: str | None) -> str:
+    """admin_page_3 -> admin_page, L_<invoice>_<order> -> L, check_123 -> check."""
+    if not data: return "callback"
+    parts = []
+    for part in data.split("_")[:3]:
+        if not part or "-" in part or any(c.isdigit() for c in part): break
+        parts.append(part)
+    return "_".join(parts) or "callback"
+
+def handler_label(event: TelegramObject, data: dict[str, Any]) -> str:
+    if isinstance(event, CallbackQuery):
+        label = callback_prefix(event.data)
+    else:
+        handler = data.get("handler")
+        label = getattr(getattr(handler, "callback", None), "__name__", type(event).__name__)
+
+    if label not in _handler_labels:
+        if len(_handler_labels) >= MAX_HANDLER_LABELS: return "other"
+        _handler_labels.add(label)
+    return label
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        label = handler_label(event, data)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.labels(label).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            HANDLER_LATENCY.labels(label).observe(elapsed)
+            if elapsed > SLOW_HANDLER_SECONDS:
+                name = getattr(data.get("handler"), "callback", None)
+                logger.warning(f"🐢 Медленный хендлер {getattr(name, '__name__', label)} ({label}): {elapsed:.2f} с")
+
+class TelegramRequestMetrics(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            EXTERNAL_ERRORS.labels("telegram", name).inc()
+            raise
+        finally:
+            EXTERNAL_LATENCY.labels("telegram", name).observe(time.perf_counter() - start)
+
+@asynccontextmanager
+async def track(service: str, method: str):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        EXTERNAL_ERRORS.labels(service, method).inc()
+        raise
+    finally:
+        EXTERNAL_LATENCY.labels(service, method).observe(time.perf_counter() - start)
+
+def tracked(service: str, method: str, failed: Callable[[Any], bool] | None = None):
+    """Декоратор для внешних вызовов. failed — для API, которые возвращают ошибку вместо исключения."""
+    latency = EXTERNAL_LATENCY.labels(service, method)
+    errors = EXTERNAL_ERRORS.labels(service, method)
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                latency.observe(time.perf_counter() - start)
+            if failed is not None and failed(result): errors.inc()
+            return result
+        return wrapper
+    return decorator
+
+def setup(dp: Dispatcher, bot: Bot) -> None:
+    middleware = HandlerMetricsMiddleware()
+    dp.message.middleware(middleware)
+    dp.callback_query.middleware(middleware)
+    dp.pre_checkout_query.middleware(middleware)
+    bot.session.middleware(TelegramRequestMetrics())
+
+_ready: dict[str, bool] = {}
+_required: set[str] = set()
+
+def expect(component: str, required: bool = True) -> None:
+    _ready.setdefault(component, False)
+    if required: _required.add(component)
+
+def set_ready(component: str, ok: bool = True) -> None:
+    _ready[component] = ok
+
+def is_ready() -> bool:
+    return all(_ready.get(component) for component in _required)
+
+register_gauge("bot_ready", "1 when all required dependencies are up", lambda: float(is_ready()))
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(body=generate_latest(REGISTRY), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+async def ready_handler(request: web.Request) -> web.Response:
+    ready = is_ready()
+    return web.json_response({"ready": ready, "components": _ready}, status=200 if ready else 503)
+
+app = web.Application()
+app.router.add_get("/metrics", metrics_handler)
+app.router.add_get("/ready", ready_handler)
+
+async def start_server(port: int) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    logger.info(f"📈 Метрики доступны на :{port}/metrics, готовность — :{port}/ready")
+    return runner
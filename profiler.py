@@ -0,0 +1,110 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+import metrics
+from config import logger, LOOP_LAG_INTERVAL, LOOP_STALL_THRESHOLD
+
+HANDLER_MODULES = {"bot", "__main__"}
+SAMPLE_INTERVAL = 0.005
+
+_profile_lock = asyncio.Lock()
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+def _collapse(frame) -> str:
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+def sample_stacks(thread_id: int, seconds: float, interval: float = SAMPLE_INTERVAL) -> Counter:
+    stacks: Counter = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None: stacks[_collapse(frame)] += 1
+        time.sleep(interval)
+    return stacks
+
+def is_profiling() -> bool:
+    return _profile_lock.locked()
+
+async def profile(seconds: float) -> bytes:
+    """Семплирует стек потока event loop и возвращает collapsed stacks (формат flamegraph.pl / speedscope)."""
+    loop_thread = threading.get_ident()
+    async with _profile_lock:
+        stacks = await asyncio.to_thread(sample_stacks, loop_thread, seconds)
+    return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common()).encode()
+
+def handler_name(frame) -> str:
+    """Ближайшая к месту блокировки функция из bot.py — обычно это хендлер."""
+    while frame is not None:
+        if frame.f_globals.get("__name__") in HANDLER_MODULES and frame.f_code.co_name != "main":
+            return frame.f_code.co_name
+        frame = frame.f_back
+    return "unknown"
+
+class LoopMonitor:
+    """Меряет лаг event loop и ловит блокирующие вызовы.
+
+    Корутина раз в interval просыпается и обновляет heartbeat; лаг пробуждения уходит в
+    метрики. Отдельный поток-сторож, если heartbeat не обновлялся дольше порога, снимает
+    стек потока loop и пишет в лог, какой хендлер его занял.
+    """
+
+    def __init__(self, interval: float, stall_threshold: float):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self._heartbeat = time.monotonic()
+        self._loop_thread: int | None = None
+        self._task: asyncio.Task | None = None
+        self._watchdog: threading.Thread | None = None
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._beat())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self) -> None:
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _beat(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - started - self.interval, 0)
+            metrics.EVENT_LOOP_LAG.observe(lag)
+            if lag > self.stall_threshold:
+                logger.warning(f"⏱ Event loop отстал на {lag * 1000:.0f} мс")
+            self._heartbeat = time.monotonic()
+
+    def _watch(self) -> None:
+        reported = None
+        while not self._stopped.wait(self.interval):
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat - self.interval
+            if stalled < self.stall_threshold or reported == heartbeat: continue
+
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None: continue
+            reported = heartbeat
+            stack = "".join(traceback.format_stack(frame)[-12:])
+            logger.warning(f"🧱 Event loop заблокирован {stalled * 1000:.0f} мс в {handler_name(frame)}:\n{stack}")
+
+monitor = LoopMonitor(LOOP_LAG_INTERVAL, LOOP_STALL_THRESHOLD)
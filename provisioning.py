@@ -0,0 +1,155 @@
+import asyncio
+import uuid
+from typing import NamedTuple
+
+import asyncpg
+
+import database
+import metrics
+import queries
+import user_cache
+import xui_api
+from config import logger, PROVISIONING_DRAIN_INTERVAL, XUI_HANDLER_DEADLINE
+
+DRAIN_BATCH = 50
+
+DEFER = queries.Query("provisioning_defer", """
+INSERT INTO pending_provisioning (user_id, uuid, expiry_ms) VALUES ($1, $2, $3)
+ON CONFLICT (user_id) DO UPDATE SET uuid = EXCLUDED.uuid, expiry_ms = EXCLUDED.expiry_ms, updated_at = NOW()
+""")
+PENDING_USERS = queries.Query("provisioning_pending_users", "SELECT user_id FROM pending_provisioning")
+NEXT_BATCH = queries.Query("provisioning_next_batch", "SELECT user_id, uuid, expiry_ms FROM pending_provisioning ORDER BY updated_at LIMIT $1")
+BUMP_ATTEMPTS = queries.Query("provisioning_bump_attempts", "UPDATE pending_provisioning SET attempts = attempts + 1 WHERE user_id = $1")
+COMPLETE = queries.Query(
+    "provisioning_complete", "DELETE FROM pending_provisioning WHERE user_id = $1 AND uuid = $2 AND expiry_ms = $3 RETURNING user_id"
+)
+
+class Grant(NamedTuple):
+    user_id: int
+    uuid: str
+    expiry_ms: int
+    is_new: bool
+
+class ProvisioningQueue:
+    """Выдача доступа в X-UI, которая не блокирует хендлеры, когда панель недоступна.
+
+    Подписка всегда сначала пишется в базу. Если circuit breaker открыт, вызов панели
+    упал или по пользователю уже есть отложенная выдача, актуальные uuid/expiry
+    сохраняются в pending_provisioning, и фоновый воркер применяет их, когда панель
+    снова отвечает. Строка удаляется только если за время вызова её не перезаписали.
+    """
+
+    def __init__(self, drain_interval: float):
+        self.drain_interval = drain_interval
+        self._pending: set[int] = set()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    async def provision(self, user_id: int, uuid_str: str, expiry_ms: int, is_new: bool = False) -> bool:
+        """True — клиент уже обновлен в панели, False — выдача отложена.
+
+        Соединение из пула на время вызова панели не держим: медленная X-UI не должна
+        выедать пул. Оно берется только на короткий defer после неудачи. Пользователь
+        ждет панель не дольше XUI_HANDLER_DEADLINE, остальное дотянет воркер.
+        """
+        email = f"user_{user_id}"
+        if user_id not in self._pending and not xui_api.breaker.is_open():
+            try:
+                if is_new:
+                    await xui_api.add_client_via_xui_api(uuid_str, email, limit_ip=1, expiry_time=expiry_ms, deadline=XUI_HANDLER_DEADLINE)
+                else:
+                    await xui_api.update_client_via_xui_api(uuid_str, email, expiry_ms, deadline=XUI_HANDLER_DEADLINE)
+                return True
+            except Exception as e:
+                logger.warning(f"⚠️ X-UI не принял {email}: {e}. Откладываем выдачу.")
+
+        async with database.db_pool.acquire() as conn:
+            await self.defer(conn, user_id, uuid_str, expiry_ms)
+        return False
+
+    async def defer(self, conn: asyncpg.Connection, user_id: int, uuid_str: str, expiry_ms: int) -> None:
+        await DEFER.execute(conn, user_id, uuid_str, expiry_ms)
+        self._pending.add(user_id)
+        self._wakeup.set()
+
+    async def start(self) -> None:
+        if not database.db_pool: return
+        async with database.db_pool.acquire() as conn:
+            rows = await PENDING_USERS.fetch(conn)
+        self._pending = {row["user_id"] for row in rows}
+        if rows: logger.info(f"⏳ В очереди {len(rows)} отложенных выдач ключей")
+        self._task = asyncio.create_task(self._drain_loop())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _drain_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.drain_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not self._pending or xui_api.breaker.is_open(): continue
+            try:
+                await self.drain()
+            except Exception as e:
+                logger.error(f"Ошибка отложенной выдачи ключей: {e}")
+
+    async def drain(self) -> None:
+        known = set(self._pending)
+        async with database.db_pool.acquire() as conn:
+            rows = await NEXT_BATCH.fetch(conn, DRAIN_BATCH)
+        # id без строки в таблице — defer из откатившейся транзакции
+        if len(rows) < DRAIN_BATCH: self._pending -= known - {row["user_id"] for row in rows}
+
+        done = 0
+        for row in rows:
+            if xui_api.breaker.is_open(): break
+            user_id = row["user_id"]
+            try:
+                await xui_api.update_client_via_xui_api(row["uuid"], f"user_{user_id}", row["expiry_ms"])
+            except Exception as e:
+                logger.warning(f"⚠️ Отложенная выдача user_{user_id} не удалась: {e}")
+                async with database.db_pool.acquire() as conn:
+                    await BUMP_ATTEMPTS.execute(conn, user_id)
+                continue
+
+            async with database.db_pool.acquire() as conn:
+                deleted = await COMPLETE.fetchval(conn, user_id, row["uuid"], row["expiry_ms"])
+            if deleted:
+                self._pending.discard(user_id)
+                done += 1
+            else:
+                self._wakeup.set()
+
+        if done: logger.info(f"✅ Выдано {done} отложенных ключей, осталось {len(self._pending)}")
+        if len(rows) == DRAIN_BATCH and not xui_api.breaker.is_open(): self._wakeup.set()
+
+queue = ProvisioningQueue(PROVISIONING_DRAIN_INTERVAL)
+
+async def prepare(conn: asyncpg.Connection, row: asyncpg.Record) -> Grant:
+    """Часть выдачи в базе, на соединении вызывающего: uuid, если его еще нет, и срок из row.
+
+    Клиента, удаленного из панели очисткой (xui_state = 'deleted'), push создаст заново.
+    """
+    user_id = row["user_id"]
+    uuid_str = row["uuid"] or str(uuid.uuid4())
+    if not row["uuid"] or row["xui_state"]:
+        await queries.SET_UUID.execute(conn, user_id, uuid_str)
+        user_cache.users.update(user_id, uuid=uuid_str, xui_state=None)
+    expiry_ms = int(row["expiry_date"].timestamp() * 1000)
+    return Grant(user_id, uuid_str, expiry_ms, is_new=not row["uuid"] or row["xui_state"] == "deleted")
+
+async def push(grant: Grant) -> bool:
+    """Отправляет подготовленную выдачу в панель — уже после того, как соединение отдано в пул.
+    True — выдано сразу, False — отложено."""
+    return await queue.provision(grant.user_id, grant.uuid, grant.expiry_ms, is_new=grant.is_new)
+
+metrics.register_gauge("xui_pending_provisioning", "Grants waiting for the X-UI panel", lambda: float(len(queue)))
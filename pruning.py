@@ -0,0 +1,92 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import database
+import provisioning
+import queries
+import user_cache
+import xui_api
+from config import logger, XUI_DISABLE_AFTER_DAYS, XUI_DELETE_AFTER_DAYS, XUI_PRUNE_INTERVAL, XUI_PRUNE_BATCH
+
+CANDIDATES = queries.Query("prune_candidates", """
+SELECT user_id, uuid, expiry_date FROM users
+WHERE expiry_date < $1 AND uuid IS NOT NULL AND (xui_state IS NULL OR xui_state <> ALL($2::text[]))
+ORDER BY expiry_date LIMIT $3
+""")
+MARK = queries.Query(
+    "prune_mark", "UPDATE users SET xui_state = $2 WHERE user_id = ANY($1::bigint[]) AND expiry_date < $3 RETURNING user_id"
+)
+RENEWED = queries.Query("prune_renewed", "SELECT user_id, uuid, expiry_date FROM users WHERE user_id = ANY($1::bigint[])")
+
+class ExpiredClientPruner:
+    """Чистит инбаунд от давно истекших клиентов, чтобы settings JSON не рос бесконечно.
+
+    Истекшие дольше disable_after клиенты выключаются (xui_state = 'disabled'), дольше
+    delete_after — удаляются из панели (xui_state = 'deleted'). Пачками, по одному логину
+    на пачку, и с остановкой, если панель начала сбоить. При продлении provisioning.prepare
+    видит 'deleted', и push сразу создает клиента заново, без попытки update.
+    """
+
+    def __init__(self, disable_after: timedelta, delete_after: timedelta, interval: float, batch: int):
+        self.disable_after = disable_after
+        self.delete_after = delete_after
+        self.interval = interval
+        self.batch = batch
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                disabled = await self.run("disabled", self.disable_after)
+                deleted = await self.run("deleted", self.delete_after)
+                if disabled or deleted: logger.info(f"🧹 X-UI: выключено {disabled}, удалено {deleted} истекших клиентов")
+            except Exception as e:
+                logger.error(f"Ошибка очистки X-UI: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def run(self, state: str, grace: timedelta) -> int:
+        if not database.db_pool or xui_api.breaker.is_open(): return 0
+        previous = ("disabled", "deleted") if state == "disabled" else ("deleted",)
+        total = 0
+        while True:
+            cutoff = datetime.now() - grace
+            async with database.db_pool.acquire() as conn:
+                rows = await CANDIDATES.fetch(conn, cutoff, list(previous), self.batch)
+            if not rows: return total
+
+            if state == "disabled":
+                clients = [(row["uuid"], f"user_{row['user_id']}", int(row["expiry_date"].timestamp() * 1000)) for row in rows]
+                done = {email for _, email, _ in await xui_api.disable_clients_via_xui_api(clients)}
+            else:
+                done = set(await xui_api.delete_clients_via_xui_api([f"user_{row['user_id']}" for row in rows]))
+            user_ids = [row["user_id"] for row in rows if f"user_{row['user_id']}" in done]
+            if user_ids: await self._mark(user_ids, state, cutoff)
+
+            total += len(user_ids)
+            if len(user_ids) < len(rows) or len(rows) < self.batch: return total
+
+    async def _mark(self, user_ids: list[int], state: str, cutoff: datetime) -> None:
+        async with database.db_pool.acquire() as conn:
+            async with conn.transaction():
+                marked = await MARK.fetch(conn, user_ids, state, cutoff)
+                # продлили, пока мы ходили в панель: возвращаем клиента через очередь выдачи
+                renewed = set(user_ids) - {row["user_id"] for row in marked}
+                if renewed:
+                    rows = await RENEWED.fetch(conn, list(renewed))
+                    for row in rows:
+                        await provisioning.queue.defer(conn, row["user_id"], row["uuid"], int(row["expiry_date"].timestamp() * 1000))
+
+        for row in marked: user_cache.users.update(row["user_id"], xui_state=state)
+
+pruner = ExpiredClientPruner(
+    timedelta(days=XUI_DISABLE_AFTER_DAYS), timedelta(days=XUI_DELETE_AFTER_DAYS), XUI_PRUNE_INTERVAL, XUI_PRUNE_BATCH
+)
@@ -0,0 +1,167 @@
+import time
+from typing import Any
+
+import asyncpg
+from prometheus_client import Counter, Histogram
+
+import metrics
+
+DB_QUERY_LATENCY = Histogram("db_query_seconds", "Latency of named SQL queries", ["query"], buckets=metrics.LATENCY_BUCKETS)
+DB_QUERY_ERRORS = Counter("db_query_errors_total", "Failed named SQL queries", ["query"])
+
+class Query:
+    """Именованный SQL-запрос.
+
+    Текст задается один раз, поэтому asyncpg готовит его на каждом соединении единожды и
+    дальше берет prepared statement из своего кэша (statement_cache_size). Каждый вызов
+    пишется в db_query_seconds{query=name} и в счетчики calls/total для /queries.
+    """
+
+    registry: dict[str, "Query"] = {}
+
+    def __init__(self, name: str, sql: str):
+        if name in Query.registry: raise ValueError(f"query {name!r} already defined")
+        self.name = name
+        self.sql = sql
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self._latency = DB_QUERY_LATENCY.labels(name)
+        Query.registry[name] = self
+
+    async def fetch(self, conn: asyncpg.Connection, *args) -> list[asyncpg.Record]:
+        return await self._run(conn.fetch, args)
+
+    async def fetchrow(self, conn: asyncpg.Connection, *args) -> asyncpg.Record | None:
+        return await self._run(conn.fetchrow, args)
+
+    async def fetchval(self, conn: asyncpg.Connection, *args) -> Any:
+        return await self._run(conn.fetchval, args)
+
+    async def execute(self, conn: asyncpg.Connection, *args) -> str:
+        return await self._run(conn.execute, args)
+
+    async def _run(self, method, args: tuple) -> Any:
+        start = time.perf_counter()
+        try:
+            return await method(self.sql, *args)
+        except Exception:
+            self.errors += 1
+            DB_QUERY_ERRORS.labels(self.name).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.calls += 1
+            self.total += elapsed
+            self._latency.observe(elapsed)
+
+def top(limit: int = 10) -> list[Query]:
+    """Запросы, на которые ушло больше всего времени базы с момента старта."""
+    return sorted((q for q in Query.registry.values() if q.calls), key=lambda q: q.total, reverse=True)[:limit]
+
+GET_USER = Query("get_user", "SELECT * FROM users WHERE user_id = $1")
+
+REGISTER_USER = Query("register_user", """
+WITH ref AS (
+    SELECT user_id FROM users
+    WHERE user_id <> $1 AND (custom_id = $3 OR user_id = $4)
+    ORDER BY custom_id = $3 DESC NULLS LAST
+    LIMIT 1
+), ins AS (
+    INSERT INTO users (user_id, username, custom_id, referrer_id)
+    VALUES ($1, $2, make_custom_id(nextval('users_custom_id_seq')), (SELECT user_id FROM ref))
+    ON CONFLICT (user_id) DO NOTHING
+    RETURNING *
+), bumped AS (
+    INSERT INTO daily_stats (day, new_users, referred_users)
+    SELECT CURRENT_DATE, 1, (referrer_id IS NOT NULL)::int FROM ins
+    ON CONFLICT (day) DO UPDATE SET new_users = daily_stats.new_users + 1, referred_users = daily_stats.referred_users + EXCLUDED.referred_users
+), rewarded AS (
+    INSERT INTO pending_referral_rewards (referrer_id, signups)
+    SELECT referrer_id, 1 FROM ins WHERE referrer_id IS NOT NULL
+    ON CONFLICT (referrer_id) DO UPDATE SET signups = pending_referral_rewards.signups + 1
+)
+SELECT TRUE AS is_new, * FROM ins
+UNION ALL
+SELECT FALSE AS is_new, * FROM users WHERE user_id = $1 AND NOT EXISTS (SELECT 1 FROM ins)
+""")
+
+# оплата (30 дней) и реферальная награда: продление от max(текущий срок, сейчас)
+EXTEND_SUBSCRIPTION = Query("extend_subscription", """
+UPDATE users SET expiry_date = GREATEST(expiry_date, NOW()) + make_interval(days => $2),
+                 expired_notification_sent = FALSE
+WHERE user_id = $1 RETURNING *
+""")
+
+# оплата зачисляется один раз: повторный апдейт или второе «Проверить оплату» с тем же
+# платежом упирается в PRIMARY KEY payments и ничего не продлевает (вернет None)
+CREDIT_PAYMENT = Query("credit_payment", """
+WITH paid AS (
+    INSERT INTO payments (method, payment_id, user_id)
+    SELECT $3, $4, $1 WHERE EXISTS (SELECT 1 FROM users WHERE user_id = $1)
+    ON CONFLICT DO NOTHING RETURNING user_id
+)
+UPDATE users SET expiry_date = GREATEST(expiry_date, NOW()) + make_interval(days => $2),
+                 expired_notification_sent = FALSE
+WHERE user_id = (SELECT user_id FROM paid) RETURNING *
+""")
+
+# раз в сутки: проверка и продление одним UPDATE, второй параллельный claim ничего не вернет
+CLAIM_BONUS = Query("claim_bonus", """
+UPDATE users SET expiry_date = GREATEST(expiry_date, NOW()) + make_interval(hours => $2), last_bonus_claim = NOW()
+WHERE user_id = $1 AND (last_bonus_claim IS NULL OR last_bonus_claim <= NOW() - INTERVAL '1 day')
+RETURNING *
+""")
+
+# правка дней админом: $2 = 0 — истекает сейчас, иначе ±$2 дней от max(текущий срок, сейчас).
+# Считается от строки под блокировкой, поэтому оплату, прошедшую параллельно, не затирает.
+# Если подписка после правки истекла, уведомление шлет сам хендлер — чекер ее пропускает
+ADJUST_DAYS = Query("adjust_days", """
+UPDATE users SET
+    expiry_date = CASE WHEN $2 = 0 THEN NOW() - INTERVAL '1 minute'
+                       ELSE GREATEST(expiry_date, NOW()) + make_interval(days => $2) END,
+    expired_notification_sent = CASE WHEN $2 = 0 THEN TRUE
+                                     ELSE GREATEST(expiry_date, NOW()) + make_interval(days => $2) < NOW() END
+WHERE user_id = $1 RETURNING *
+""")
+
+SET_UUID = Query("set_uuid", "UPDATE users SET uuid = $2, xui_state = NULL WHERE user_id = $1")
+
+SET_SUPPORT_TIME = Query("set_support_time", "UPDATE users SET last_support_time = $2 WHERE user_id = $1 RETURNING *")
+
+SET_REFERRAL_COUNT = Query("set_referral_count", "UPDATE users SET referral_count = $2 WHERE user_id = $1 RETURNING *")
+
+ADD_REFERRALS = Query("add_referrals", "UPDATE users SET referral_count = referral_count + $2 WHERE user_id = $1 RETURNING *")
+
+EXPIRED_UNNOTIFIED = Query("expired_unnotified", """
+SELECT user_id, expiry_date FROM users
+WHERE expiry_date < NOW() AND (expired_notification_sent IS FALSE OR expired_notification_sent IS NULL)
+  AND unreachable_at IS NULL
+""")
+
+# список истекших может прийти с реплики: продление, которое она еще не видела, здесь не пройдет
+MARK_EXPIRED_NOTIFIED = Query("mark_expired_notified", """
+UPDATE users SET expired_notification_sent = TRUE
+WHERE user_id = $1 AND expiry_date < NOW() AND expired_notification_sent IS NOT TRUE
+RETURNING user_id
+""")
+
+# временная ошибка отправки: напомним при следующем проходе
+UNMARK_EXPIRED_NOTIFIED = Query("unmark_expired_notified", "UPDATE users SET expired_notification_sent = FALSE WHERE user_id = $1")
+
+MARK_UNREACHABLE = Query("mark_unreachable", """
+UPDATE users u SET unreachable_at = NOW(), unreachable_reason = f.reason
+FROM unnest($1::bigint[], $2::text[]) AS f(user_id, reason)
+WHERE u.user_id = f.user_id
+RETURNING u.user_id, u.unreachable_at, u.unreachable_reason
+""")
+
+MARK_REACHABLE = Query("mark_reachable", "UPDATE users SET unreachable_at = NULL, unreachable_reason = NULL WHERE user_id = $1")
+
+# фильтр админ-списка одной формы: $1 — активны после (NULL — все), $2 — поиск (NULL — без поиска)
+ADMIN_USERS_WHERE = "($1::timestamp IS NULL OR expiry_date > $1) AND ($2::text IS NULL OR username ILIKE $2 OR CAST(user_id AS TEXT) = $2 OR custom_id = $2)"
+ADMIN_USERS_COUNT = Query("admin_users_count", f"SELECT COUNT(*) FROM users WHERE {ADMIN_USERS_WHERE}")
+ADMIN_USERS_PAGE = Query("admin_users_page", f"""
+SELECT user_id, custom_id, username, referral_count, expiry_date, uuid FROM users
+WHERE {ADMIN_USERS_WHERE} ORDER BY user_id LIMIT 1 OFFSET $3
+""")
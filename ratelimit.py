@@ -0,0 +1,149 @@
+import asyncio
+import time
+from collections import deque
+from contextvars import ContextVar
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from prometheus_client import Counter, Histogram
+
+import metrics
+from config import logger, TG_GLOBAL_RATE, TG_CHAT_RATE, TG_CHAT_BURST, TG_GROUP_RATE, TG_MAX_RETRIES
+
+INTERACTIVE, TRANSACTIONAL, BULK = 0, 1, 2
+PRIORITY_NAMES = ("interactive", "transactional", "bulk")
+
+# на что распространяются лимиты Telegram; answerCallbackQuery, getChatMember и т.п. идут мимо.
+# Правки сообщений считаются в глобальном лимите, но не в лимите чата (его Telegram ставит на новые сообщения)
+LIMITED_PREFIXES = ("send", "copyMessage", "forwardMessage", "editMessage")
+CHAT_LIMITED_PREFIXES = ("send", "copyMessage", "forwardMessage")
+
+SEND_WAIT = Histogram("telegram_send_wait_seconds", "Time an outgoing message waited for the rate limiter", ["priority"], buckets=metrics.LATENCY_BUCKETS)
+RETRY_AFTER = Counter("telegram_retry_after_total", "429 Too Many Requests answers, retried by the rate limiter", ["priority"])
+
+_priority: ContextVar[int] = ContextVar("telegram_priority", default=INTERACTIVE)
+
+def set_priority(priority: int) -> None:
+    """Приоритет исходящих сообщений текущей задачи. Хендлеры по умолчанию — INTERACTIVE;
+    фоновые задачи вызывают это в начале (контекст задачи свой, соседей не задевает)."""
+    _priority.set(priority)
+
+class TelegramRateLimiter(BaseRequestMiddleware):
+    """Общий для процесса планировщик исходящих сообщений.
+
+    Глобальный лимит (global_rate сообщений/с) выдается строго по приоритету: пока есть
+    ждущие INTERACTIVE, TRANSACTIONAL и BULK не получают слотов, поэтому рассылка не
+    задерживает ответы пользователям больше чем на один интервал. На каждый чат —
+    GCRA с burst (личка: chat_rate/с, группы и каналы: group_rate/с). TelegramRetryAfter
+    обрабатывается здесь: чат ставится на паузу, BULK при этом тормозится целиком, а
+    запрос повторяется до max_retries раз.
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int, group_rate: float, max_retries: int):
+        self.interval = 1 / global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._next_slot = 0.0
+        self._bulk_paused_until = 0.0
+        self._waiters: tuple[deque[asyncio.Future], ...] = (deque(), deque(), deque())
+        self._pump_task: asyncio.Task | None = None
+        self._wakeup = asyncio.Event()
+        self._chat_tat: dict[int | str, float] = {}
+
+    def waiting(self, priority: int) -> int:
+        return len(self._waiters[priority])
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        if not name.startswith(LIMITED_PREFIXES): return await make_request(bot, method)
+
+        priority = _priority.get()
+        chat_id = getattr(method, "chat_id", None)
+        per_chat = chat_id is not None and name.startswith(CHAT_LIMITED_PREFIXES)
+        for attempt in range(self.max_retries + 1):
+            start = time.monotonic()
+            if per_chat: await self._chat_slot(chat_id)
+            await self._global_slot(priority)
+            SEND_WAIT.labels(PRIORITY_NAMES[priority]).observe(time.monotonic() - start)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                RETRY_AFTER.labels(PRIORITY_NAMES[priority]).inc()
+                self._retry_after(chat_id, e.retry_after)
+                if attempt == self.max_retries: raise
+                logger.warning(f"⏳ Telegram 429 на {name} ({chat_id}), повтор через {e.retry_after} с")
+
+    def _retry_after(self, chat_id, seconds: float) -> None:
+        until = time.monotonic() + seconds
+        if chat_id is not None:
+            _, tolerance = self._chat_limits(chat_id)
+            self._chat_tat[chat_id] = max(self._chat_tat.get(chat_id, 0), until + tolerance)
+        self._bulk_paused_until = max(self._bulk_paused_until, until)
+
+    def _chat_limits(self, chat_id) -> tuple[float, float]:
+        """(период между сообщениями, допуск на burst) для чата."""
+        if isinstance(chat_id, int) and chat_id > 0:
+            period = 1 / self.chat_rate
+            return period, (self.chat_burst - 1) * period
+        return 1 / self.group_rate, 0
+
+    async def _chat_slot(self, chat_id) -> None:
+        period, tolerance = self._chat_limits(chat_id)
+        now = time.monotonic()
+        tat = max(self._chat_tat.get(chat_id, now), now)
+        wait = tat - tolerance - now
+        self._chat_tat[chat_id] = tat + period
+        if len(self._chat_tat) > 10000: self._prune(now)
+        if wait > 0: await asyncio.sleep(wait)
+
+    def _prune(self, now: float) -> None:
+        self._chat_tat = {chat_id: tat for chat_id, tat in self._chat_tat.items() if tat > now}
+
+    async def _global_slot(self, priority: int) -> None:
+        now = time.monotonic()
+        if not any(self._waiters) and now >= self._next_slot and (priority != BULK or now >= self._bulk_paused_until):
+            self._next_slot = max(self._next_slot, now) + self.interval
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[priority].append(future)
+        self._wakeup.set()
+        if self._pump_task is None or self._pump_task.done(): self._pump_task = asyncio.create_task(self._pump())
+        try:
+            await future
+        except asyncio.CancelledError:
+            if not future.done(): self._waiters[priority].remove(future)
+            raise
+
+    async def _pump(self) -> None:
+        """Раздает глобальные слоты ждущим по одному, старший приоритет первым."""
+        while any(self._waiters):
+            now = time.monotonic()
+            if now < self._next_slot:
+                await asyncio.sleep(self._next_slot - now)
+                continue
+            lane = next((queue for p, queue in enumerate(self._waiters) if queue and (p != BULK or now >= self._bulk_paused_until)), None)
+            if lane is None:
+                # ждут только BULK на паузе после 429 — просыпаемся раньше, если придет кто-то важнее
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self._bulk_paused_until - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            future = lane.popleft()
+            if future.done(): continue
+            future.set_result(None)
+            self._next_slot = max(self._next_slot, now) + self.interval
+
+limiter = TelegramRateLimiter(TG_GLOBAL_RATE, TG_CHAT_RATE, TG_CHAT_BURST, TG_GROUP_RATE, TG_MAX_RETRIES)
+
+metrics.register_gauge("telegram_send_waiting_interactive", "Replies to users waiting for a send slot", lambda: float(limiter.waiting(INTERACTIVE)))
+metrics.register_gauge("telegram_send_waiting_transactional", "Notifications waiting for a send slot", lambda: float(limiter.waiting(TRANSACTIONAL)))
+metrics.register_gauge("telegram_send_waiting_bulk", "Broadcast messages waiting for a send slot", lambda: float(limiter.waiting(BULK)))
+
+def setup(bot: Bot) -> None:
+    """Регистрировать до metrics.setup: тогда метрики Telegram меряют сам запрос, а не очередь."""
+    bot.session.middleware(limiter)
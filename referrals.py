@@ -0,0 +1,157 @@
+import asyncio
+import random
+from datetime import datetime, timedelta
+
+import database
+import provisioning
+import queries
+import ratelimit
+import stats
+import xui_api
+import user_cache
+from config import logger, REFERRAL_WORKERS, REFERRAL_COALESCE_SECONDS, REFERRAL_RETRY_BASE, REFERRAL_RETRY_MAX
+from utils import safe_bot_send_message, PENDING_NOTE
+
+REWARD_EVERY = 5
+REWARD_DAYS = 3
+
+PENDING_SIGNUPS = queries.Query("referral_pending_signups", "SELECT signups FROM pending_referral_rewards WHERE referrer_id = $1")
+CONSUME_SIGNUPS = queries.Query(
+    "referral_consume_signups", "UPDATE pending_referral_rewards SET signups = signups - $2, attempts = 0 WHERE referrer_id = $1"
+)
+DELETE_CONSUMED = queries.Query("referral_delete_consumed", "DELETE FROM pending_referral_rewards WHERE referrer_id = $1 AND signups <= 0")
+PENDING_REWARDS = queries.Query("referral_pending_rewards", "SELECT referrer_id, next_attempt_at FROM pending_referral_rewards")
+BUMP_ATTEMPTS = queries.Query(
+    "referral_bump_attempts", "UPDATE pending_referral_rewards SET attempts = attempts + 1 WHERE referrer_id = $1 RETURNING attempts"
+)
+SET_NEXT_ATTEMPT = queries.Query(
+    "referral_set_next_attempt", "UPDATE pending_referral_rewards SET next_attempt_at = $2 WHERE referrer_id = $1"
+)
+
+class ReferralRewardQueue:
+    """Очередь начислений за рефералов.
+
+    Каждый новый реферал сначала сохраняется в pending_referral_rewards, а затем
+    referrer_id ставится в очередь с небольшой задержкой: все регистрации, пришедшие
+    за это окно, обрабатываются одним расчетом. Ошибки ретраятся с backoff, а
+    необработанные начисления переживают рестарт.
+    """
+
+    def __init__(self, workers: int, coalesce_seconds: float):
+        self.workers = workers
+        self.coalesce_seconds = coalesce_seconds
+        self._queue: asyncio.Queue[int] = asyncio.Queue()
+        self._scheduled: set[int] = set()
+        self._timers: dict[int, asyncio.TimerHandle] = {}
+        self._tasks: list[asyncio.Task] = []
+        self._stopping = False
+
+    def signed_up(self, referrer_id: int) -> None:
+        """Строку в pending_referral_rewards уже записал user_cache.register_user."""
+        self.schedule(referrer_id, self.coalesce_seconds)
+
+    def schedule(self, referrer_id: int, delay: float = 0) -> None:
+        if referrer_id in self._scheduled: return
+        self._scheduled.add(referrer_id)
+        if delay > 0:
+            loop = asyncio.get_running_loop()
+            self._timers[referrer_id] = loop.call_later(delay, self._release, referrer_id)
+        else:
+            self._queue.put_nowait(referrer_id)
+
+    def _release(self, referrer_id: int) -> None:
+        self._timers.pop(referrer_id, None)
+        self._queue.put_nowait(referrer_id)
+
+    async def start(self) -> None:
+        if not database.db_pool: return
+        async with database.db_pool.acquire() as conn:
+            rows = await PENDING_REWARDS.fetch(conn)
+
+        now = datetime.now()
+        for row in rows:
+            delay = (row["next_attempt_at"] - now).total_seconds() if row["next_attempt_at"] else 0
+            self.schedule(row["referrer_id"], max(delay, 0))
+        if rows: logger.info(f"🎁 Восстановлено {len(rows)} отложенных начислений за рефералов")
+
+        self._stopping = False
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for timer in self._timers.values(): timer.cancel()
+        self._timers.clear()
+        self._stopping = True
+        for task in self._tasks: task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self) -> None:
+        ratelimit.set_priority(ratelimit.TRANSACTIONAL)
+        # флаг, а не только cancel(): на 3.11 asyncio.wait_for внутри вызова X-UI может проглотить отмену
+        while not self._stopping:
+            referrer_id = await self._queue.get()
+            self._scheduled.discard(referrer_id)
+            try:
+                await self._process(referrer_id)
+            except Exception as e:
+                await self._retry_later(referrer_id, e)
+            finally:
+                self._queue.task_done()
+
+    async def _process(self, referrer_id: int) -> None:
+        if not database.db_pool: return
+        logger.info(f"🎁 Начисляем награду рефереру {referrer_id}...")
+
+        grant: provisioning.Grant | None = None
+        # в транзакции только база; панель и Telegram — после того, как соединение вернулось в пул
+        async with database.db_pool.acquire() as conn:
+            async with conn.transaction():
+                signups = await PENDING_SIGNUPS.fetchval(conn, referrer_id)
+                if not signups: return
+
+                row = await queries.ADD_REFERRALS.fetchrow(conn, referrer_id, signups)
+                if row:
+                    count = row["referral_count"]
+                    rewards = count // REWARD_EVERY - (count - signups) // REWARD_EVERY
+                    if rewards > 0:
+                        row = await queries.EXTEND_SUBSCRIPTION.fetchrow(conn, referrer_id, REWARD_DAYS * rewards)
+                        had_uuid = bool(row["uuid"])
+                        grant = await provisioning.prepare(conn, row)
+                        await stats.bump(conn, referral_rewards=rewards)
+                        row = await queries.GET_USER.fetchrow(conn, referrer_id)
+
+                await CONSUME_SIGNUPS.execute(conn, referrer_id, signups)
+                await DELETE_CONSUMED.execute(conn, referrer_id)
+
+        if row: user_cache.users.put(row)
+        if grant:
+            provisioned = await provisioning.push(grant)
+            try:
+                await safe_bot_send_message(referrer_id, self._notice(grant, rewards, had_uuid, provisioned), parse_mode="HTML")
+            except: pass
+
+    def _notice(self, grant: provisioning.Grant, rewards: int, had_uuid: bool, provisioned: bool) -> str:
+        days = REWARD_DAYS * rewards
+        title = f"🎉 <b>Бонус ({REWARD_EVERY * rewards} друзей)!</b>"
+        note = "" if provisioned else PENDING_NOTE
+
+        if not had_uuid:
+            key = xui_api.generate_vless_link(grant.uuid, f"user_{grant.user_id}")
+            return f"{title}\nВаш ключ (+{days} дн.):\n<code>{key}</code>{note}"
+        return f"{title}\nВам добавлено {days} дн. VPN!{note}"
+
+    async def _retry_later(self, referrer_id: int, error: Exception) -> None:
+        attempts = 1
+        delay = REFERRAL_RETRY_BASE
+        try:
+            async with database.db_pool.acquire() as conn:
+                attempts = await BUMP_ATTEMPTS.fetchval(conn, referrer_id) or 1
+                delay = min(REFERRAL_RETRY_BASE * 2 ** (attempts - 1), REFERRAL_RETRY_MAX) * random.uniform(0.8, 1.2)
+                await SET_NEXT_ATTEMPT.execute(conn, referrer_id, datetime.now() + timedelta(seconds=delay))
+        except Exception as e:
+            logger.error(f"Не удалось сохранить повтор начисления {referrer_id}: {e}")
+
+        logger.error(f"❌ Ошибка начисления рефереру {referrer_id} (попытка {attempts}): {error}. Повтор через {int(delay)} с.")
+        self.schedule(referrer_id, delay)
+
+rewards = ReferralRewardQueue(REFERRAL_WORKERS, REFERRAL_COALESCE_SECONDS)
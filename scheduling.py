@@ -0,0 +1,171 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware, Dispatcher
+from aiogram.types import TelegramObject, Update, User
+from prometheus_client import Counter, Histogram
+
+import database
+import metrics
+from config import logger, MAX_CONCURRENT_UPDATES, ADMIN_ID, ADMISSION_MAX_WAITING, ADMISSION_MAX_POOL_WAIT
+
+BUSY_TEXT = "⏳ Сейчас много запросов, попробуйте через пару секунд."
+# подтверждения оплаты («Проверить оплату» CryptoPay и «Я оплатил» Lava) не отбрасываем никогда
+CRITICAL_CALLBACKS = ("check_", "L_")
+
+UPDATE_QUEUE_WAIT = Histogram("bot_update_queue_wait_seconds", "Time an update waited for its user lane and a global handler slot", buckets=metrics.LATENCY_BUCKETS)
+UPDATES_DELAYED = Counter("bot_updates_delayed_total", "Updates that found all handler slots busy", ["reason"])
+UPDATES_SHED = Counter("bot_updates_shed_total", "Callbacks answered with a busy alert instead of being handled", ["reason"])
+
+class AdmissionController:
+    """Решает, принимать ли новый апдейт, когда бот не справляется.
+
+    Перегрузка — очередь апдейтов длиннее max_waiting или самый давний ждущий
+    соединения из пула ждет дольше max_pool_wait (база или зависшие вызовы X-UI/Lava
+    держат соединения). Тогда некритичные нажатия кнопок сразу получают alert
+    «попробуйте через пару секунд» и не встают в очередь: пользователь не смотрит на
+    спиннер, а очередь не растет от повторных нажатий. Сообщения и подтверждения
+    оплаты принимаются всегда.
+    """
+
+    def __init__(self, max_waiting: int, max_pool_wait: float, critical: tuple[str, ...]):
+        self.max_waiting = max_waiting
+        self.max_pool_wait = max_pool_wait
+        self.critical = critical
+
+    def overload(self, waiting: int) -> str | None:
+        if waiting >= self.max_waiting: return "queue"
+        if database.db_pool and database.db_pool.oldest_wait() >= self.max_pool_wait: return "db_pool"
+        return None
+
+    def sheddable(self, update: Update) -> bool:
+        callback = update.callback_query
+        return callback is not None and not (callback.data or "").startswith(self.critical)
+
+class _Lane:
+    __slots__ = ("lock", "refs")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.refs = 0
+
+class UpdateScheduler(BaseMiddleware):
+    """Outer-middleware на dp.update.
+
+    Апдейты одного пользователя выполняются строго по очереди (двойное нажатие
+    «Я оплатил» или «Бонус» больше не гоняет два read-modify-write параллельно),
+    а общее число работающих хендлеров ограничено семафором. Слот берется только
+    после своей очереди, поэтому один «залипший» пользователь не занимает чужие
+    слоты. Админ идет мимо: /profile и выгрузки работают минутами.
+
+    Заодно помнит работающие апдейты и последний update_id: при остановке drain()
+    дожидается их, а confirm_offset() говорит, до какого апдейта можно подтвердить
+    getUpdates, чтобы Telegram не прислал обработанное повторно. Админские сюда не
+    попадают: минутный /profile иначе держал бы offset и после рестарта заставлял
+    Telegram повторить все, что успело завершиться за ним.
+    """
+
+    def __init__(self, max_concurrent: int, exempt: set[int] | None = None, admission: AdmissionController | None = None):
+        self.max_concurrent = max_concurrent
+        self.exempt = exempt or set()
+        self.admission = admission
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._lanes: dict[int, _Lane] = {}
+        self.in_flight = 0
+        self.waiting = 0
+        self.last_update_id = 0
+        self._active: dict[asyncio.Task, int] = {}
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        if not isinstance(event, Update): return await self._schedule(handler, event, data)
+        self.last_update_id = max(self.last_update_id, event.update_id)
+        user: User | None = data.get("event_from_user")
+        if user is not None and user.id in self.exempt: return await self._schedule(handler, event, data)
+        task = asyncio.current_task()
+        self._active[task] = event.update_id
+        try:
+            return await self._schedule(handler, event, data)
+        finally:
+            self._active.pop(task, None)
+
+    async def _schedule(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        user: User | None = data.get("event_from_user")
+        if user is None or user.id in self.exempt: return await handler(event, data)
+
+        sheddable = self.admission is not None and self.admission.sheddable(event)
+        if sheddable:
+            reason = self.admission.overload(self.waiting)
+            if reason:
+                UPDATES_SHED.labels(reason).inc()
+                return await self._busy(event, data)
+
+        lane = self._lanes.get(user.id)
+        if lane is None: lane = self._lanes[user.id] = _Lane()
+        if lane.refs: UPDATES_DELAYED.labels("user").inc()
+        lane.refs += 1
+
+        start = time.perf_counter()
+        started = False
+        self.waiting += 1
+        try:
+            async with lane.lock:
+                if self._slots.locked(): UPDATES_DELAYED.labels("global").inc()
+                async with self._slots:
+                    started = True
+                    self.waiting -= 1
+                    UPDATE_QUEUE_WAIT.observe(time.perf_counter() - start)
+                    self.in_flight += 1
+                    try:
+                        return await handler(event, data)
+                    except database.PoolTimeoutError:
+                        # пул так и не освободился: вместо молча погасшего спиннера — «попробуйте позже»
+                        if not sheddable: raise
+                        UPDATES_SHED.labels("db_timeout").inc()
+                        return await self._busy(event, data)
+                    finally:
+                        self.in_flight -= 1
+        finally:
+            if not started: self.waiting -= 1
+            lane.refs -= 1
+            if not lane.refs: del self._lanes[user.id]
+
+    async def _busy(self, update: Update, data: dict[str, Any]) -> None:
+        try:
+            await data["bot"].answer_callback_query(update.callback_query.id, BUSY_TEXT, show_alert=True)
+        except Exception as e:
+            logger.warning(f"Не удалось ответить на callback под нагрузкой: {e}")
+
+    async def drain(self, timeout: float) -> int:
+        """Ждет завершения начатых апдейтов не дольше timeout. Возвращает, сколько не успело."""
+        # задачи, созданные поллингом перед остановкой, должны успеть дойти до middleware
+        await asyncio.sleep(0)
+        if not self._active: return 0
+        _, pending = await asyncio.wait(list(self._active), timeout=timeout)
+        return len(pending)
+
+    def confirm_offset(self) -> int:
+        """offset для getUpdates: все апдейты ниже него обработаны (незавершенные придут снова)."""
+        return min(self._active.values(), default=self.last_update_id + 1)
+
+scheduler = UpdateScheduler(
+    MAX_CONCURRENT_UPDATES, exempt={ADMIN_ID},
+    admission=AdmissionController(ADMISSION_MAX_WAITING, ADMISSION_MAX_POOL_WAIT, CRITICAL_CALLBACKS),
+)
+
+metrics.register_gauge("bot_updates_in_flight", "Handlers currently running", lambda: float(scheduler.in_flight))
+metrics.register_gauge("bot_updates_waiting", "Updates waiting for their user lane or a handler slot", lambda: float(scheduler.waiting))
+metrics.register_gauge("bot_update_lanes", "Users with updates queued or running", lambda: float(len(scheduler._lanes)))
+
+def setup(dp: Dispatcher) -> None:
+    dp.update.outer_middleware(scheduler)
@@ -6,6 +6,7 @@ class AdminState(StatesGroup):
     editing_user_id = State()
     waiting_for_search_query = State()
     waiting_for_announcement_text = State()
+    waiting_for_bulk_days = State()
 
 class SupportState(StatesGroup):
     waiting_for_question = State()
@@ -0,0 +1,107 @@
+import asyncio
+from datetime import date, datetime, timedelta
+
+import asyncpg
+
+import database
+import queries
+from config import logger, STATS_REFRESH_INTERVAL, STATS_DAYS
+
+DAILY_FIELDS = ("new_users", "referred_users", "bonus_claims", "payments", "referral_rewards")
+
+TOTALS = queries.Query("stats_totals", """
+SELECT COUNT(*) AS total,
+       COUNT(*) FILTER (WHERE expiry_date > NOW()) AS active,
+       COUNT(*) FILTER (WHERE referrer_id IS NOT NULL) AS referred
+FROM users
+""")
+DAILY_SINCE = queries.Query("stats_daily_since", "SELECT * FROM daily_stats WHERE day >= $1 ORDER BY day DESC")
+
+_bump_queries: dict[tuple[str, ...], queries.Query] = {}
+
+async def bump(conn: asyncpg.Connection, **fields: int) -> None:
+    """Инкремент дневных счетчиков в daily_stats: bump(conn, new_users=1, referred_users=1)."""
+    names = tuple(fields)
+    query = _bump_queries.get(names)
+    if query is None:
+        if unknown := set(names) - set(DAILY_FIELDS): raise ValueError(f"unknown stats fields: {unknown}")
+        columns = ", ".join(names)
+        values = ", ".join(f"${i}" for i in range(1, len(names) + 1))
+        updates = ", ".join(f"{name} = daily_stats.{name} + EXCLUDED.{name}" for name in names)
+        query = _bump_queries[names] = queries.Query(
+            f"stats_bump_{'_'.join(names)}",
+            f"INSERT INTO daily_stats (day, {columns}) VALUES (CURRENT_DATE, {values}) "
+            f"ON CONFLICT (day) DO UPDATE SET {updates}",
+        )
+    await query.execute(conn, *fields.values())
+
+class StatsSnapshot:
+    """Агрегаты для админского дашборда.
+
+    Дневные счетчики (регистрации, рефералы, бонусы, оплаты) инкрементятся хендлерами
+    через bump(). Итоги по таблице users (всего / активных) зависят от времени, поэтому
+    их раз в interval пересчитывает фоновая задача — открытие дашборда читает только
+    память и STATS_DAYS строк daily_stats.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.total_users = 0
+        self.active_users = 0
+        self.referred_users = 0
+        self.refreshed_at: datetime | None = None
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Ошибка пересчета статистики: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def refresh(self) -> None:
+        if not database.db_pool: return
+        async with database.read_pool().acquire() as conn:
+            row = await TOTALS.fetchrow(conn)
+        self.total_users, self.active_users, self.referred_users = row["total"], row["active"], row["referred"]
+        self.refreshed_at = datetime.now()
+
+    async def render(self) -> str:
+        since = date.today() - timedelta(days=STATS_DAYS - 1)
+        async with database.read_pool().acquire() as conn:
+            rows = await DAILY_SINCE.fetch(conn, since)
+
+        week = {name: sum(row[name] for row in rows) for name in DAILY_FIELDS}
+        conversion = self.referred_users / self.total_users * 100 if self.total_users else 0
+        age = f"{int((datetime.now() - self.refreshed_at).total_seconds() // 60)} мин. назад" if self.refreshed_at else "еще не считались"
+
+        lines = [
+            "📊 <b>Статистика</b>\n",
+            f"👥 Всего пользователей: <b>{self.total_users}</b>",
+            f"✅ Активных подписок: <b>{self.active_users}</b>",
+            f"🤝 Пришли по рефералке: <b>{self.referred_users}</b> ({conversion:.1f}%)",
+            f"<i>Итоги обновлены {age}</i>\n",
+            f"<b>За {STATS_DAYS} дн.:</b>",
+            f"🆕 Новых: {week['new_users']} (по рефералке: {week['referred_users']})",
+            f"🎁 Бонусов: {week['bonus_claims']}",
+            f"💳 Оплат: {week['payments']}",
+            f"🏆 Реф. наград: {week['referral_rewards']}\n",
+            "<code>Дата   Нов Реф Бон Опл</code>",
+        ]
+        for row in rows:
+            lines.append(
+                f"<code>{row['day']:%d.%m} {row['new_users']:>4}{row['referred_users']:>4}{row['bonus_claims']:>4}{row['payments']:>4}</code>"
+            )
+        return "\n".join(lines)
+
+snapshot = StatsSnapshot(STATS_REFRESH_INTERVAL)
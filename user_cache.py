@@ -0,0 +1,125 @@
+from collections import OrderedDict
+
+import asyncpg
+
+import database
+import metrics
+import queries
+from config import USER_CACHE_SIZE
+
+USER_FIELDS = (
+    "user_id", "username", "uuid", "expiry_date", "custom_id", "referrer_id",
+    "referral_count", "last_support_time", "last_bonus_claim", "expired_notification_sent",
+    "xui_state", "unreachable_at", "unreachable_reason",
+)
+
+class UserRecord:
+    __slots__ = USER_FIELDS
+
+    def __init__(self, user_id: int):
+        for name in USER_FIELDS: setattr(self, name, None)
+        self.user_id = user_id
+
+    def apply(self, row: asyncpg.Record | dict) -> None:
+        for name in row.keys():
+            if name in USER_FIELDS: setattr(self, name, row[name])
+
+    def __getitem__(self, name: str):
+        return getattr(self, name)
+
+    def get(self, name: str, default=None):
+        return getattr(self, name, default)
+
+class UserCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._records: OrderedDict[int, UserRecord] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def get(self, user_id: int) -> UserRecord | None:
+        record = self._records.get(user_id)
+        if record is None:
+            self.misses += 1
+            return None
+        self._records.move_to_end(user_id)
+        self.hits += 1
+        return record
+
+    def put(self, row: asyncpg.Record, written: bool = True) -> UserRecord:
+        """Кладет полную строку users (SELECT * / RETURNING *) в кэш.
+
+        written — строка только что записана: после вытеснения из кэша пользователь
+        читается из primary (database.note_write), а не с отстающей реплики.
+        """
+        user_id = row["user_id"]
+        if written: database.note_write(user_id)
+        record = self._records.get(user_id)
+        if record is None:
+            record = UserRecord(user_id)
+            self._records[user_id] = record
+            if len(self._records) > self.maxsize:
+                self._records.popitem(last=False)
+        else:
+            self._records.move_to_end(user_id)
+        record.apply(row)
+        return record
+
+    def update(self, user_id: int, **fields) -> None:
+        """Частичное обновление после записи: трогает только уже закэшированные записи."""
+        database.note_write(user_id)
+        record = self._records.get(user_id)
+        if record is not None: record.apply(fields)
+
+    def invalidate(self, user_id: int) -> None:
+        self._records.pop(user_id, None)
+
+    def clear(self) -> None:
+        """Массовая запись в users: кэш сбрасывается, чтения временно идут в primary."""
+        database.note_bulk_write()
+        self._records.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._records),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+users = UserCache(USER_CACHE_SIZE)
+
+metrics.register_counter("user_cache_hits", "User cache hits", lambda: users.hits)
+metrics.register_counter("user_cache_misses", "User cache misses", lambda: users.misses)
+metrics.register_gauge("user_cache_size", "Cached user records", lambda: len(users))
+
+async def get_user(user_id: int, conn: asyncpg.Connection | None = None) -> UserRecord | None:
+    record = users.get(user_id)
+    if record is not None: return record
+
+    if conn is not None:
+        row = await queries.GET_USER.fetchrow(conn, user_id)
+    else:
+        if not database.db_pool: return None
+        async with database.read_pool(user_id).acquire() as conn:
+            row = await queries.GET_USER.fetchrow(conn, user_id)
+
+    if not row: return None
+    return users.put(row, written=False)
+
+async def register_user(conn: asyncpg.Connection, user_id: int, username: str | None, ref: str | None) -> tuple[UserRecord, bool]:
+    """Регистрация за один запрос: поиск реферера по custom_id или числовому id, вставка,
+    счетчик в daily_stats и начисление в pending_referral_rewards. Возвращает (запись, новый ли)."""
+    ref_id = int(ref) if ref and ref.isdigit() and len(ref) < 19 else None
+    for attempt in range(3):
+        try:
+            row = await queries.REGISTER_USER.fetchrow(conn, user_id, username, ref, ref_id)
+            break
+        except asyncpg.UniqueViolationError as e:
+            # custom_id из последовательности совпал со старым случайным — берем следующий
+            if e.constraint_name != "users_custom_id_key" or attempt == 2: raise
+    return users.put(row), row["is_new"]
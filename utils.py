@@ -1,11 +1,15 @@
 import re
+from collections import OrderedDict
 from aiogram import types
-from config import bot
+from aiogram.exceptions import TelegramBadRequest
+from config import bot, RENDERED_CACHE_SIZE
+import metrics
 
 MAX_MESSAGE_LENGTH = 4000
 MAX_CALLBACK_ALERT_LENGTH = 150
 HTML_TAG_RE = re.compile(r"<(/?)([a-zA-Z0-9]+)(?:\s[^>]*)?>")
 HTML_SELF_CLOSING_TAGS = {"br", "hr", "img"}
+PENDING_NOTE = "\n\n⏳ <i>Сервер VPN сейчас перегружен — ключ активируется автоматически в течение нескольких минут.</i>"
 
 def _strip_incomplete_html_tail(text: str) -> str:
     lt = text.rfind("<")
@@ -50,27 +54,96 @@ def truncate_text(text: str | None, max_length: int, parse_mode: str | None = No
     ellipsis = "…"
     return text[: max_length - len(ellipsis)].rstrip() + ellipsis
 
+def content_hash(text: str | None, kwargs: dict) -> int:
+    markup = kwargs.get("reply_markup")
+    return hash((
+        text,
+        kwargs.get("parse_mode"),
+        markup.model_dump_json(exclude_none=True) if markup is not None else None,
+        kwargs.get("disable_web_page_preview"),
+    ))
+
+class RenderedCache:
+    """Хэш последнего отправленного содержимого для (chat_id, message_id).
+
+    Повторная отрисовка того же экрана (фильтры, стрелки, «Назад» в то же меню) не
+    делает edit_message_text: не тратим запрос и лимит, не ловим «message is not modified».
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.skipped = 0
+        self._hashes: OrderedDict[tuple[int, int], int] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def unchanged(self, chat_id: int, message_id: int, digest: int) -> bool:
+        if self._hashes.get((chat_id, message_id)) != digest: return False
+        self._hashes.move_to_end((chat_id, message_id))
+        self.skipped += 1
+        return True
+
+    def remember(self, chat_id: int, message_id: int, digest: int) -> None:
+        self._hashes[(chat_id, message_id)] = digest
+        self._hashes.move_to_end((chat_id, message_id))
+        if len(self._hashes) > self.maxsize: self._hashes.popitem(last=False)
+
+rendered = RenderedCache(RENDERED_CACHE_SIZE)
+
+metrics.register_counter("telegram_edits_skipped", "Message edits skipped because the content was unchanged", lambda: rendered.skipped)
+metrics.register_gauge("telegram_rendered_cache_size", "Messages with a known rendered content hash", lambda: float(len(rendered)))
+
+def _is_not_modified(e: TelegramBadRequest) -> bool:
+    return "message is not modified" in str(e)
+
 async def safe_message_answer(message: types.Message, text: str, **kwargs):
     parse_mode = kwargs.get("parse_mode")
     text = truncate_text(text, MAX_MESSAGE_LENGTH, parse_mode=parse_mode) 
-    return await message.answer(text, **kwargs)
+    result = await message.answer(text, **kwargs)
+    rendered.remember(result.chat.id, result.message_id, content_hash(text, kwargs))
+    return result
 
 async def safe_message_edit_text(message: types.Message, text: str, **kwargs):
     parse_mode = kwargs.get("parse_mode")
     text = truncate_text(text, MAX_MESSAGE_LENGTH, parse_mode=parse_mode)  
-    return await message.edit_text(text, **kwargs)
+    digest = content_hash(text, kwargs)
+    if rendered.unchanged(message.chat.id, message.message_id, digest): return message
+    try:
+        result = await message.edit_text(text, **kwargs)
+    except TelegramBadRequest as e:
+        if not _is_not_modified(e): raise
+        result = message
+    rendered.remember(message.chat.id, message.message_id, digest)
+    return result
+
+async def safe_bot_edit_message_text(chat_id: int, message_id: int, text: str, **kwargs):
+    parse_mode = kwargs.get("parse_mode")
+    text = truncate_text(text, MAX_MESSAGE_LENGTH, parse_mode=parse_mode)
+    digest = content_hash(text, kwargs)
+    if rendered.unchanged(chat_id, message_id, digest): return True
+    try:
+        result = await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, **kwargs)
+    except TelegramBadRequest as e:
+        if not _is_not_modified(e): raise
+        result = True
+    rendered.remember(chat_id, message_id, digest)
+    return result
 
 async def safe_bot_send_message(chat_id: int, text: str, **kwargs):
     parse_mode = kwargs.get("parse_mode")
     text = truncate_text(text, MAX_MESSAGE_LENGTH, parse_mode=parse_mode) 
-    return await bot.send_message(chat_id, text, **kwargs)
+    result = await bot.send_message(chat_id, text, **kwargs)
+    rendered.remember(result.chat.id, result.message_id, content_hash(text, kwargs))
+    return result
 
 async def safe_callback_answer(callback: types.CallbackQuery, text: str | None = None, *, show_alert: bool = False, **kwargs):
     if text is not None:
         text = truncate_text(text, MAX_CALLBACK_ALERT_LENGTH)
     return await callback.answer(text, show_alert=show_alert, **kwargs)
 
-def get_guide_text(key: str) -> str:
+def get_guide_text(key: str, pending: bool = False) -> str:
+    note = PENDING_NOTE if pending else ""
     return (
         f"✅ <b>Оплата прошла успешно!</b>\n\n"
         f"Вот твой ключ доступа (нажми на скрытый текст, чтобы скопировать):\n"
@@ -89,4 +162,5 @@ def get_guide_text(key: str) -> str:
         f"<a href='https://github.com/hiddify/hiddify-next/releases'>Скачать Hiddify</a>\n"
         f"<i>Установи -> Нажми 'Новый профиль' -> 'Добавить из буфера' -> Нажми большую кнопку подключения.</i>\n\n"
         f"<b>⚠️ ВАЖНО:</b> В настройках приложения обязательно включите <b>режим TUN</b> или <b>VPN-режим</b>."
+        f"{note}"
     )
\ No newline at end of file
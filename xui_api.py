@@ -1,28 +1,137 @@
+import asyncio
 import os
+import time
 import uuid
-from py3xui import AsyncApi, Client
+
+from typing import TYPE_CHECKING
+
+import httpx
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+import metrics
 from config import (
     PANEL_URL, PANEL_USERNAME, PANEL_PASSWORD, INBOUND_ID,
-    SERVER_IP, SERVER_PORT, REALITY_PK, SNI, SID, logger
+    SERVER_IP, SERVER_PORT, REALITY_PK, SNI, SID, logger,
+    XUI_TIMEOUT, XUI_ATTEMPTS, XUI_BREAKER_FAILURES, XUI_BREAKER_RESET,
 )
 
-vpn_api: AsyncApi | None = None
+if TYPE_CHECKING:
+    from py3xui import AsyncApi
+
+vpn_api: "AsyncApi | None" = None
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+class CircuitBreaker:
+    """closed -> (N ошибок подряд) -> open -> (reset_timeout) -> half-open: один пробный вызов."""
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None: return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout: return "open"
+        return "half-open"
+
+    def is_open(self) -> bool:
+        state = self.state
+        return state == "open" or (state == "half-open" and self._probing)
+
+    def before_call(self) -> None:
+        state = self.state
+        if state == "open" or (state == "half-open" and self._probing):
+            raise CircuitOpenError("X-UI panel circuit is open")
+        if state == "half-open": self._probing = True
+
+    def record_success(self) -> None:
+        if self.opened_at is not None: logger.info("✅ X-UI панель снова доступна")
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
 
-async def init_vpn_api():
+    def abandon_probe(self) -> None:
+        """Пробный вызов отменили: исход неизвестен, следующий вызов снова станет пробой."""
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._probing = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None: logger.error(f"🔌 X-UI панель недоступна, circuit open на {self.reset_timeout} с")
+            self.opened_at = time.monotonic()
+
+breaker = CircuitBreaker(XUI_BREAKER_FAILURES, XUI_BREAKER_RESET)
+
+metrics.register_gauge("xui_circuit_open", "1 if the X-UI circuit breaker is open", lambda: float(breaker.state != "closed"))
+
+def is_transient(error: BaseException) -> bool:
+    if isinstance(error, (asyncio.TimeoutError, httpx.TransportError, ConnectionError)): return True
+    if isinstance(error, httpx.HTTPStatusError): return error.response.status_code >= 500
+    return False
+
+async def _guarded(func, *args, deadline: float | None = None, **kwargs):
+    """Таймаут + ретраи с джиттером + circuit breaker для любого вызова панели.
+
+    deadline — общий срок на все попытки (для хендлеров); без него действуют только
+    XUI_TIMEOUT на попытку и XUI_ATTEMPTS.
+    """
+    breaker.before_call()
+    try:
+        async with asyncio.timeout(deadline):
+            async for attempt in AsyncRetrying(
+                stop=stop_after_attempt(XUI_ATTEMPTS),
+                wait=wait_random_exponential(multiplier=0.2, max=2),
+                retry=retry_if_exception(is_transient),
+                reraise=True,
+            ):
+                with attempt:
+                    result = await asyncio.wait_for(func(*args, **kwargs), XUI_TIMEOUT)
+    except Exception as e:
+        # success:false от панели (ValueError) — не сбой связи, но и не признак здоровья
+        if is_transient(e): breaker.record_failure()
+        else: breaker.abandon_probe()
+        raise
+    except BaseException:
+        # CancelledError (drain, stop() фоновых задач): без этого half-open застрял бы с _probing навсегда
+        breaker.abandon_probe()
+        raise
+    breaker.record_success()
+    return result
+
+async def init_vpn_api() -> bool:
     global vpn_api
+    from py3xui import AsyncApi
     vpn_api = AsyncApi(
         host=PANEL_URL,
         username=PANEL_USERNAME,
         password=PANEL_PASSWORD,
         use_tls_verify=False,
     )
+    # ретраи делает _guarded; свои (3 попытки со sleep 2-4 с) py3xui обрезались бы на XUI_TIMEOUT
+    for api in (vpn_api.client, vpn_api.inbound, vpn_api.database, vpn_api.server): api.max_retries = 1
     try:
         await vpn_api.login()
         logger.info("✅ X-UI API connected")
+        return True
     except Exception as e:
         logger.warning(f"⚠️ X-UI login failed: {e}")
+        return False
+
+@metrics.tracked("xui", "add_client")
+async def add_client_via_xui_api(uuid_str: str, email: str, limit_ip: int = 1, expiry_time: int = 0, deadline: float | None = None) -> bool:
+    return await _guarded(_add_client, uuid_str, email, limit_ip=limit_ip, expiry_time=expiry_time, deadline=deadline)
 
-async def add_client_via_xui_api(uuid_str: str, email: str, limit_ip: int = 1, expiry_time: int = 0) -> bool:
+@metrics.tracked("xui", "update_client")
+async def update_client_via_xui_api(uuid_str: str, email: str, expiry_time: int, deadline: float | None = None) -> bool:
+    return await _guarded(_update_client, uuid_str, email, expiry_time, deadline=deadline)
+
+async def _add_client(uuid_str: str, email: str, limit_ip: int = 1, expiry_time: int = 0) -> bool:
     if vpn_api is None:
         raise RuntimeError("vpn_api is not initialized")
 
@@ -31,6 +140,7 @@ async def add_client_via_xui_api(uuid_str: str, email: str, limit_ip: int = 1, e
     LIMIT_GB = 75 
     LIMIT_BYTES = LIMIT_GB * 1024 * 1024 * 1024
 
+    from py3xui import Client
     client = Client(
         id=uuid_str,
         email=email,
@@ -47,13 +157,14 @@ async def add_client_via_xui_api(uuid_str: str, email: str, limit_ip: int = 1, e
     logger.info("✅ Client %s added successfully via py3xui", email)
     return True
 
-async def update_client_via_xui_api(uuid_str: str, email: str, expiry_time: int) -> bool:
+async def _update_client(uuid_str: str, email: str, expiry_time: int) -> bool:
     if vpn_api is None: raise RuntimeError("vpn_api is not initialized")
     await vpn_api.login()
 
     LIMIT_GB = 75 
     LIMIT_BYTES = LIMIT_GB * 1024 * 1024 * 1024
 
+    from py3xui import Client
     client = Client(
         id=uuid_str,
         email=email,
@@ -71,6 +182,7 @@ async def update_client_via_xui_api(uuid_str: str, email: str, expiry_time: int)
         logger.info(f"✅ Client {email} updated successfully")
         return True
     except Exception as e:
+        if is_transient(e): raise
         logger.warning(f"⚠️ Ошибка обновления {email}: {e}. Пробуем пересоздать...")
 
         try:
@@ -88,13 +200,62 @@ async def update_client_via_xui_api(uuid_str: str, email: str, expiry_time: int)
                         await vpn_api.client.delete(INBOUND_ID, real_uuid)
                     except Exception: pass
             logger.info(f"🆕 Создаем клиента {email} заново...")
-            await add_client_via_xui_api(uuid_str, email, limit_ip=1, expiry_time=expiry_time)
+            await _add_client(uuid_str, email, limit_ip=1, expiry_time=expiry_time)
             return True
 
         except Exception as deep_error:
             logger.error(f"❌ Не удалось восстановить клиента {email}: {deep_error}")
             raise deep_error
 
+async def _disable_client(uuid_str: str, email: str, expiry_time: int) -> None:
+    LIMIT_GB = 75 
+    LIMIT_BYTES = LIMIT_GB * 1024 * 1024 * 1024
+
+    from py3xui import Client
+    client = Client(
+        id=uuid_str,
+        email=email,
+        enable=False,
+        limit_ip=1,
+        total_gb=LIMIT_BYTES,
+        expiry_time=expiry_time,
+        flow="xtls-rprx-vision",
+        tg_id="",
+        sub_id="",
+    )
+    await vpn_api.client.update(uuid_str, client=client)
+
+async def _delete_client(email: str) -> None:
+    # client.delete() ради email каждый раз выкачивает список всех клиентов, а email у нас и так есть
+    api = vpn_api.client
+    await api._post(api._url(f"panel/api/clients/del/{email}"), {"Accept": "application/json"}, {})
+
+async def _bulk(action, items: list[tuple]) -> list[tuple]:
+    """Один логин на пачку; останавливается, как только панель начинает сбоить."""
+    if vpn_api is None: raise RuntimeError("vpn_api is not initialized")
+    await _guarded(vpn_api.login)
+
+    done = []
+    for item in items:
+        try:
+            await _guarded(action, *item)
+        except CircuitOpenError:
+            break
+        except Exception as e:
+            if is_transient(e): break
+            logger.warning(f"⚠️ {action.__name__}{item}: {e}")
+        done.append(item)
+    return done
+
+@metrics.tracked("xui", "disable_clients")
+async def disable_clients_via_xui_api(clients: list[tuple[str, str, int]]) -> list[tuple[str, str, int]]:
+    """clients — (uuid, email, expiry_ms). Возвращает обработанные; ошибка «нет такого клиента» считается успехом."""
+    return await _bulk(_disable_client, clients)
+
+@metrics.tracked("xui", "delete_clients")
+async def delete_clients_via_xui_api(emails: list[str]) -> list[str]:
+    return [item[0] for item in await _bulk(_delete_client, [(email,) for email in emails])]
+
 def generate_vless_link(user_uuid: str, email: str) -> str:
     return (
         f"vless://{user_uuid}@{SERVER_IP}:{SERVER_PORT}?"